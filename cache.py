@@ -0,0 +1,122 @@
+"""
+Persistent cache of detector results, shared across cases.
+
+The same stock images, wallpapers, and application assets turn up in case
+after case. Results are cached by the file's sha512 and a version string that
+identifies the detector configuration (cascades, templates, thresholds, and
+options), so that changing any of them invalidates the old results. The cache
+is kept to a maximum amount of entries by evicting the least recently used.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+DEFAULT_CACHE_NAME = os.path.join(os.path.expanduser('~'), '.prioritize', 'cache.sqlite')
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# Bump whenever the format of the cached results changes
+CACHE_FORMAT = 1
+
+# Only record a hit as a use if the entry hasn't been used in this long, to
+# avoid a write for every hit
+TOUCH_INTERVAL = 60 * 60
+
+# How many new entries between checks for eviction
+EVICT_INTERVAL = 1000
+
+CREATE_CACHE_TABLE_QUERY = '''CREATE TABLE IF NOT EXISTS results (
+  sha512    TEXT,
+  version   TEXT,
+  result    TEXT,
+  last_used INTEGER,
+  PRIMARY KEY (sha512, version)
+  )'''
+
+CREATE_CACHE_INDEX_QUERY = '''CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)'''
+
+SELECT_RESULT_QUERY = '''SELECT result, last_used FROM results WHERE sha512=? AND version=?'''
+
+INSERT_RESULT_QUERY = '''INSERT OR REPLACE INTO results (sha512, version, result, last_used)
+  VALUES (?, ?, ?, ?)'''
+
+TOUCH_RESULT_QUERY = '''UPDATE results SET last_used=? WHERE sha512=? AND version=?'''
+
+COUNT_QUERY = '''SELECT COUNT(*) FROM results'''
+
+EVICT_QUERY = '''DELETE FROM results WHERE rowid IN
+  (SELECT rowid FROM results ORDER BY last_used LIMIT ?)'''
+
+
+def make_version(config):
+    """Returns a version string for a detector configuration, which is any
+    JSON-serializable value"""
+    return hashlib.sha1(json.dumps([CACHE_FORMAT, config], sort_keys=True)).hexdigest()
+
+
+def encode_result(result):
+    """Serializes a list of values. Strings are treated as raw bytes, since
+    OCRed text and EXIF fields aren't necessarily valid UTF-8."""
+    return json.dumps(result, encoding='latin-1')
+
+
+def decode_result(text):
+    return [value.encode('latin-1') if isinstance(value, unicode) else value
+            for value in json.loads(text)]
+
+
+class ResultCache(object):
+    """Cache of results keyed by (sha512, version). Results are flat lists of
+    numbers, strings, booleans, and None."""
+
+    def __init__(self, fname=DEFAULT_CACHE_NAME, version='', max_entries=DEFAULT_MAX_ENTRIES):
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # Several processes may share the cache, so wait on each other's locks
+        self.conn = sqlite3.connect(fname, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(CREATE_CACHE_TABLE_QUERY)
+        self.conn.execute(CREATE_CACHE_INDEX_QUERY)
+        self.conn.commit()
+        self.version = version
+        self.max_entries = max_entries
+        self.added = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sha512):
+        """Returns the cached result, or None"""
+        row = self.conn.execute(SELECT_RESULT_QUERY, (sha512, self.version)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        result, last_used = row
+        now = int(time.time())
+        if now - last_used > TOUCH_INTERVAL:
+            self.conn.execute(TOUCH_RESULT_QUERY, (now, sha512, self.version))
+        return decode_result(result)
+
+    def put(self, sha512, result):
+        self.conn.execute(INSERT_RESULT_QUERY, (sha512, self.version, encode_result(result), int(time.time())))
+        self.added += 1
+        if self.added % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries beyond the maximum"""
+        count = self.conn.execute(COUNT_QUERY).fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(EVICT_QUERY, (count - self.max_entries,))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
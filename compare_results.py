@@ -0,0 +1,320 @@
+"""
+Utility for comparing two runs of prioritize.py, such as before and after a
+change to the cascades, the detector settings, or the templates.
+
+The files are matched up by their sha512, with a merge join over both
+databases in sha512 order, so that neither has to fit into memory. It reports:
+ * how many classifications changed, for faces, CCs, IDs, and screenshots
+ * the precision and recall of each, and how they changed, if a labeled
+   ground truth is given
+ * how the time spent in each stage changed
+
+The ground truth is a CSV file with a header, a sha512 column, and a 0/1
+column for any of faces, cc, id, and screenshot.
+
+USAGE
+  compare_results.py [--truth <csv>] <baseline db> <candidate db>
+"""
+
+import sys
+import csv
+import sqlite3
+import argparse
+
+g_debug = False
+
+
+###############################################################################
+# Generic helpers
+###############################################################################
+
+def print_debug(msg):
+    if g_debug:
+        print "  DEBUG:", msg
+
+###############################################################################
+# Database-related functionality
+###############################################################################
+
+FIELDS = ['faces', 'cc', 'id', 'screenshot']
+
+# The UNIQUE constraint on sha512 indexes it, so this streams without a sort
+SELECT_RESULTS_QUERY = '''SELECT files.sha512, files.filename, jpeg.well_formed,
+    jpeg.faces, jpeg.cc, jpeg.id, jpeg.screenshot
+    FROM files JOIN jpeg ON jpeg.file_id = files.id
+    ORDER BY files.sha512'''
+
+SELECT_STAGE_TIMINGS_QUERY = '''SELECT stage, SUM(calls), SUM(total_seconds)
+    FROM stage_timings GROUP BY stage'''
+
+SELECT_TABLE_QUERY = '''SELECT name FROM sqlite_master WHERE type='table' AND name=?'''
+
+# Rows fetched at a time from each database
+FETCH_ROWS = 10000
+
+
+def to_bool(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true')
+    return bool(value)
+
+
+def iter_results(db_name):
+    """Yields (sha512, filename, {field: bool}) for every image, in sha512 order"""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    cursor.execute(SELECT_RESULTS_QUERY)
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        for sha512, filename, well_formed, faces, cc, id_, screenshot in rows:
+            labels = {'faces': bool(faces) and int(faces) > 0,
+                      'cc': to_bool(cc),
+                      'id': to_bool(id_),
+                      'screenshot': to_bool(screenshot)}
+            yield sha512, filename, labels
+    conn.close()
+
+
+def merge_join(baseline, candidate):
+    """Joins two iterators sorted by sha512. Yields (sha512, filename,
+    baseline labels, candidate labels), where the labels are None for a file
+    that's only in the other database."""
+    base_row = next(baseline, None)
+    cand_row = next(candidate, None)
+    while base_row is not None or cand_row is not None:
+        if cand_row is None or (base_row is not None and base_row[0] < cand_row[0]):
+            yield base_row[0], base_row[1], base_row[2], None
+            base_row = next(baseline, None)
+        elif base_row is None or cand_row[0] < base_row[0]:
+            yield cand_row[0], cand_row[1], None, cand_row[2]
+            cand_row = next(candidate, None)
+        else:
+            yield base_row[0], base_row[1], base_row[2], cand_row[2]
+            base_row = next(baseline, None)
+            cand_row = next(candidate, None)
+
+
+def get_stage_timings(db_name):
+    """Returns {stage: (calls, total seconds)}, or None for databases from
+    before the timings were recorded"""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    try:
+        if cursor.execute(SELECT_TABLE_QUERY, ('stage_timings',)).fetchone() is None:
+            return None
+        cursor.execute(SELECT_STAGE_TIMINGS_QUERY)
+        return dict((stage, (calls, total)) for stage, calls, total in cursor.fetchall())
+    finally:
+        conn.close()
+
+###############################################################################
+# Comparison
+###############################################################################
+
+def load_truth(fname):
+    """Returns {sha512: {field: bool}} from a ground truth CSV file"""
+    truth = {}
+    with open(fname, 'rb') as fh:
+        for row in csv.DictReader(fh):
+            sha512 = row.pop('sha512').strip().lower()
+            truth[sha512] = dict((field, to_bool(row[field])) for field in FIELDS
+                                 if row.get(field, '').strip() != '')
+    return truth
+
+
+class Confusion(object):
+    """Counts of true/false positives/negatives for a single field"""
+
+    def __init__(self):
+        self.tp = self.fp = self.fn = self.tn = 0
+
+    def add(self, predicted, actual):
+        if predicted and actual:
+            self.tp += 1
+        elif predicted:
+            self.fp += 1
+        elif actual:
+            self.fn += 1
+        else:
+            self.tn += 1
+
+    def precision(self):
+        return self.tp * 1.0 / (self.tp + self.fp) if self.tp + self.fp else None
+
+    def recall(self):
+        return self.tp * 1.0 / (self.tp + self.fn) if self.tp + self.fn else None
+
+
+class Comparison(object):
+    """The differences between a baseline and a candidate run"""
+
+    def __init__(self, truth=None, max_examples=0):
+        self.truth = truth or {}
+        self.max_examples = max_examples
+        self.only_baseline = 0
+        self.only_candidate = 0
+        self.common = 0
+        # field -> [gained, lost]
+        self.changes = dict((field, [0, 0]) for field in FIELDS)
+        self.examples = []
+        self.confusion = {'baseline': dict((field, Confusion()) for field in FIELDS),
+                          'candidate': dict((field, Confusion()) for field in FIELDS)}
+        # Labeled files that each run didn't examine
+        self.unlabeled = {'baseline': len(self.truth), 'candidate': len(self.truth)}
+
+    def add(self, sha512, filename, base, cand):
+        if base is None:
+            self.only_candidate += 1
+        elif cand is None:
+            self.only_baseline += 1
+        else:
+            self.common += 1
+            for field in FIELDS:
+                if base[field] != cand[field]:
+                    self.changes[field][0 if cand[field] else 1] += 1
+                    if len(self.examples) < self.max_examples:
+                        self.examples.append((filename, field, base[field], cand[field]))
+
+        actual = self.truth.get(sha512)
+        if actual is None:
+            return
+        for name, labels in (('baseline', base), ('candidate', cand)):
+            if labels is None:
+                continue
+            self.unlabeled[name] -= 1
+            for field, value in actual.iteritems():
+                self.confusion[name][field].add(labels[field], value)
+
+    def regressions(self, max_drop):
+        """Returns a list of (field, metric, drop) for the precision and recall
+        that dropped by more than max_drop"""
+        regressions = []
+        for field in FIELDS:
+            for metric in ('precision', 'recall'):
+                base = getattr(self.confusion['baseline'][field], metric)()
+                cand = getattr(self.confusion['candidate'][field], metric)()
+                if base is not None and cand is not None and base - cand > max_drop:
+                    regressions.append((field, metric, base - cand))
+        return regressions
+
+
+def compare(baseline_db, candidate_db, truth=None, max_examples=0):
+    comparison = Comparison(truth, max_examples)
+    for sha512, filename, base, cand in merge_join(iter_results(baseline_db), iter_results(candidate_db)):
+        comparison.add(sha512, filename, base, cand)
+    return comparison
+
+###############################################################################
+# Reporting
+###############################################################################
+
+def format_ratio(value):
+    return '%0.3f' % value if value is not None else '  -  '
+
+
+def format_delta(base, cand):
+    if base is None or cand is None:
+        return '  -  '
+    return '%+0.3f' % (cand - base)
+
+
+def print_report(comparison, baseline_timings, candidate_timings):
+    print "Files in both: %d, only in the baseline: %d, only in the candidate: %d" % (
+        comparison.common, comparison.only_baseline, comparison.only_candidate)
+    print
+    print "%-12s %10s %10s" % ('Changed', 'gained', 'lost')
+    for field in FIELDS:
+        gained, lost = comparison.changes[field]
+        print "%-12s %10d %10d" % (field, gained, lost)
+    for filename, field, before, after in comparison.examples:
+        print "  %s: %s %s -> %s" % (filename, field, before, after)
+
+    if comparison.truth:
+        print
+        print "Against %d labeled files (%d and %d weren't in the baseline and candidate)" % (
+            len(comparison.truth), comparison.unlabeled['baseline'], comparison.unlabeled['candidate'])
+        print "%-12s %10s %10s %8s %10s %10s %8s" % ('', 'precision', '', '', 'recall', '', '')
+        print "%-12s %10s %10s %8s %10s %10s %8s" % ('', 'baseline', 'candidate', 'delta',
+                                                     'baseline', 'candidate', 'delta')
+        for field in FIELDS:
+            base = comparison.confusion['baseline'][field]
+            cand = comparison.confusion['candidate'][field]
+            print "%-12s %10s %10s %8s %10s %10s %8s" % (
+                field, format_ratio(base.precision()), format_ratio(cand.precision()),
+                format_delta(base.precision(), cand.precision()),
+                format_ratio(base.recall()), format_ratio(cand.recall()),
+                format_delta(base.recall(), cand.recall()))
+
+    print
+    if baseline_timings is None or candidate_timings is None:
+        print "No stage timings to compare (they're recorded from this version on)"
+        return
+    print "%-12s %14s %14s %8s" % ('Stage', 'baseline ms', 'candidate ms', 'change')
+    for stage in sorted(set(baseline_timings) | set(candidate_timings)):
+        base = mean_ms(baseline_timings.get(stage))
+        cand = mean_ms(candidate_timings.get(stage))
+        change = '%+0.1f%%' % ((cand - base) * 100.0 / base) if base and cand is not None else '-'
+        print "%-12s %14s %14s %8s" % (stage, '%0.2f' % base if base is not None else '-',
+                                       '%0.2f' % cand if cand is not None else '-', change)
+
+
+def mean_ms(timing):
+    """Returns the mean milliseconds per call, from (calls, total seconds)"""
+    if not timing or not timing[0]:
+        return None
+    return timing[1] * 1000.0 / timing[0]
+
+###############################################################################
+# General functionality
+###############################################################################
+
+def build_argparser():
+    parser = argparse.ArgumentParser(description='Compares the results and speed of two runs')
+
+    parser.add_argument('--debug', dest='debug', action='store_true',
+                      help='Add additional logging data')
+
+    parser.add_argument('--truth', dest='truth', action='store',
+                      default=None,
+                      help='A CSV file of labeled files, with a sha512 column and a 0/1 column '
+                           'for any of %s' % ', '.join(FIELDS))
+
+    parser.add_argument('--examples', dest='examples', action='store', type=int,
+                      default=10,
+                      help='List up to this many of the changed classifications (default is 10)')
+
+    parser.add_argument('--max-drop', dest='max_drop', action='store', type=float,
+                      default=None,
+                      help='Exit with an error if any precision or recall dropped by more than this')
+
+    parser.add_argument(dest='baseline', help='The database from the earlier run')
+
+    parser.add_argument(dest='candidate', help='The database from the run being evaluated')
+    return parser
+
+
+def main(argv=None):
+    global g_debug
+    parser = build_argparser()
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    g_debug = args.debug
+
+    truth = load_truth(args.truth) if args.truth else None
+    print_debug("Loaded %d labeled files" % len(truth or {}))
+    comparison = compare(args.baseline, args.candidate, truth, args.examples)
+    print_report(comparison, get_stage_timings(args.baseline), get_stage_timings(args.candidate))
+
+    if args.max_drop is not None:
+        regressions = comparison.regressions(args.max_drop)
+        for field, metric, drop in regressions:
+            print "Regression: the %s of %s dropped by %0.3f" % (metric, field, drop)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Lists and reads the files to examine, whether they're on disk or inside of a
+container, so that carved output doesn't need to be extracted first.
+
+Supported containers:
+  tar archives (optionally compressed), zip archives, and raw concatenated
+  carves (several JPEGs carved back-to-back into a single file)
+
+Files inside of a container are named <container path>::<path within the
+container>. Members of a raw carve are named by their byte range, as
+<container path>::@<offset>+<length>.
+
+USAGE
+  containers.py   (Lists and reads back the members of a test zip archive)
+"""
+
+import os
+import mmap
+import tarfile
+import zipfile
+import threading
+
+# Separates the container's path from the path within the container
+CONTAINER_SEP = '::'
+
+# Raw concatenated carves can't be identified by their contents. Others, such
+# as disk images, can be added with set_carve_extensions.
+CARVE_EXTENSIONS = ('.carve',)
+
+# Archives are identified from this much of the start of the file
+SNIFF_SIZE = 512
+
+ZIP_MAGIC = ('PK\x03\x04', 'PK\x05\x06')
+TAR_MAGIC = 'ustar'
+TAR_MAGIC_OFFSET = 257
+
+# Compressed tars only have the magic of their compression, so they're also
+# identified by name, rather than decompressing every gzip or bzip2 file
+COMPRESSED_MAGIC = ('\x1f\x8b', 'BZh')
+COMPRESSED_TAR_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tbz2')
+
+# JPEG start and end of image markers
+JPEG_SOI = '\xff\xd8\xff'
+JPEG_EOI = '\xff\xd9'
+
+# The extensions of files that are split as raw concatenated carves
+g_carve_extensions = CARVE_EXTENSIONS
+
+# Open containers are reused for every one of their members
+g_open_containers = {}
+
+# The open archives share a file position, so only one thread may read from
+# them at a time
+g_container_lock = threading.RLock()
+
+
+###############################################################################
+# Entries
+###############################################################################
+
+class Entry(object):
+    """A single file to examine. The contents are only read when needed"""
+
+    def __init__(self, name, size, reader):
+        self.name = name
+        self.size = size
+        self._reader = reader
+
+    def read(self, size=None):
+        """Reads the contents, or only the first size bytes"""
+        return self._reader(size)
+
+    def __repr__(self):
+        return 'Entry(%r, %d)' % (self.name, self.size)
+
+
+def file_entry(fname):
+    def reader(size=None):
+        with open(fname, 'rb') as fh:
+            return fh.read() if size is None else fh.read(size)
+    return Entry(fname, os.path.getsize(fname), reader)
+
+
+def tar_entries(fname):
+    archive = open_container(fname)
+    for member in archive:
+        if member.isfile():
+            name = fname + CONTAINER_SEP + member.name
+            yield Entry(name, member.size, _tar_reader(fname, member))
+
+
+def _tar_reader(fname, member):
+    def reader(size=None):
+        with g_container_lock:
+            return open_container(fname).extractfile(member).read(size)
+    return reader
+
+
+def zip_entries(fname):
+    archive = open_container(fname)
+    for info in archive.infolist():
+        if not info.filename.endswith('/'):
+            # Members with the UTF-8 flag set are named in unicode, while every
+            # other name is a (UTF-8) str
+            member = info.filename
+            if isinstance(member, unicode):
+                member = member.encode('utf-8')
+            name = fname + CONTAINER_SEP + member
+            yield Entry(name, info.file_size, _zip_reader(fname, info))
+
+
+def _zip_reader(fname, member):
+    """member is either the ZipInfo, or the member's name as it was recorded"""
+    def reader(size=None):
+        with g_container_lock:
+            archive = open_container(fname)
+            info = member if isinstance(member, zipfile.ZipInfo) else _zip_info(archive, member)
+            if size is None:
+                return archive.read(info)
+            return archive.open(info).read(size)
+    return reader
+
+
+def _zip_info(archive, member):
+    """Finds a member by its recorded (UTF-8) name, whether or not the archive
+    names it in unicode"""
+    try:
+        return archive.getinfo(member)
+    except KeyError:
+        return archive.getinfo(member.decode('utf-8'))
+
+
+def carve_entries(fname):
+    for offset, length in split_carve(fname):
+        name = '%s%s@%d+%d' % (fname, CONTAINER_SEP, offset, length)
+        yield Entry(name, length, _carve_reader(fname, offset, length))
+
+
+def _carve_reader(fname, offset, length):
+    def reader(size=None):
+        with open(fname, 'rb') as fh:
+            fh.seek(offset)
+            return fh.read(length if size is None else min(size, length))
+    return reader
+
+
+def split_carve(fname):
+    """Returns the (offset, length) of each JPEG within a raw concatenated carve
+
+    A new JPEG only starts at a start of image marker that follows an end of
+    image marker, so that embedded EXIF thumbnails aren't split out.
+    """
+    size = os.path.getsize(fname)
+    if size == 0:
+        return []
+    ranges = []
+    with open(fname, 'rb') as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = data.find(JPEG_SOI)
+            while start != -1:
+                end = data.find(JPEG_EOI, start + len(JPEG_SOI))
+                next_start = data.find(JPEG_SOI, end) if end != -1 else -1
+                stop = next_start if next_start != -1 else size
+                ranges.append((start, stop - start))
+                start = next_start
+        finally:
+            data.close()
+    return ranges
+
+
+###############################################################################
+# Containers
+###############################################################################
+
+def set_carve_extensions(extensions):
+    """Splits files with any of these extensions as raw concatenated carves,
+    along with CARVE_EXTENSIONS"""
+    global g_carve_extensions
+    extensions = [ext.lower() if ext.startswith('.') else '.' + ext.lower() for ext in extensions]
+    g_carve_extensions = CARVE_EXTENSIONS + tuple(extensions)
+
+
+def read_magic(fname):
+    """Returns the first SNIFF_SIZE bytes of fname, or '' if it can't be read"""
+    try:
+        with open(fname, 'rb') as fh:
+            return fh.read(SNIFF_SIZE)
+    except IOError:
+        return ''
+
+
+def container_type(fname):
+    """Returns 'tar', 'zip', 'carve', or None if fname isn't a container
+
+    This only checks the name and a single small read, so it's cheap enough
+    for every file in a listing. A file that's mistaken for an archive fails
+    to open when it's listed, and is then examined as a file.
+    """
+    lower = fname.lower()
+    if lower.endswith(g_carve_extensions):
+        return 'carve'
+    magic = read_magic(fname)
+    if magic.startswith(ZIP_MAGIC):
+        return 'zip'
+    if magic[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + len(TAR_MAGIC)] == TAR_MAGIC:
+        return 'tar'
+    if magic.startswith(COMPRESSED_MAGIC) and lower.endswith(COMPRESSED_TAR_EXTENSIONS):
+        return 'tar'
+    return None
+
+
+def open_container(fname):
+    """Returns an open archive for fname, reusing it if it was already open"""
+    with g_container_lock:
+        if fname not in g_open_containers:
+            if container_type(fname) == 'zip':
+                g_open_containers[fname] = zipfile.ZipFile(fname)
+            else:
+                g_open_containers[fname] = tarfile.open(fname)
+        return g_open_containers[fname]
+
+
+def close_containers():
+    with g_container_lock:
+        for archive in g_open_containers.itervalues():
+            archive.close()
+        g_open_containers.clear()
+
+
+def get_entries(fname, expand_containers=True):
+    """Returns the entries for a single file on disk"""
+    kind = container_type(fname) if expand_containers else None
+    if kind == 'tar':
+        return tar_entries(fname)
+    elif kind == 'zip':
+        return zip_entries(fname)
+    elif kind == 'carve':
+        return carve_entries(fname)
+    return [file_entry(fname)]
+
+
+def is_contained(name):
+    return CONTAINER_SEP in name
+
+
+def read_entry(name):
+    """Reads the contents of a file given its name, as recorded in the DB"""
+    # Names are recorded as the text of their UTF-8 encoding
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    if not is_contained(name):
+        return file_entry(name).read()
+
+    container, member = name.split(CONTAINER_SEP, 1)
+    kind = container_type(container)
+    # Carves are named by their byte range, even if the container's extension
+    # is no longer split as a carve
+    if kind == 'carve' or (kind is None and member.startswith('@')):
+        offset, length = member.lstrip('@').split('+')
+        return _carve_reader(container, int(offset), int(length))()
+    elif kind == 'zip':
+        return _zip_reader(container, member)()
+    else:
+        with g_container_lock:
+            return open_container(container).extractfile(member).read()
+
+###############################################################################
+# Test Main
+###############################################################################
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    tmp_dir = tempfile.mkdtemp(prefix='containers-')
+    try:
+        zip_fname = os.path.join(tmp_dir, 'test.zip')
+        archive = zipfile.ZipFile(zip_fname, 'w')
+        # A non-ASCII unicode name is written with the UTF-8 flag set
+        archive.writestr(u'caf\xe9/r\xe9sum\xe9.jpg', 'flagged')
+        archive.writestr('plain.jpg', 'plain')
+        archive.close()
+        for entry in get_entries(zip_fname):
+            assert isinstance(entry.name, str), repr(entry.name)
+            data = entry.read()
+            # As read back from the DB, where it's stored decoded
+            assert read_entry(entry.name.decode('utf-8')) == data
+            assert entry.read(4) == data[:4]
+            print "%r: %r" % (entry.name, data)
+        close_containers()
+    finally:
+        shutil.rmtree(tmp_dir)
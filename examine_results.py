@@ -4,9 +4,16 @@ Utility for examining data extracted from images.
 Creates an HTML file that displays all of the images.
 """
 
+import os
 import sys
 import sqlite3
+import hashlib
 import argparse
+import datetime
+
+# local
+import query
+import containers
 
 g_debug = False
 
@@ -22,71 +29,88 @@ def print_debug(msg):
 ###############################################################################
 # Database-related functionality
 ###############################################################################
-def open_db(db_name):
+# How long to wait on an ingest's lock when rebuilding the report tables
+REBUILD_TIMEOUT = 60
+
+def open_db(db_name, rebuild_views=False):
+    """Opens the database. It's only written to if rebuild_views is set, since
+    it may be in use by an ingest; out of date report tables are otherwise
+    left alone, and the results are read from the source tables instead."""
     print_debug("Connecting to DB: '%s'" % db_name)
-    conn = sqlite3.connect(db_name)
+    conn = sqlite3.connect(db_name, timeout=REBUILD_TIMEOUT)
     cursor = conn.cursor()
+    if rebuild_views:
+        if query.ensure_views(cursor):
+            print_debug("Rebuilt the report tables")
+            conn.commit()
+    elif not query.views_are_current(cursor):
+        print ("The report tables are out of date (an ingest may still be running), so the results "
+               "are read from the source tables, which is slower. Use --rebuild-views to rebuild them.")
     return cursor
 
 
-def get_query_results(cursor, query):
-    cursor.execute(query)
-    query_results = cursor.fetchall()
-    results = []
-    fields = "filename, faces, screenshot, screenshot_fname, cc, cc_fname, jpeg.id, id_fname, contains_skin, skin_type, gps_data, date_data, model_data, ocr_text".split(', ')
-    for result in query_results:
-        results.append(dict(zip(fields, result)))
-    return results
-
-
-def order_by_faces(cursor, maxfiles=None):
+def order_by_faces(cursor, maxfiles=None, filters=None):
     print_debug('Prioritizing by the number of faces')
+    results = filters or query.new_query(cursor)
+    return results.not_solid().order_by('faces').limit(maxfiles).run(cursor)
 
-    query = '''SELECT files.filename, faces, screenshot, screenshot_fname, cc, cc_fname, 
-                jpeg.id, id_fname, contains_skin, skin_type, gps_data, date_data, model_data, ocr_text
-    FROM jpeg JOIN files
-        ON files.id = jpeg.file_id
-    WHERE well_formed = 1 AND is_solid = 0
-    ORDER BY faces DESC
-    '''
-
-    if maxfiles:
-        query += " LIMIT %d" % maxfiles
-
-    return get_query_results(cursor, query)
-
-def order_by_cc(cursor, maxfiles=None):
-    query = '''SELECT files.filename, faces, screenshot, screenshot_fname, cc, cc_fname, 
-                jpeg.id, id_fname, contains_skin, skin_type, gps_data, date_data, model_data, ocr_text
-    FROM jpeg JOIN files
-        ON files.id = jpeg.file_id
-    WHERE well_formed = 1 
-    ORDER BY cc DESC
-    '''
-
-    if maxfiles:
-        query += " LIMIT %d" % maxfiles
-
-    return get_query_results(cursor, query)
+def order_by_cc(cursor, maxfiles=None, filters=None):
+    results = filters or query.new_query(cursor)
+    return results.order_by('cc').limit(maxfiles).run(cursor)
 
-def order_by_id(cursor, maxfiles=None):
-    query = '''SELECT files.filename, faces, screenshot, screenshot_fname, cc, cc_fname, 
-                jpeg.id, id_fname, contains_skin, skin_type, gps_data, date_data, model_data, ocr_text
-    FROM jpeg JOIN files
-        ON files.id = jpeg.file_id
-    WHERE well_formed = 1 
-    ORDER BY jpeg.id DESC
-    '''
+def order_by_id(cursor, maxfiles=None, filters=None):
+    results = filters or query.new_query(cursor)
+    return results.order_by('id').limit(maxfiles).run(cursor)
 
-    if maxfiles:
-        query += " LIMIT %d" % maxfiles
-
-    return get_query_results(cursor, query)
+def order_by_date(cursor, maxfiles=None, filters=None):
+    results = filters or query.new_query(cursor)
+    return results.order_by('date').limit(maxfiles).run(cursor)
 
 orderings = {}
 orderings['faces'] = order_by_faces
 orderings['cc'] = order_by_cc
 orderings['id'] = order_by_id
+orderings['date'] = order_by_date
+
+
+def build_filters(cursor, args):
+    """Returns a query with the filters from the command line, and a description of them"""
+    filters = query.new_query(cursor)
+    description = []
+    if args.min_faces:
+        filters.min_faces(args.min_faces)
+        description.append("at least %d faces" % args.min_faces)
+    if args.has_gps:
+        filters.has_gps()
+        description.append("GPS data")
+    if args.date_from or args.date_to:
+        filters.date_range(args.date_from, args.date_to)
+        description.append("taken from %s to %s" % (args.date_from or 'the start', args.date_to or 'now'))
+    if args.camera:
+        filters.camera_model(args.camera)
+        description.append("a camera model containing '%s'" % args.camera)
+    if args.text:
+        filters.ocr_contains(args.text)
+        description.append("OCRed text containing '%s'" % args.text)
+    if args.near:
+        lat, lon, radius = args.near
+        filters.within_radius(lat, lon, radius)
+        description.append("GPS data within %g km of (%g, %g)" % (radius, lat, lon))
+    if args.within:
+        filters.within_box(*args.within)
+        description.append("GPS data within (%g, %g) - (%g, %g)" % tuple(args.within))
+    return filters, description
+
+
+def parse_floats(count, value):
+    """Parses a comma-separated list of count numbers"""
+    try:
+        numbers = [float(part) for part in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise argparse.ArgumentTypeError("Expected %d comma-separated numbers, not '%s'" % (count, value))
+    return numbers
 
 ###############################################################################
 # File-related functionality
@@ -107,6 +131,26 @@ HTML_HEADER = """<html>
 
 HTML_FOOTER = """</center></body></html> """
 
+def get_image_source(filename, extract_dir):
+    """Returns the path to use for displaying an image.
+    Images within containers are extracted into extract_dir first.
+    """
+    if not containers.is_contained(filename):
+        return filename
+
+    ext = os.path.splitext(filename)[1]
+    if containers.CONTAINER_SEP in ext:
+        ext = ''
+    extracted = os.path.join(extract_dir, hashlib.md5(filename.encode('utf-8')).hexdigest() + ext)
+    if not os.path.exists(extracted):
+        print_debug("Extracting %s to %s" % (filename, extracted))
+        if not os.path.isdir(extract_dir):
+            os.makedirs(extract_dir)
+        with open(extracted, 'wb') as fh:
+            fh.write(containers.read_entry(filename))
+    return extracted
+
+
 def write_file(fname, header_msg, imagesinfo):
     """This function will write the output to a file
     imagesinfo is a list of dictionaries, where each entry is the information
@@ -114,24 +158,53 @@ def write_file(fname, header_msg, imagesinfo):
     """
 
     #    filename, faces, screenshot, screenshot_fname, cc, cc_fname, jpeg.id, id_fname, contains_skin, skin_type, gps_data, text 
+    extract_dir = os.path.splitext(fname)[0] + '_files'
     with open(fname,'w') as fh:    
         fh.write(HTML_HEADER)
         fh.write(header_msg + '<br/>')
         for entry in imagesinfo:
-            fh.write('<img src="%s"></><br/>\n' % entry['filename'])
-            fh.write("<table>")
-            fh.write("<tr><td>Filename:</td> <td>%s</td><br/>" % entry['filename'])
-            if entry['gps_data']:
-                fh.write("<tr><td>GPS Data:</td> <td>%s</td><br/>" % entry['gps_data'])
-            if entry['model_data']:
-                fh.write("<tr><td>Camera Model:</td> <td>%s</td><br/>" % entry['model_data'])
-            if entry['date_data']:
-                fh.write("<tr><td>Image Date:</td> <td>%s</td><br/>" % entry['date_data'])
-            if entry['ocr_text']:
-                fh.write("<tr><td>OCRed Text:</td> <td>%s</td><br/>" % entry['ocr_text'])
-            fh.write("</table><hr>\n\n")
+            write_image(fh, entry, extract_dir)
         fh.write(HTML_FOOTER)
 
+
+def write_clusters(fname, header_msg, clusters):
+    """Same as write_file, but with the images grouped into clusters (see
+    query.cluster_results)"""
+    extract_dir = os.path.splitext(fname)[0] + '_files'
+    with open(fname,'w') as fh:
+        fh.write(HTML_HEADER)
+        fh.write(header_msg + '<br/>')
+        for i, cluster in enumerate(clusters):
+            fh.write("<h2>Group %d: %d images near (%0.5f, %0.5f), from %s to %s</h2>\n" % (
+                i + 1, len(cluster['results']), cluster['latitude'], cluster['longitude'],
+                format_timestamp(cluster['start']), format_timestamp(cluster['end'])))
+            for entry in cluster['results']:
+                write_image(fh, entry, extract_dir)
+        fh.write(HTML_FOOTER)
+
+
+def write_image(fh, entry, extract_dir):
+    fh.write('<img src="%s"></><br/>\n' % get_image_source(entry['filename'], extract_dir))
+    fh.write("<table>")
+    fh.write("<tr><td>Filename:</td> <td>%s</td><br/>" % entry['filename'])
+    if entry['screenshot']:
+        confidence = entry['screenshot_confidence']
+        fh.write("<tr><td>Screenshot:</td> <td>%s%s</td><br/>" % (entry['screenshot_fname'],
+                 " (confidence %0.2f)" % confidence if confidence is not None else ''))
+    if entry['gps_data']:
+        fh.write("<tr><td>GPS Data:</td> <td>%s</td><br/>" % entry['gps_data'])
+    if entry['model_data']:
+        fh.write("<tr><td>Camera Model:</td> <td>%s</td><br/>" % entry['model_data'])
+    if entry['date_data']:
+        fh.write("<tr><td>Image Date:</td> <td>%s</td><br/>" % entry['date_data'])
+    if entry['ocr_text']:
+        fh.write("<tr><td>OCRed Text:</td> <td>%s</td><br/>" % entry['ocr_text'])
+    fh.write("</table><hr>\n\n")
+
+
+def format_timestamp(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
 ###############################################################################
 # General functionality
 ###############################################################################
@@ -158,9 +231,57 @@ def build_argparser():
                       default=100,
                       help='Specify an upper limit to the amount of files that will be returned. Defaults to the top 100')
 
+    parser.add_argument('--rebuild-views', dest='rebuild_views', action='store_true',
+                      help="Rebuild the report tables if they're out of date. This writes to the database, "
+                           "so avoid it while an ingest is still running")
+
     parser.add_argument('--output', dest='output', action='store',
                       default=DEFAULT_OUTPUT_NAME,
                       help='Override the default destination filename (default is %s)' % DEFAULT_OUTPUT_NAME)
+
+    # Filters
+    parser.add_argument('--min-faces', dest='min_faces', action='store', type=int,
+                      default=None,
+                      help='Only include images with at least this many faces')
+
+    parser.add_argument('--has-gps', dest='has_gps', action='store_true',
+                      help='Only include images with GPS data')
+
+    parser.add_argument('--date-from', dest='date_from', action='store',
+                      default=None,
+                      help='Only include images taken on or after this date (YYYY-MM-DD)')
+
+    parser.add_argument('--date-to', dest='date_to', action='store',
+                      default=None,
+                      help='Only include images taken on or before this date (YYYY-MM-DD)')
+
+    parser.add_argument('--camera', dest='camera', action='store',
+                      default=None,
+                      help='Only include images whose camera model contains this term')
+
+    parser.add_argument('--text', dest='text', action='store',
+                      default=None,
+                      help='Only include images whose OCRed text contains this term')
+
+    parser.add_argument('--near', dest='near', action='store', type=lambda value: parse_floats(3, value),
+                      default=None, metavar='LAT,LON,KM',
+                      help='Only include images taken within KM kilometers of a location')
+
+    parser.add_argument('--within', dest='within', action='store', type=lambda value: parse_floats(4, value),
+                      default=None, metavar='MIN_LAT,MIN_LON,MAX_LAT,MAX_LON',
+                      help='Only include images taken within a bounding box')
+
+    parser.add_argument('--cluster', dest='cluster', action='store_true',
+                      help='Group the images by where and when they were taken. Images without GPS data '
+                           'and a date are left out')
+
+    parser.add_argument('--cluster-km', dest='cluster_km', action='store', type=float,
+                      default=1.0,
+                      help='The furthest apart that images in a group can be (default is 1 km)')
+
+    parser.add_argument('--cluster-hours', dest='cluster_hours', action='store', type=float,
+                      default=3.0,
+                      help='The longest gap between images in a group (default is 3 hours)')
     return parser
 
 
@@ -176,13 +297,36 @@ def main():
     output     = args.output
     
     # Open a connection to the database    
-    cursor = open_db(db_name)
+    cursor = open_db(db_name, args.rebuild_views)
 
+    try:
+        filters, description = build_filters(cursor, args)
+    except ValueError, e:
+        parser.error(str(e))
     order_by = orderings[args.order_by]
-    results = order_by(cursor, maxfiles)
-    header_msg = "The results are ordered by %s" % args.order_by
-
-    write_file(output, header_msg, results)
+    if args.cluster:
+        # Every located image is needed to find the groups
+        results = order_by(cursor, None, filters.has_gps())
+        clusters = query.cluster_results(results, args.cluster_km, args.cluster_hours * 60 * 60)
+        header_msg = "The results are grouped by where and when they were taken"
+    else:
+        results = order_by(cursor, maxfiles, filters)
+        header_msg = "The results are ordered by %s" % args.order_by
+    if description:
+        header_msg += ", and only include images with " + ", ".join(description)
+
+    if args.cluster:
+        # Stop adding groups once there are enough images
+        shown = []
+        count = 0
+        for cluster in clusters:
+            if maxfiles and count >= maxfiles:
+                break
+            shown.append(cluster)
+            count += len(cluster['results'])
+        write_clusters(output, header_msg, shown)
+    else:
+        write_file(output, header_msg, results)
     print "Open %s to see the results" % output
 
 if __name__ == "__main__":
@@ -0,0 +1,395 @@
+"""
+Utility for exporting the results into a typed, columnar format for analysis.
+
+The join of the files and jpeg tables is streamed out in chunks, with each
+chunk written as its own part:
+  npy     - a directory of NumPy .npy files, one for each column
+  parquet - a Parquet file (requires pyarrow)
+
+Booleans, numbers, and timestamps get their own types. The text columns with
+only a few distinct values (such as the matched templates) are
+dictionary-encoded, with the dictionaries shared by every part, while the
+rest (such as the filenames and OCRed text) are plain strings. Running the
+export again only appends the files that were added since the last one.
+
+  columns = export_results.load_columns('prioritize_export')
+  frame = export_results.load_dataframe('prioritize_export')   (requires pandas)
+
+USAGE
+  export_results.py [--db <db>] [--format npy|parquet] <output dir>
+"""
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import argparse
+
+import numpy
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+g_debug = False
+
+
+###############################################################################
+# Generic helpers
+###############################################################################
+
+def print_debug(msg):
+    if g_debug:
+        print "  DEBUG:", msg
+
+###############################################################################
+# Columns
+###############################################################################
+
+# (name, source column, type). 'dict' columns are dictionary-encoded text,
+# stored as int32 codes, and are only for columns with few distinct values,
+# since their dictionaries are held in memory. 'text' columns are plain
+# strings, stored in .npy files as UTF-8 bytes and int64 offsets.
+COLUMNS = [
+    ('file_id', 'files.id', 'int64'),
+    ('filename', 'files.filename', 'text'),
+    ('filesize', 'files.filesize', 'int64'),
+    ('md5', 'files.md5', 'S32'),
+    ('sha512', 'files.sha512', 'S128'),
+    ('well_formed', 'jpeg.well_formed', 'bool'),
+    ('is_solid', 'jpeg.is_solid', 'bool'),
+    ('faces', 'jpeg.faces', 'int32'),
+    ('screenshot', 'jpeg.screenshot', 'bool'),
+    ('screenshot_confidence', 'jpeg.screenshot_confidence', 'float32'),
+    ('screenshot_fname', 'jpeg.screenshot_fname', 'dict'),
+    ('cc', 'jpeg.cc', 'bool'),
+    ('cc_fname', 'jpeg.cc_fname', 'dict'),
+    ('id', 'jpeg.id', 'bool'),
+    ('id_fname', 'jpeg.id_fname', 'dict'),
+    # -1 if skin detection wasn't run
+    ('contains_skin', 'jpeg.contains_skin', 'int8'),
+    ('skin_type', 'jpeg.skin_type', 'dict'),
+    ('gps_data', 'jpeg.gps_data', 'text'),
+    ('date_data', 'jpeg.date_data', 'text'),
+    ('model_data', 'jpeg.model_data', 'text'),
+    ('ocr_text', 'jpeg.ocr_text', 'text'),
+    ('latitude', 'jpeg.latitude', 'float64'),
+    ('longitude', 'jpeg.longitude', 'float64'),
+    ('timestamp', 'jpeg.timestamp', 'datetime64[s]'),
+]
+
+# Bumped whenever the columns or their encoding change
+EXPORT_VERSION = 2
+
+DEFAULT_CHUNK_ROWS = 100000
+
+MANIFEST_FILE = 'manifest.json'
+DICTIONARY_DIR = 'dictionaries'
+PART_FORMAT = 'part-%05d'
+
+# The bytes of a 'text' column, next to its offsets
+TEXT_DATA_SUFFIX = '.data'
+
+SELECT_EXPORT_QUERY = '''SELECT %(columns)s FROM files JOIN jpeg ON jpeg.file_id = files.id
+    WHERE files.id > ? ORDER BY files.id'''
+
+
+def to_bool(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true')
+    return bool(value)
+
+
+def to_text(value):
+    if value is None:
+        return u''
+    if isinstance(value, unicode):
+        return value
+    # The model and OCRed text are stored as BLOBs
+    return str(value).decode('utf-8', 'replace')
+
+
+def is_missing(value):
+    return value is None or value == ''
+
+
+def convert_column(values, col_type, dictionary):
+    """Converts a chunk of one column's values into a numpy array. New text
+    values are added to the dictionary, which maps text to its code."""
+    if col_type == 'bool':
+        return numpy.array([to_bool(value) for value in values], numpy.bool_)
+    if col_type == 'int8':
+        return numpy.array([-1 if is_missing(value) else int(to_bool(value)) for value in values], numpy.int8)
+    if col_type in ('int32', 'int64'):
+        return numpy.array([0 if is_missing(value) else int(value) for value in values], col_type)
+    if col_type in ('float32', 'float64'):
+        return numpy.array([numpy.nan if is_missing(value) else float(value) for value in values], col_type)
+    if col_type.startswith('datetime64'):
+        return numpy.array([numpy.datetime64('NaT') if is_missing(value) else int(value)
+                            for value in values], col_type)
+    if col_type == 'text':
+        return [to_text(value) for value in values]
+    if col_type == 'dict':
+        codes = numpy.empty(len(values), numpy.int32)
+        for i, value in enumerate(values):
+            text = to_text(value)
+            if text not in dictionary:
+                dictionary[text] = len(dictionary)
+            codes[i] = dictionary[text]
+        return codes
+    return numpy.array([str(value or '') for value in values], col_type)
+
+###############################################################################
+# Writing
+###############################################################################
+
+def get_source_columns(cursor):
+    """Returns the source column for each exported column, or NULL for the
+    columns that are missing from older databases"""
+    cursor.execute("PRAGMA table_info(jpeg)")
+    jpeg_columns = [row[1] for row in cursor.fetchall()]
+    sources = []
+    for name, source, col_type in COLUMNS:
+        table, column = source.split('.')
+        sources.append(source if table == 'files' or column in jpeg_columns else 'NULL')
+    return sources
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as fh:
+            return json.load(fh)
+    except IOError:
+        return None
+
+
+def write_json(fname, value):
+    """Writes a JSON file atomically, so an interrupted export leaves the last
+    complete state behind"""
+    with open(fname + '.tmp', 'w') as fh:
+        json.dump(value, fh)
+    os.rename(fname + '.tmp', fname)
+
+
+def load_dictionaries(out_dir):
+    """Returns the text -> code mapping for each dictionary-encoded column"""
+    dictionaries = {}
+    for name, source, col_type in COLUMNS:
+        if col_type != 'dict':
+            continue
+        try:
+            with open(os.path.join(out_dir, DICTIONARY_DIR, name + '.json')) as fh:
+                values = json.load(fh)
+        except IOError:
+            values = []
+        dictionaries[name] = dict((value, code) for code, value in enumerate(values))
+    return dictionaries
+
+
+def save_dictionaries(out_dir, dictionaries):
+    dict_dir = os.path.join(out_dir, DICTIONARY_DIR)
+    if not os.path.isdir(dict_dir):
+        os.makedirs(dict_dir)
+    for name, dictionary in dictionaries.iteritems():
+        values = [None] * len(dictionary)
+        for value, code in dictionary.iteritems():
+            values[code] = value
+        write_json(os.path.join(dict_dir, name + '.json'), values)
+
+
+def encode_text(values):
+    """Returns (offsets, data) for a list of strings, where string i is
+    data[offsets[i]:offsets[i + 1]] in UTF-8"""
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = numpy.zeros(len(encoded) + 1, numpy.int64)
+    numpy.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = ''.join(encoded)
+    # Older versions of numpy can't make an array from an empty buffer
+    return offsets, numpy.frombuffer(data, numpy.uint8) if data else numpy.zeros(0, numpy.uint8)
+
+
+def decode_text(offsets, data):
+    data = data.tostring()
+    return numpy.array([data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                        for i in range(len(offsets) - 1)], object)
+
+
+def write_npy_part(part_path, arrays):
+    if os.path.isdir(part_path):
+        # Left over from an interrupted export
+        shutil.rmtree(part_path)
+    os.makedirs(part_path)
+    for name, source, col_type in COLUMNS:
+        if col_type == 'text':
+            offsets, data = encode_text(arrays[name])
+            numpy.save(os.path.join(part_path, name + '.npy'), offsets)
+            numpy.save(os.path.join(part_path, name + TEXT_DATA_SUFFIX + '.npy'), data)
+        else:
+            numpy.save(os.path.join(part_path, name + '.npy'), arrays[name])
+
+
+def write_parquet_part(part_path, arrays):
+    """Writes a part as Parquet. The text is written as plain strings, and
+    Parquet dictionary-encodes the low-cardinality columns within each part."""
+    columns = [pyarrow.array(arrays[name]) for name, source, col_type in COLUMNS]
+    table = pyarrow.Table.from_arrays(columns, [name for name, source, col_type in COLUMNS])
+    pyarrow.parquet.write_table(table, part_path,
+                                use_dictionary=[name for name, source, col_type in COLUMNS
+                                                if col_type == 'dict'])
+
+
+def export(db_name, out_dir, out_format='npy', chunk_rows=DEFAULT_CHUNK_ROWS, rebuild=False):
+    """Exports the results that aren't already in out_dir. Returns the amount
+    of rows that were added."""
+    if out_format == 'parquet' and pyarrow is None:
+        raise ValueError("Exporting to Parquet requires pyarrow")
+    if rebuild and os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    manifest = read_manifest(out_dir)
+    if manifest is None:
+        manifest = {'version': EXPORT_VERSION, 'format': out_format, 'columns': COLUMNS,
+                    'parts': [], 'rows': 0, 'last_file_id': 0}
+    elif manifest['version'] != EXPORT_VERSION or manifest['format'] != out_format:
+        raise ValueError("%s holds a different export format; use --rebuild to replace it" % out_dir)
+    dictionaries = load_dictionaries(out_dir)
+
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    sources = get_source_columns(cursor)
+    cursor.execute(SELECT_EXPORT_QUERY % {'columns': ', '.join(sources)}, (manifest['last_file_id'],))
+
+    added = 0
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+        arrays = {}
+        for index, (name, source, col_type) in enumerate(COLUMNS):
+            # Parquet builds its own dictionaries for each part
+            if out_format == 'parquet' and col_type == 'dict':
+                col_type = 'text'
+            arrays[name] = convert_column([row[index] for row in rows], col_type, dictionaries.get(name))
+
+        part_name = PART_FORMAT % len(manifest['parts'])
+        if out_format == 'parquet':
+            part_name += '.parquet'
+            write_parquet_part(os.path.join(out_dir, part_name), arrays)
+        else:
+            write_npy_part(os.path.join(out_dir, part_name), arrays)
+        manifest['parts'].append(part_name)
+        manifest['rows'] += len(rows)
+        manifest['last_file_id'] = int(arrays['file_id'][-1])
+        added += len(rows)
+        print_debug("Wrote %d rows to %s" % (len(rows), part_name))
+    conn.close()
+
+    # The parts are only added to the export once the dictionaries that their
+    # codes refer to are saved. An interrupted export leaves the last complete
+    # one behind, and its parts are overwritten by the next one.
+    if out_format == 'npy':
+        save_dictionaries(out_dir, dictionaries)
+    write_json(os.path.join(out_dir, MANIFEST_FILE), manifest)
+    return added
+
+###############################################################################
+# Reading
+###############################################################################
+
+def load_columns(out_dir, decode=False):
+    """Loads an npy export as a dictionary of column name -> numpy array.
+    Dictionary-encoded columns are left as their codes, unless decode is True."""
+    manifest = read_manifest(out_dir)
+    if manifest is None:
+        raise ValueError("%s isn't an export" % out_dir)
+    if manifest['format'] != 'npy':
+        raise ValueError("%s was exported as %s; read it with that format's tools" % (out_dir, manifest['format']))
+    columns = {}
+    for name, source, col_type in COLUMNS:
+        if col_type == 'text':
+            parts = [decode_text(numpy.load(os.path.join(out_dir, part, name + '.npy')),
+                                 numpy.load(os.path.join(out_dir, part, name + TEXT_DATA_SUFFIX + '.npy')))
+                     for part in manifest['parts']]
+            columns[name] = numpy.concatenate(parts) if parts else numpy.zeros(0, object)
+            continue
+        parts = [numpy.load(os.path.join(out_dir, part, name + '.npy')) for part in manifest['parts']]
+        columns[name] = numpy.concatenate(parts) if parts else numpy.zeros(0, col_type if col_type != 'dict' else numpy.int32)
+        if decode and col_type == 'dict':
+            columns[name] = numpy.array(load_dictionary(out_dir, name), object)[columns[name]]
+    return columns
+
+
+def load_dictionary(out_dir, name):
+    """Returns the list of values for a dictionary-encoded column"""
+    with open(os.path.join(out_dir, DICTIONARY_DIR, name + '.json')) as fh:
+        return json.load(fh)
+
+
+def load_dataframe(out_dir):
+    """Loads an npy export as a pandas DataFrame, with the dictionary-encoded
+    columns as categoricals"""
+    import pandas
+    columns = load_columns(out_dir)
+    data = {}
+    for name, source, col_type in COLUMNS:
+        if col_type == 'dict':
+            data[name] = pandas.Categorical.from_codes(columns[name], load_dictionary(out_dir, name))
+        else:
+            data[name] = columns[name]
+    return pandas.DataFrame(data, columns=[name for name, source, col_type in COLUMNS])
+
+###############################################################################
+# General functionality
+###############################################################################
+
+DEFAULT_DB_NAME = "prioritize.sqlite"
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser(description='Exports the results into a typed columnar format')
+
+    parser.add_argument('--debug', dest='debug', action='store_true',
+                      help='Add additional logging data')
+
+    parser.add_argument('--db', dest='db', action='store',
+                      default=DEFAULT_DB_NAME,
+                      help='Override the default source database (default is %s)' % DEFAULT_DB_NAME)
+
+    parser.add_argument('--format', dest='format', action='store',
+                      choices=['npy', 'parquet'], default='npy',
+                      help='Write NumPy .npy column files, or Parquet files (requires pyarrow) (default is npy)')
+
+    parser.add_argument('--chunk-rows', dest='chunk_rows', action='store', type=int,
+                      default=DEFAULT_CHUNK_ROWS,
+                      help='The most rows held in memory, and written to each part (default is %d)' % DEFAULT_CHUNK_ROWS)
+
+    parser.add_argument('--rebuild', dest='rebuild', action='store_true',
+                      help='Replace the whole export, instead of appending the new files. Needed to pick up '
+                           'results that were filled in after being exported, such as deferred optional stages')
+
+    parser.add_argument(dest='output', help='The directory to export into')
+    return parser
+
+
+def main(argv=None):
+    global g_debug
+    parser = build_argparser()
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    g_debug = args.debug
+
+    try:
+        added = export(args.db, args.output, args.format, args.chunk_rows, args.rebuild)
+    except ValueError, e:
+        parser.error(str(e))
+    print "Exported %d new files to %s" % (added, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+'''
+Keypoint detectors and descriptors, along with how their descriptors are
+matched.
+
+  surf  - SURF, with floating point descriptors matched by L2 distance. It's
+          in OpenCV's non-free module, so it's missing from many builds.
+  orb   - ORB, with binary descriptors matched by Hamming distance through an
+          LSH index
+  akaze - AKAZE (OpenCV 3+), with binary descriptors matched the same way
+
+The benchmark runs every available backend over a corpus of known images, and
+reports which is the fastest one that meets a recall target. The corpus has a
+directory of positive examples for each template group (e.g. icon/, cc/, id/),
+and a negative/ directory of images that shouldn't match any group.
+
+USAGE
+  features.py <corpus dir> [<recall target>]
+'''
+
+import os
+import abc
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy
+import cv2
+
+DEFAULT_BACKEND = 'surf'
+
+# A match is only good if it's this much closer than the next best (Lowe's
+# ratio test)
+MATCH_RATIO = 0.75
+
+# FLANN index algorithms
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+
+class BackendUnavailable(Exception):
+    """The backend isn't included in this build of OpenCV"""
+    pass
+
+
+class FeatureBackend(object):
+    """A detector and the matching that goes with its descriptors
+
+    name         - the name used on the command line and in the database
+    norm         - the distance used to compare descriptors
+    dtype        - the type of the descriptors' values
+    index_params - the FLANN index parameters, or None for brute force matching
+    """
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+    norm = cv2.NORM_L2
+    dtype = numpy.float32
+    index_params = None
+    options = {}
+
+    @abc.abstractmethod
+    def create_detector(self):
+        """Returns the keypoint detector and descriptor extractor. Raises
+        BackendUnavailable if this OpenCV doesn't have it."""
+
+    def config(self):
+        """Describes the backend, so that a change to it invalidates the
+        results and the reference model"""
+        return {'detector': self.name, 'options': self.options}
+
+    def create_matcher(self):
+        if self.index_params is None:
+            return cv2.BFMatcher(self.norm)
+        return cv2.FlannBasedMatcher(self.index_params, {'checks': 50})
+
+    def available(self):
+        try:
+            self.create_detector()
+            return True
+        except BackendUnavailable:
+            return False
+
+
+def _create(names, *args):
+    """Returns a detector from the first of the factory names (such as
+    'SURF' or 'xfeatures2d.SURF_create') that this OpenCV provides"""
+    for name in names:
+        factory = cv2
+        try:
+            for part in name.split('.'):
+                factory = getattr(factory, part)
+        except AttributeError:
+            continue
+        try:
+            return factory(*args)
+        except cv2.error:
+            # Listed, but left out of the build (e.g. the non-free algorithms)
+            continue
+    raise BackendUnavailable("%s isn't available in this build of OpenCV" % names[0])
+
+
+class SurfBackend(FeatureBackend):
+    name = 'surf'
+    options = {'threshold': 3200}
+
+    def create_detector(self):
+        return _create(['SURF', 'xfeatures2d.SURF_create'], self.options['threshold'])
+
+
+class OrbBackend(FeatureBackend):
+    name = 'orb'
+    norm = cv2.NORM_HAMMING
+    dtype = numpy.uint8
+    index_params = {'algorithm': FLANN_INDEX_LSH, 'table_number': 6,
+                    'key_size': 12, 'multi_probe_level': 1}
+    options = {'features': 1000}
+
+    def create_detector(self):
+        return _create(['ORB_create', 'ORB'], self.options['features'])
+
+
+class AkazeBackend(FeatureBackend):
+    name = 'akaze'
+    norm = cv2.NORM_HAMMING
+    dtype = numpy.uint8
+    index_params = OrbBackend.index_params
+
+    def create_detector(self):
+        return _create(['AKAZE_create'])
+
+
+def register_backends(*backends):
+    """Returns the backends by name. A backend that's missing its name or any
+    of its methods raises TypeError here, when the module is imported, instead
+    of partway through a run."""
+    registered = {}
+    for backend in backends:
+        if backend.__abstractmethods__:
+            raise TypeError("%s doesn't implement %s" % (backend.__name__,
+                                                         ', '.join(sorted(backend.__abstractmethods__))))
+        if not backend.name:
+            raise TypeError("%s doesn't have a name" % backend.__name__)
+        registered[backend.name] = backend
+    return registered
+
+
+BACKENDS = register_backends(SurfBackend, OrbBackend, AkazeBackend)
+
+
+def get_backend(name=DEFAULT_BACKEND):
+    """Returns the backend with the given name. Raises BackendUnavailable if
+    this OpenCV doesn't have it."""
+    backend = BACKENDS[name]()
+    if not backend.available():
+        raise BackendUnavailable("%s isn't available in this build of OpenCV" % name)
+    return backend
+
+###############################################################################
+# Matching
+###############################################################################
+
+def train_matcher(backend, desc):
+    """Returns a matcher holding an image's descriptors, so that all of the
+    templates can be matched against it without rebuilding its index. Returns
+    None if there are too few descriptors to match."""
+    if desc is None or len(desc) < 2:
+        return None
+    matcher = backend.create_matcher()
+    matcher.add([numpy.asarray(desc, backend.dtype)])
+    matcher.train()
+    return matcher
+
+
+def good_matches(matcher, query_desc, ratio=MATCH_RATIO):
+    """Matches descriptors against a trained matcher. Returns an array that's
+    true for each query descriptor with a good match (using the ratio test)."""
+    good = numpy.zeros(len(query_desc), numpy.bool_)
+    if len(query_desc) == 0:
+        return good
+    for m in matcher.knnMatch(query_desc, k=2):
+        if len(m) == 2 and m[0].distance < m[1].distance * ratio:
+            good[m[0].queryIdx] = True
+    return good
+
+###############################################################################
+# Test Main
+###############################################################################
+
+def classify(model, icon_templates, img, matcher):
+    """Returns the groups that an image is in, decided the same way as when
+    prioritizing: icons through the screenshot detector, and every group with
+    the reference model's thresholds"""
+    import screenshot
+    matched = set()
+    for group in model.groups:
+        if group == 'icon':
+            is_match = screenshot.detect(img, icon_templates,
+                                         lambda: model.within_group(matcher, group))[0]
+        else:
+            is_match = model.within_group(matcher, group)[0]
+        if is_match:
+            matched.add(group)
+    return matched
+
+
+def benchmark(backend, corpus, groups):
+    """Returns (seconds per image, recall, false positive rate) for a backend"""
+    import refmodel
+    import screenshot
+    model_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        model = refmodel.ReferenceModel(model_dir, groups, backend)
+        icon_templates = screenshot.load_templates(groups['icon']) if 'icon' in groups else []
+        detector = backend.create_detector()
+        positives = found = negatives = false_positives = 0
+        elapsed = 0.0
+        for label in sorted(os.listdir(corpus)):
+            label_dir = os.path.join(corpus, label)
+            if not os.path.isdir(label_dir):
+                continue
+            for fname in sorted(os.listdir(label_dir)):
+                img = cv2.imread(os.path.join(label_dir, fname))
+                if img is None:
+                    continue
+                start = time.time()
+                kp, desc = detector.detectAndCompute(img, None)
+                matcher = train_matcher(backend, desc)
+                matched = classify(model, icon_templates, img, matcher)
+                elapsed += time.time() - start
+                if label in groups:
+                    positives += 1
+                    found += label in matched
+                else:
+                    negatives += 1
+                    false_positives += bool(matched)
+        images = positives + negatives
+        return (elapsed / images if images else 0.0,
+                found * 1.0 / positives if positives else 0.0,
+                false_positives * 1.0 / negatives if negatives else 0.0)
+    finally:
+        shutil.rmtree(model_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import refmodel
+    if len(sys.argv) < 2:
+        print "USAGE: features.py <corpus dir> [<recall target>]"
+        sys.exit(1)
+    corpus = sys.argv[1]
+    target = float(sys.argv[2]) if len(sys.argv) > 2 else 0.9
+
+    best = None
+    print "%-8s %12s %8s %8s" % ('backend', 'sec/image', 'recall', 'FP rate')
+    for name in sorted(BACKENDS):
+        backend = BACKENDS[name]()
+        if not backend.available():
+            print "%-8s (not available)" % name
+            continue
+        seconds, recall, fp_rate = benchmark(backend, corpus, refmodel.DEFAULT_GROUPS)
+        print "%-8s %12.4f %8.3f %8.3f" % (name, seconds, recall, fp_rate)
+        if recall >= target and (best is None or seconds < best[1]):
+            best = (name, seconds)
+
+    if best:
+        print "Fastest backend with a recall of at least %0.2f: %s" % (target, best[0])
+    else:
+        print "No backend reached a recall of %0.2f" % target
@@ -1,14 +1,14 @@
 #!/usr/bin/env python
 
 '''
-Uses SURF to match two images.
+Uses SURF (or another feature backend) to match two images.
   Finds common features between two images and draws them
 
 Based on the sample code from opencv:
   samples/python2/find_obj.py
 
 USAGE
-  find_obj.py <image1> <image2>
+  find_obj.py <image1> <image2> [<backend>]
 '''
 
 import sys
@@ -16,15 +16,20 @@ import sys
 import numpy
 import cv2
 
+# local
+import features
+
 
 ###############################################################################
 # Image Matching
 ###############################################################################
 
-def match_images(img1, img2, img1_features=None, img2_features=None):
+def match_images(img1, img2, img1_features=None, img2_features=None, backend=None):
     """Given two images, returns the matches"""
-    detector = cv2.SURF(3200)
-    matcher = cv2.BFMatcher(cv2.NORM_L2)
+    if backend is None:
+        backend = features.get_backend()
+    detector = backend.create_detector()
+    matcher = backend.create_matcher()
 
     if img1_features is None:
         kp1, desc1 = detector.detectAndCompute(img1, None)
@@ -125,7 +130,7 @@ def explore_match(win, img1, img2, kp_pairs, status=None, H=None):
 if __name__ == '__main__':
     if len(sys.argv) < 3:
         print "No filenames specified"
-        print "USAGE: find_obj.py <image1> <image2>"
+        print "USAGE: find_obj.py <image1> <image2> [<backend>]"
         sys.exit(1)
 
     fn1 = sys.argv[1]
@@ -142,7 +147,8 @@ if __name__ == '__main__':
         print 'Failed to load fn2:', fn2
         sys.exit(1)
 
-    kp_pairs = match_images(img1, img2)
+    backend = features.get_backend(sys.argv[3] if len(sys.argv) > 3 else features.DEFAULT_BACKEND)
+    kp_pairs = match_images(img1, img2, backend=backend)
 
     if kp_pairs:
         draw_matches('find_obj', kp_pairs, img1, img2)
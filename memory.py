@@ -0,0 +1,155 @@
+"""
+Keeps the memory used for decoding images bounded, so that a single huge or
+malicious image can't take down the whole run.
+
+Before an image is decoded, its dimensions are read from the header:
+ * Images within the pixel budget are decoded normally.
+ * Larger JPEGs are decoded at a reduced resolution (1/2, 1/4, or 1/8), using
+   the scaling that's built into the JPEG decoder.
+ * Anything else that's too large is skipped, along with every image while
+   the process is above its RSS limit.
+
+The amount of decoded images held at once can also be capped across all of
+the worker processes, with a semaphore that's shared between them.
+"""
+
+import gc
+import StringIO
+import resource
+import contextlib
+
+# PIL
+import PIL.Image
+
+# OpenCV
+import cv2
+
+# Numpy
+import numpy
+
+# 64 megapixels is roughly 200 MB once decoded, and more than any camera
+DEFAULT_MAX_PIXELS = 64 * 1000 * 1000
+
+# The reduced resolutions that the JPEG decoder supports
+JPEG_SCALES = (2, 4, 8)
+
+# Reasons for skipping an image
+SKIP_TOO_LARGE = 'too large'
+SKIP_RSS_LIMIT = 'rss limit'
+
+
+###############################################################################
+# Memory usage
+###############################################################################
+
+def get_rss():
+    """Returns the current resident set size of this process, in bytes"""
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        # Not Linux; the peak is the best that's available. It's in KB on
+        # Linux but bytes on OS X.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_dimensions(data):
+    """Returns (width, height, format) from the image's header, without decoding
+    it. Returns None if the header can't be parsed."""
+    try:
+        img = PIL.Image.open(StringIO.StringIO(data))
+        width, height = img.size
+        return width, height, img.format
+    except Exception:
+        return None
+
+###############################################################################
+# Governor
+###############################################################################
+
+class MemoryGovernor(object):
+    """Decodes images within the memory limits
+
+    max_pixels - the most pixels that a decoded image may have
+    max_rss    - the RSS (in bytes) above which images are skipped, or None
+    slots      - a (multiprocessing) semaphore limiting the decoded images that
+                 are held at once, or None for no limit
+    """
+
+    def __init__(self, max_pixels=DEFAULT_MAX_PIXELS, max_rss=None, slots=None):
+        self.max_pixels = max_pixels
+        self.max_rss = max_rss
+        self.slots = slots
+        # A shared count of the slots this process holds, if set, so that
+        # they can be given back if it's killed (see release_held)
+        self.held = None
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Reserves room for a decoded image for the enclosed block"""
+        if self.slots is None:
+            yield
+            return
+        self.slots.acquire()
+        if self.held is not None:
+            self.held.value += 1
+        try:
+            yield
+        finally:
+            if self.held is not None:
+                self.held.value -= 1
+            self.slots.release()
+
+    def release_held(self, held):
+        """Gives back the slots that a worker process held when it died"""
+        if self.slots is not None:
+            for i in range(held.value):
+                self.slots.release()
+        held.value = 0
+
+    def over_rss(self):
+        if self.max_rss is None:
+            return False
+        if get_rss() <= self.max_rss:
+            return False
+        # Give back anything that's only waiting on the garbage collector
+        gc.collect()
+        return get_rss() > self.max_rss
+
+    def get_scale(self, width, height):
+        """Returns the JPEG scale that fits the image into the budget, or None"""
+        for scale in JPEG_SCALES:
+            if (width // scale) * (height // scale) <= self.max_pixels:
+                return scale
+        return None
+
+    def decode(self, data, dimensions):
+        """Decodes an image within the budget.
+
+        Returns (img, skip_reason). img is None if the image couldn't be
+        decoded, and skip_reason is only set if it was skipped for the budget.
+        """
+        width, height, img_format = dimensions
+        if self.over_rss():
+            return None, SKIP_RSS_LIMIT
+
+        if width * height <= self.max_pixels:
+            buf = numpy.frombuffer(data, numpy.uint8)
+            return cv2.imdecode(buf, cv2.CV_LOAD_IMAGE_COLOR), None
+
+        scale = self.get_scale(width, height)
+        if img_format != 'JPEG' or scale is None:
+            return None, SKIP_TOO_LARGE
+        return self.decode_reduced(data, width // scale, height // scale), None
+
+    def decode_reduced(self, data, width, height):
+        """Decodes a JPEG at a reduced resolution, returning a BGR image"""
+        try:
+            img = PIL.Image.open(StringIO.StringIO(data))
+            img.draft('RGB', (width, height))
+            img = img.convert('RGB')
+            # PIL is RGB, while OpenCV is BGR
+            return numpy.ascontiguousarray(numpy.asarray(img)[:, :, ::-1])
+        except Exception:
+            return None
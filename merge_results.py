@@ -0,0 +1,228 @@
+"""
+Utility for combining the databases written by sharded runs of prioritize.py.
+
+Each node (or local worker process) writes its partition of the files into its
+own shard database. This combines them into a single database, deduplicating
+on sha512 and remapping the file_ids of every table that refers to a file.
+Indexes are dropped while the rows are copied and rebuilt once at the end.
+
+USAGE
+  merge_results.py <output> <shard> [<shard> ...]
+"""
+
+import sys
+import sqlite3
+import argparse
+
+# local
+import query
+
+g_debug = False
+
+
+###############################################################################
+# Generic helpers
+###############################################################################
+
+def print_debug(msg):
+    if g_debug:
+        print "  DEBUG:", msg
+
+###############################################################################
+# Database-related functionality
+###############################################################################
+
+SELECT_SCHEMA_QUERY = '''SELECT type, name, tbl_name, sql FROM %s.sqlite_master
+    WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%%' '''
+
+SELECT_MAX_FILE_ID_QUERY = '''SELECT COALESCE(MAX(id), 0) FROM main.files'''
+
+# Only add the files whose contents aren't already in the merged database.
+# NOT IN would match nothing once a NULL sha512 was merged, so use NOT EXISTS.
+MERGE_FILES_QUERY = '''INSERT INTO main.files (filename, filesize, md5, sha512)
+    SELECT filename, filesize, md5, sha512 FROM shard.files
+    WHERE sha512 IS NOT NULL AND NOT EXISTS
+        (SELECT 1 FROM main.files AS merged WHERE merged.sha512 = shard.files.sha512)
+    ORDER BY id'''
+
+# Copies rows from a per-file table, remapping the file_id through the sha512.
+# Rows for files that were already merged from an earlier shard are dropped.
+MERGE_PER_FILE_QUERY = '''INSERT INTO main.%(table)s (%(columns)s)
+    SELECT %(select_columns)s FROM shard.%(table)s AS src
+        JOIN shard.files AS shard_files ON shard_files.id = src.file_id
+        JOIN main.files AS merged_files ON merged_files.sha512 = shard_files.sha512
+    WHERE merged_files.id > ?'''
+
+
+# How each shard was produced (see prioritize.py)
+SETTINGS_TABLE = 'settings'
+
+MERGE_SETTINGS_QUERY = '''INSERT OR IGNORE INTO main.settings (name, value)
+    SELECT name, value FROM shard.settings'''
+
+SELECT_CONFLICTING_SETTINGS_QUERY = '''SELECT shard_settings.name, merged.value, shard_settings.value
+    FROM shard.settings AS shard_settings
+        JOIN main.settings AS merged ON merged.name = shard_settings.name
+    WHERE merged.value != shard_settings.value'''
+
+
+# Every shard's stage timings are kept
+STAGE_TIMINGS_TABLE = 'stage_timings'
+
+MERGE_STAGE_TIMINGS_QUERY = '''INSERT INTO main.stage_timings SELECT * FROM shard.stage_timings'''
+
+
+# Files that couldn't be read have no file_id, so they're merged by filename
+FAILURES_TABLE = 'failures'
+
+MERGE_READ_FAILURES_QUERY = '''INSERT INTO main.failures (file_id, stage, error, filename)
+    SELECT NULL, stage, error, filename FROM shard.failures AS src
+    WHERE src.file_id IS NULL AND src.filename IS NOT NULL AND NOT EXISTS
+        (SELECT 1 FROM main.failures AS merged
+         WHERE merged.file_id IS NULL AND merged.filename = src.filename)'''
+
+
+def get_schema(cursor, db='main'):
+    """Returns a list of (type, name, tbl_name, sql) for everything in the db"""
+    cursor.execute(SELECT_SCHEMA_QUERY % db)
+    return cursor.fetchall()
+
+
+def get_columns(cursor, table, db='main'):
+    cursor.execute("PRAGMA %s.table_info(%s)" % (db, table))
+    return [row[1] for row in cursor.fetchall()]
+
+
+def get_per_file_tables(cursor, db='main'):
+    """Returns the names of the regular tables that refer to the files table.
+    The report tables are left out, since they're rebuilt after merging."""
+    tables = []
+    for entry_type, name, tbl_name, sql in get_schema(cursor, db):
+        if entry_type != 'table' or sql.upper().startswith('CREATE VIRTUAL'):
+            continue
+        if name.startswith(query.REPORT_PREFIX):
+            continue
+        if 'file_id' in get_columns(cursor, name, db):
+            tables.append(name)
+    return tables
+
+
+def create_output_schema(cursor, shard_name):
+    """Creates any of the shard's tables that are missing from the output"""
+    cursor.execute("ATTACH DATABASE ? AS shard", (shard_name,))
+    existing = set(row[1] for row in get_schema(cursor))
+    tables = ['files', SETTINGS_TABLE, STAGE_TIMINGS_TABLE] + get_per_file_tables(cursor, 'shard')
+    # Create the tables before their indexes
+    for entry_type in ('table', 'index'):
+        for shard_type, name, tbl_name, sql in get_schema(cursor, 'shard'):
+            if shard_type == entry_type and tbl_name in tables and name not in existing:
+                cursor.execute(sql)
+    cursor.execute("DETACH DATABASE shard")
+
+
+def drop_indexes(cursor):
+    """Drops all of the explicit indexes, returning the SQL to recreate them"""
+    indexes = []
+    for entry_type, name, tbl_name, sql in get_schema(cursor):
+        if entry_type == 'index' and not tbl_name.startswith(query.REPORT_PREFIX):
+            indexes.append(sql)
+            cursor.execute("DROP INDEX %s" % name)
+    return indexes
+
+
+def merge_shard(cursor, shard_name):
+    """Merges a single shard into the main database. Returns the amount of new files"""
+    cursor.execute("ATTACH DATABASE ? AS shard", (shard_name,))
+    cursor.execute("BEGIN")
+
+    cursor.execute(SELECT_MAX_FILE_ID_QUERY)
+    watermark = cursor.fetchone()[0]
+    cursor.execute(MERGE_FILES_QUERY)
+    added = cursor.rowcount
+
+    for table in get_per_file_tables(cursor, 'shard'):
+        shard_columns = get_columns(cursor, table, 'shard')
+        columns = [col for col in get_columns(cursor, table) if col in shard_columns]
+        select_columns = ['merged_files.id' if col == 'file_id' else 'src.' + col for col in columns]
+        query = MERGE_PER_FILE_QUERY % {'table': table,
+                                        'columns': ', '.join(columns),
+                                        'select_columns': ', '.join(select_columns)}
+        cursor.execute(query, (watermark,))
+        print_debug("Copied %d rows into %s" % (cursor.rowcount, table))
+
+    shard_tables = [row[1] for row in get_schema(cursor, 'shard')]
+    if SETTINGS_TABLE in shard_tables:
+        merge_settings(cursor, shard_name)
+    if STAGE_TIMINGS_TABLE in shard_tables:
+        cursor.execute(MERGE_STAGE_TIMINGS_QUERY)
+    if FAILURES_TABLE in shard_tables and 'filename' in get_columns(cursor, FAILURES_TABLE, 'shard'):
+        cursor.execute(MERGE_READ_FAILURES_QUERY)
+
+    cursor.execute("COMMIT")
+    cursor.execute("DETACH DATABASE shard")
+    return added
+
+
+def merge_settings(cursor, shard_name):
+    """Copies the shard's settings, warning about any that differ from the
+    shards that were merged before it"""
+    cursor.execute(SELECT_CONFLICTING_SETTINGS_QUERY)
+    for name, merged_value, shard_value in cursor.fetchall():
+        print "Warning: %s has %s=%s, but earlier shards have %s" % (shard_name, name, shard_value, merged_value)
+    cursor.execute(MERGE_SETTINGS_QUERY)
+
+
+def merge_databases(output, shard_names):
+    """Merges all of the shard databases into output"""
+    conn = sqlite3.connect(output)
+    # Detaching isn't allowed inside of a transaction, so manage them manually
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA synchronous = OFF")
+
+    for shard_name in shard_names:
+        create_output_schema(cursor, shard_name)
+
+    indexes = drop_indexes(cursor)
+    for shard_name in shard_names:
+        added = merge_shard(cursor, shard_name)
+        print "Merged %d new files from %s" % (added, shard_name)
+
+    print_debug("Rebuilding %d indexes" % len(indexes))
+    cursor.execute("BEGIN")
+    for sql in indexes:
+        cursor.execute(sql)
+    query.build_views(cursor)
+    cursor.execute("COMMIT")
+    conn.close()
+
+###############################################################################
+# General functionality
+###############################################################################
+
+def build_argparser():
+    parser = argparse.ArgumentParser(description='Merges the databases written by sharded runs')
+
+    parser.add_argument('--debug', dest='debug', action='store_true',
+                      help='Add additional logging data')
+
+    parser.add_argument(dest='output', help='The database to merge the shards into')
+
+    parser.add_argument(dest='shards', nargs='+', help='The shard databases to merge')
+    return parser
+
+
+def main(argv=None):
+    global g_debug
+    # First the initial argument parsing
+    parser = build_argparser()
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    g_debug = args.debug
+
+    merge_databases(args.output, args.shards)
+
+if __name__ == "__main__":
+    main()
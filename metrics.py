@@ -0,0 +1,319 @@
+"""
+Keeps track of the progress and throughput of a long-running ingest.
+
+Collects rolling counters and rates (files/s, bytes/s, the duplicate ratio),
+the latency of each stage, queue depths, and worker utilization. They're
+reported through a throttled status line, and can optionally be served over
+HTTP for monitoring:
+  /metrics  - Prometheus text exposition format
+  /status   - JSON
+"""
+
+import json
+import time
+import threading
+import contextlib
+import collections
+import BaseHTTPServer
+
+# How far back the rolling rates look, in seconds
+RATE_WINDOW = 60
+
+# Prefix for the Prometheus metric names
+METRIC_PREFIX = 'prioritize'
+
+# The results that a finished file is counted under
+FILE_RESULTS = ('valid', 'invalid', 'duplicate', 'failed', 'quarantined')
+
+
+###############################################################################
+# Metrics collection
+###############################################################################
+
+class StageStats(object):
+    """Latency statistics for a single stage"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.recent = collections.deque(maxlen=100)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        self.recent.append(seconds)
+
+    def as_dict(self):
+        recent = list(self.recent)
+        return {'count': self.count,
+                'total_seconds': self.total,
+                'max_seconds': self.maximum,
+                'mean_seconds': self.total / self.count if self.count else 0.0,
+                'recent_mean_seconds': sum(recent) / len(recent) if recent else 0.0}
+
+
+class Metrics(object):
+    """Thread-safe counters, rates, and stage timings for a run"""
+
+    def __init__(self, total_files=0):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.total_files = total_files
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.stages = collections.defaultdict(StageStats)
+        # (timestamp, files, bytes) samples, for the rolling rates
+        self.samples = collections.deque()
+        # worker name -> seconds spent busy
+        self.busy = collections.defaultdict(float)
+        self.last_status = 0
+        # Called with the name of each stage as it starts, if set
+        self.on_stage = None
+
+    def count_file(self, size, result):
+        """Records a finished file. result is one of FILE_RESULTS"""
+        now = time.time()
+        with self.lock:
+            self.counters['files'] += 1
+            self.counters['bytes'] += size
+            self.counters[result] += 1
+            self.samples.append((now, 1, size))
+            while self.samples and self.samples[0][0] < now - RATE_WINDOW:
+                self.samples.popleft()
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def set_gauge(self, name, value):
+        """Sets a point-in-time value, such as the depth of a queue"""
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_stage_time(self, name, seconds):
+        with self.lock:
+            self.stages[name].add(seconds)
+
+    def add_recorded(self, stages, counters):
+        """Adds what a StageRecorder recorded in another process"""
+        for name, seconds in stages:
+            self.add_stage_time(name, seconds)
+        for name, amount in counters.iteritems():
+            self.increment(name, amount)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the enclosed block as a stage"""
+        if self.on_stage is not None:
+            self.on_stage(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.time() - start)
+
+    @contextlib.contextmanager
+    def working(self, worker='main'):
+        """Marks the worker as busy for the enclosed block, for the utilization"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.busy[worker] += time.time() - start
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def rates(self):
+        """Returns the (files/s, bytes/s) over the rolling window"""
+        now = time.time()
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            return 0.0, 0.0
+        window = min(RATE_WINDOW, now - self.start_time)
+        if window <= 0:
+            return 0.0, 0.0
+        files = sum(sample[1] for sample in samples)
+        size = sum(sample[2] for sample in samples)
+        return files / window, size / window
+
+    def eta(self):
+        """Returns the estimated seconds remaining, or None if unknown"""
+        files_rate = self.rates()[0]
+        remaining = self.total_files - self.counters['files']
+        if files_rate <= 0 or remaining <= 0:
+            return None
+        return remaining / files_rate
+
+    def snapshot(self):
+        """Returns all of the metrics as a dictionary"""
+        files_rate, bytes_rate = self.rates()
+        elapsed = self.elapsed()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            stages = dict((name, stats.as_dict()) for name, stats in self.stages.iteritems())
+            utilization = dict((worker, busy / elapsed if elapsed else 0.0)
+                               for worker, busy in self.busy.iteritems())
+        files = counters.get('files', 0)
+        return {'elapsed_seconds': elapsed,
+                'total_files': self.total_files,
+                'counters': counters,
+                'gauges': gauges,
+                'files_per_second': files_rate,
+                'bytes_per_second': bytes_rate,
+                'duplicate_ratio': counters.get('duplicate', 0) * 1.0 / files if files else 0.0,
+                'eta_seconds': self.eta(),
+                'stages': stages,
+                'worker_utilization': utilization}
+
+    ###########################################################################
+    # Reporting
+    ###########################################################################
+
+    def status_line(self):
+        snapshot = self.snapshot()
+        files = snapshot['counters'].get('files', 0)
+        line = "[%s] %d" % (format_duration(snapshot['elapsed_seconds']), files)
+        # The total isn't known while watching for new files
+        if self.total_files:
+            line += "/%d files (%0.1f%%)" % (self.total_files, files * 100.0 / self.total_files)
+        else:
+            line += " files"
+        line += " | %0.1f files/s | %0.2f MB/s | %0.1f%% duplicates" % (
+            snapshot['files_per_second'], snapshot['bytes_per_second'] / (1024 * 1024),
+            snapshot['duplicate_ratio'] * 100)
+        if snapshot['eta_seconds'] is not None:
+            line += " | ETA %s" % format_duration(snapshot['eta_seconds'])
+        return line
+
+    def maybe_print_status(self, interval):
+        """Prints the status line, at most once every interval seconds"""
+        now = time.time()
+        if now - self.last_status >= interval:
+            self.last_status = now
+            print self.status_line()
+
+    def prometheus_text(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        stages = sorted(snapshot['stages'].items())
+        lines = []
+        described = set()
+
+        def add(name, value, help_text, metric_type='gauge', labels=None):
+            full_name = '%s_%s' % (METRIC_PREFIX, name)
+            if full_name not in described:
+                described.add(full_name)
+                lines.append('# HELP %s %s' % (full_name, help_text))
+                lines.append('# TYPE %s %s' % (full_name, metric_type))
+            if labels:
+                label_text = ','.join('%s="%s"' % item for item in sorted(labels.items()))
+                full_name = '%s{%s}' % (full_name, label_text)
+            lines.append('%s %r' % (full_name, float(value)))
+
+        add('elapsed_seconds', snapshot['elapsed_seconds'], 'Seconds since the run started')
+        add('files', snapshot['total_files'], 'Files to be examined in this run')
+        add('files_processed_total', counters.get('files', 0), 'Files examined', 'counter')
+        add('bytes_processed_total', counters.get('bytes', 0), 'Bytes examined', 'counter')
+        for result in FILE_RESULTS:
+            add('files_result_total', counters.get(result, 0), 'Files examined, by result',
+                'counter', {'result': result})
+        add('files_per_second', snapshot['files_per_second'],
+            'Files examined per second over the last %d seconds' % RATE_WINDOW)
+        add('bytes_per_second', snapshot['bytes_per_second'],
+            'Bytes examined per second over the last %d seconds' % RATE_WINDOW)
+        add('duplicate_ratio', snapshot['duplicate_ratio'], 'Fraction of the files that were duplicates')
+        for name, value in sorted(snapshot['gauges'].items()):
+            add('queue_depth', value, 'Items waiting in each queue', labels={'queue': name})
+        for name, stats in stages:
+            add('stage_seconds_total', stats['total_seconds'], 'Seconds spent in each stage',
+                'counter', {'stage': name})
+        for name, stats in stages:
+            add('stage_calls_total', stats['count'], 'Calls to each stage', 'counter', {'stage': name})
+        for name, stats in stages:
+            add('stage_recent_mean_seconds', stats['recent_mean_seconds'],
+                'Mean latency of the recent calls to each stage', labels={'stage': name})
+        for worker, value in sorted(snapshot['worker_utilization'].items()):
+            add('worker_utilization', value, 'Fraction of the time each worker was busy',
+                labels={'worker': worker})
+        return '\n'.join(lines) + '\n'
+
+
+class StageRecorder(object):
+    """Stands in for Metrics in a worker process (see sandbox.py), recording
+    the stage timings and counters of each call so that the parent can add
+    them to its own (see Metrics.add_recorded)"""
+
+    def __init__(self, on_stage=None):
+        self.on_stage = on_stage
+        self.stages = []
+        self.counters = collections.defaultdict(int)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.on_stage is not None:
+            self.on_stage(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.time() - start))
+
+    def increment(self, name, amount=1):
+        self.counters[name] += amount
+
+    def take(self):
+        """Returns the (stages, counters) since the last call, and resets them"""
+        recorded = self.stages, dict(self.counters)
+        self.stages = []
+        self.counters = collections.defaultdict(int)
+        return recorded
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+###############################################################################
+# HTTP endpoint
+###############################################################################
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the metrics of the server's Metrics instance"""
+
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path.startswith('/metrics'):
+            body = metrics.prometheus_text()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path.startswith('/status') or self.path == '/':
+            body = json.dumps(metrics.snapshot(), indent=2, sort_keys=True)
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the requests out of the run's output
+        pass
+
+
+def start_server(metrics, port, host='127.0.0.1'):
+    """Serves the metrics over HTTP from a background thread. Returns the server"""
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -6,6 +6,7 @@ Based on http://code.google.com/p/python-tesseract/wiki/CodeSnippets
 """
 
 import sys
+import cv2
 from cv2 import cv
 import tesseract
 
@@ -22,6 +23,15 @@ def ocr_text(fname):
     return text
 
 
+def ocr_image(img):
+    """Same as ocr_text, but for an image that's already decoded (a BGR image,
+    as from cv2), so that it's only decoded once and within the memory budget"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    tesseract.SetCvImage(cv.GetImage(cv.fromarray(gray)), api)
+    text = api.GetUTF8Text()
+    return text
+
+
 def main():
     if len(sys.argv) < 3:
         print "No image file specified"
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+'''
+Reads files ahead of when they're needed, so that the hashing and detectors
+aren't left waiting on high-latency storage (such as an NFS or SMB share).
+
+A pool of reader threads keeps several reads in flight, and hands the
+contents over as each file's turn comes up. The reads in flight are bounded
+by both the amount of files and the amount of bytes, so that a run of large
+files can't use up the memory.
+
+USAGE
+  prefetch.py <path> [<latency in ms>] [<readers>]
+    (Compares sequential and prefetched reads, with latency added to each)
+'''
+
+import os
+import sys
+import time
+import Queue
+import hashlib
+import threading
+
+# local
+import containers
+
+DEFAULT_READERS = 4
+
+# The most data held in buffers that haven't been handed over yet
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class _Read(object):
+    """A read that was handed to the reader threads"""
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.data = self.entry.read()
+        except Exception:
+            self.error = sys.exc_info()
+        self.done.set()
+
+
+class Prefetcher(object):
+    """Reads entries (see containers.Entry) in the background
+
+    readers   - the amount of reader threads, which is also the most files that
+                are read ahead
+    max_bytes - the most bytes held by reads that haven't been handed over
+    """
+
+    def __init__(self, readers=DEFAULT_READERS, max_bytes=DEFAULT_MAX_BYTES):
+        self.readers = readers
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # entry -> _Read, for the reads that haven't been handed over
+        self.in_flight = {}
+        self.bytes_in_flight = 0
+        self.hits = 0
+        self.misses = 0
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(readers):
+            thread = threading.Thread(target=self._reader, name='prefetch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _reader(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def prefetch(self, entries):
+        """Starts reading the upcoming entries, in order, until the limits are
+        reached. Entries that are already being read are left alone."""
+        with self.lock:
+            for entry in entries:
+                if entry in self.in_flight:
+                    continue
+                if len(self.in_flight) >= self.readers:
+                    break
+                # Stop rather than skip ahead, so the reads stay in order
+                if self.bytes_in_flight + entry.size > self.max_bytes:
+                    break
+                job = _Read(entry)
+                self.in_flight[entry] = job
+                self.bytes_in_flight += entry.size
+                self.queue.put(job)
+
+    def read(self, entry):
+        """Returns the contents of an entry, waiting for it if it's being read
+        ahead, or reading it directly if it isn't"""
+        with self.lock:
+            job = self.in_flight.get(entry)
+        if job is None:
+            self.misses += 1
+            return entry.read()
+        self.hits += 1
+        job.done.wait()
+        with self.lock:
+            del self.in_flight[entry]
+            self.bytes_in_flight -= entry.size
+        if job.error:
+            raise job.error[0], job.error[1], job.error[2]
+        return job.data
+
+    def pending(self):
+        """Returns the amount of reads that haven't been handed over"""
+        with self.lock:
+            return len(self.in_flight)
+
+    def close(self):
+        """Stops the reader threads once the queued reads are done"""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+###############################################################################
+# Test Main
+###############################################################################
+
+class SlowEntry(object):
+    """Wraps an entry, adding a fixed latency to every read. Stands in for
+    files on slow network storage."""
+
+    def __init__(self, entry, latency):
+        self.entry = entry
+        self.name = entry.name
+        self.size = entry.size
+        self.latency = latency
+
+    def read(self, size=None):
+        time.sleep(self.latency)
+        return self.entry.read(size)
+
+
+def consume(entries, prefetcher=None, lookahead=0):
+    """Reads and hashes every entry, like prioritize.py does. Returns the time taken"""
+    start = time.time()
+    for i, entry in enumerate(entries):
+        if prefetcher is not None:
+            prefetcher.prefetch(entries[i + 1:i + 1 + lookahead])
+            data = prefetcher.read(entry)
+        else:
+            data = entry.read()
+        hashlib.md5(data).hexdigest()
+        hashlib.sha512(data).hexdigest()
+    return time.time() - start
+
+
+def list_entries(path):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in sorted(filenames):
+            entries.extend(containers.get_entries(os.path.join(dirpath, fname)))
+    return entries
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_READERS
+    entries = [SlowEntry(entry, latency) for entry in list_entries(path)]
+    print "%d files, with %0.0f ms of latency per read" % (len(entries), latency * 1000)
+
+    sequential = consume(entries)
+    print "Sequential: %0.3f seconds" % sequential
+
+    prefetcher = Prefetcher(readers)
+    prefetched = consume(entries, prefetcher, readers)
+    prefetcher.close()
+    print "Prefetched (%d readers): %0.3f seconds (%0.1fx)" % (readers, prefetched,
+                                                            sequential / prefetched if prefetched else 0)
@@ -24,10 +24,17 @@ Well-formed / number of faces / possible screenshot (contains a known icon) / no
 import os
 import sys
 import time
+import Queue
+import signal
 import hashlib
 import os.path
+import calendar
+import datetime
+import StringIO
 import sqlite3
 import argparse
+import collections
+import multiprocessing
 
 
 # PIL
@@ -42,8 +49,22 @@ import cv2.cv as cv
 import numpy
 
 # local
-import find_obj
-from ocr_text import ocr_text
+import cache
+import features
+import containers
+import memory
+import metrics
+import prefetch
+import refmodel
+import sandbox
+import screenshot
+import query
+import scheduler
+import watch
+import merge_results
+import export_results
+import compare_results
+from ocr_text import ocr_image
 from detect_skin import detect_skin
 
 ###############################################################################
@@ -51,41 +72,99 @@ from detect_skin import detect_skin
 ###############################################################################
 
 
-def get_file_list(root, maxfiles=None):
-    """Returns a list of up to maxfiles fully-qualified filenames"""
+def get_file_list(root, maxfiles=None, shard=None, expand_containers=True):
+    """Returns a list of up to maxfiles entries (see containers.Entry)
     
-    if os.path.isfile(root) and (maxfiles is None or maxfiles > 0):
-      return [root]
+    Tar, zip, and raw carve containers are expanded into their members, unless
+    expand_containers is False. If shard is an (index, count) tuple, only the
+    entries that belong to that partition of the listing are returned.
+    
+    maxfiles limits the whole listing, before it's partitioned, so that all of
+    the shards together examine at most maxfiles entries.
+    """
+    
+    if os.path.isfile(root):
+      fnames = [os.path.abspath(root)]
+    else:
+      fnames = walk_files(root)
 
     all_files = []
+    listed = 0
 
-    # First get the full listing
-    for dirpath, dirnames, filenames in os.walk(root):
-        if maxfiles is not None and len(all_files) >= maxfiles:
-            break
-        for fname in filenames:
-            if maxfiles is not None and len(all_files) >= maxfiles:
-                break
-            all_files.append(os.path.abspath(os.path.join(dirpath, fname)))
+    for fname in fnames:
+        for entry in list_entries(fname, expand_containers):
+            if maxfiles is not None and listed >= maxfiles:
+                return all_files
+            listed += 1
+            if shard is not None and not in_shard(root, entry.name, shard):
+                continue
+            all_files.append(entry)
 
     return all_files
 
 
-def get_hashes(fname):
-    """Returns the MD5 and SHA-512 hashes for a file"""
-    with open(fname, 'rb') as fh:
-        data = fh.read()
-        md5 = hashlib.md5(data).hexdigest()
-        sha512 = hashlib.sha512(data).hexdigest()
-        return md5, sha512
+def list_entries(fname, expand_containers=True):
+    """Returns the entries for a single file on disk. A container that can't
+    be listed (such as a truncated archive) is examined as a file instead."""
+    entries = []
+    try:
+        for entry in containers.get_entries(fname, expand_containers):
+            entries.append(entry)
+    except Exception, e:
+        if not os.path.isfile(fname):
+            print "%s was removed before it could be examined" % fname
+            return entries
+        print "Couldn't list the files in %s (%s), so it's examined as a file" % (fname, e)
+        entries.append(containers.file_entry(fname))
+    return entries
+
+
+def walk_files(root):
+    """Yields the fully-qualified filename of every file under root"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Sort the listing so that every node walks the tree in the same order
+        dirnames.sort()
+        for fname in sorted(filenames):
+            yield os.path.abspath(os.path.join(dirpath, fname))
+
+
+def in_shard(root, fname, shard):
+    """Returns whether or not fname belongs to the (index, count) shard
+    
+    The partition is based on the path relative to root, so that nodes which
+    mount the evidence at different locations still agree on the split.
+    """
+    index, count = shard
+    relpath = os.path.relpath(fname, root).replace(os.sep, '/')
+    digest = hashlib.md5(relpath).hexdigest()
+    return int(digest, 16) % count == index
+
+
+def get_hashes(data):
+    """Returns the MD5 and SHA-512 hashes for a file's contents"""
+    md5 = hashlib.md5(data).hexdigest()
+    sha512 = hashlib.sha512(data).hexdigest()
+    return md5, sha512
+
+
+CASCADE_FILES = ['./haarcascades/haarcascade_frontalface_alt.xml', 
+                 './haarcascades/haarcascade_frontalface_alt2.xml']
+
+# detectMultiScale parameters for the face cascades
+FACE_SCALE_FACTOR = 1.3
+FACE_MIN_NEIGHBORS = 4
+FACE_MIN_SIZE = (30, 30)
+
+# Bump whenever the detection code changes in a way that changes results (and
+# isn't covered by a tunable in get_cache_version), so that cached results
+# aren't reused
+DETECTOR_VERSION = 1
 
 
 def load_cascades():
-    fnames = ['./haarcascades/haarcascade_frontalface_alt.xml', 
-            './haarcascades/haarcascade_frontalface_alt2.xml']
     cascades= []
 
-    for cascade_fn in fnames:
+    for cascade_fn in CASCADE_FILES:
         if os.path.exists(cascade_fn) and os.path.isfile(cascade_fn):
             cascade = cv2.CascadeClassifier(cascade_fn)
             cascades.append(cascade)
@@ -107,6 +186,15 @@ def print_debug(msg):
 # Database filename
 DEFAULT_DB_NAME = "prioritize.sqlite"
 
+# The longest that results go uncommitted, in seconds
+COMMIT_INTERVAL = 5
+
+# How often the report tables are updated while watching, in seconds
+REPORT_INTERVAL = 30
+
+# Suffix for the databases written by each local shard
+SHARD_DB_FORMAT = "%s.shard%d"
+
 # Create table statements
 CREATE_FILES_TABLE_QUERY = '''CREATE TABLE IF NOT EXISTS files (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -135,25 +223,147 @@ CREATE_JPEG_TABLE_QUERY = '''
         gps_data          TEXT,
         date_data         TEXT,
         model_data        TEXT,
-        ocr_text          TEXT
+        ocr_text          TEXT,
+        latitude          REAL,
+        longitude         REAL,
+        timestamp         INTEGER,
+        screenshot_confidence REAL
+    )'''
+
+# Columns that were added to the jpeg table after it was first released
+JPEG_ADDED_COLUMNS = [('latitude', 'REAL'), ('longitude', 'REAL'), ('timestamp', 'INTEGER'),
+                      ('screenshot_confidence', 'REAL')]
+
+ADD_JPEG_COLUMN_QUERY = '''ALTER TABLE jpeg ADD COLUMN %s %s'''
+
+# Images that weren't examined because of the memory budget
+CREATE_SKIPPED_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS skipped_files (
+        file_id           INTEGER,
+        reason            TEXT,
+        width             INTEGER,
+        height            INTEGER
+    )'''
+
+# How the database was produced, such as the feature backend
+CREATE_SETTINGS_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS settings (
+        name              TEXT PRIMARY KEY,
+        value             TEXT
+    )'''
+
+# How long each stage took, for every run into the database
+CREATE_STAGE_TIMINGS_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS stage_timings (
+        started           INTEGER,
+        worker            TEXT,
+        stage             TEXT,
+        calls             INTEGER,
+        total_seconds     REAL,
+        max_seconds       REAL
+    )'''
+
+# Files that couldn't be examined, such as ones that crashed or hung the
+# detectors. They're skipped when the run is resumed. Files that couldn't be
+# read have no hash, so they have no file_id and are only kept by filename.
+CREATE_FAILURES_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS failures (
+        file_id           INTEGER,
+        stage             TEXT,
+        error             TEXT,
+        filename          TEXT
     )'''
 
+# Columns that were added to the failures table after it was first released
+FAILURES_ADDED_COLUMNS = [('filename', 'TEXT')]
+
+CREATE_JPEG_INDEX_QUERY = '''CREATE INDEX IF NOT EXISTS jpeg_file_id ON jpeg (file_id)'''
+
+CREATE_FAILURES_INDEX_QUERY = '''CREATE INDEX IF NOT EXISTS failures_file_id ON failures (file_id)'''
+
+CREATE_FAILURES_FILENAME_INDEX_QUERY = '''CREATE INDEX IF NOT EXISTS failures_filename ON failures (filename)'''
+
 # Insert statements
 
 INSERT_FILE_QUERY = '''INSERT INTO files (filename,filesize,md5,sha512) VALUES (?, ?, ?, ?)'''
 
 INSERT_JPEG_QUERY = '''INSERT INTO jpeg
   (file_id, well_formed, is_solid, faces, screenshot, screenshot_fname, cc, cc_fname, 
-    id, id_fname, contains_skin, skin_type, gps_data, date_data, model_data, ocr_text)
-  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    id, id_fname, contains_skin, skin_type, gps_data, date_data, model_data, ocr_text,
+    latitude, longitude, timestamp, screenshot_confidence)
+  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+INSERT_SKIPPED_QUERY = '''INSERT INTO skipped_files (file_id, reason, width, height) VALUES (?, ?, ?, ?)'''
+
+INSERT_FAILURE_QUERY = '''INSERT INTO failures (file_id, stage, error, filename) VALUES (?, ?, ?, ?)'''
+
+# Each path only keeps its latest read failure
+DELETE_READ_FAILURE_QUERY = '''DELETE FROM failures WHERE file_id IS NULL AND filename=?'''
+
+DELETE_READ_FAILURES_QUERY = '''DELETE FROM failures WHERE file_id IS NULL'''
+
+INSERT_SETTING_QUERY = '''INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)'''
+
+INSERT_STAGE_TIMING_QUERY = '''INSERT INTO stage_timings
+  (started, worker, stage, calls, total_seconds, max_seconds) VALUES (?, ?, ?, ?, ?, ?)'''
+
+UPDATE_JPEG_OPTIONAL_QUERY = '''UPDATE jpeg SET contains_skin=?, skin_type=?, ocr_text=?
+  WHERE file_id=?'''
 
 # SELECT
-SELECT_SHA512_QUERY = '''SELECT sha512 FROM files WHERE sha512=? LIMIT 1'''
+SELECT_SETTING_QUERY = '''SELECT value FROM settings WHERE name=?'''
+
+SELECT_SHA512_QUERY = '''SELECT sha512 FROM %s.files WHERE sha512=? LIMIT 1'''
+
+SELECT_QUARANTINED_QUERY = '''SELECT files.id FROM %(db)s.files AS files
+  JOIN %(db)s.failures AS failures ON failures.file_id = files.id
+  WHERE files.sha512=? LIMIT 1'''
+
+# The name that the main database is attached under by local shards
+PRIOR_DB = 'prior'
+
+SELECT_FAILED_FILES_QUERY = '''SELECT DISTINCT file_id FROM failures WHERE file_id IS NOT NULL'''
+
+# Only the images that were fully examined have optional stages to run
+SELECT_JPEG_GROUPS_QUERY = '''SELECT cc, id FROM jpeg
+  WHERE file_id=? AND well_formed=1 AND is_solid=0'''
            
 
 def create_db(cursor):
     cursor.execute(CREATE_FILES_TABLE_QUERY)
     cursor.execute(CREATE_JPEG_TABLE_QUERY)
+    upgrade_jpeg_table(cursor)
+    cursor.execute(CREATE_JPEG_INDEX_QUERY)
+    cursor.execute(CREATE_SKIPPED_TABLE_QUERY)
+    cursor.execute(CREATE_SETTINGS_TABLE_QUERY)
+    cursor.execute(CREATE_STAGE_TIMINGS_TABLE_QUERY)
+    cursor.execute(CREATE_FAILURES_TABLE_QUERY)
+    cursor.execute("PRAGMA table_info(failures)")
+    existing = [row[1] for row in cursor.fetchall()]
+    for name, col_type in FAILURES_ADDED_COLUMNS:
+        if name not in existing:
+            cursor.execute("ALTER TABLE failures ADD COLUMN %s %s" % (name, col_type))
+    cursor.execute(CREATE_FAILURES_INDEX_QUERY)
+    cursor.execute(CREATE_FAILURES_FILENAME_INDEX_QUERY)
+
+
+def upgrade_jpeg_table(cursor):
+    """Adds the newer columns to databases from older versions, filling in the
+    typed location and time columns from the text columns"""
+    cursor.execute("PRAGMA table_info(jpeg)")
+    existing = [row[1] for row in cursor.fetchall()]
+    missing = [(name, col_type) for name, col_type in JPEG_ADDED_COLUMNS if name not in existing]
+    for name, col_type in missing:
+        cursor.execute(ADD_JPEG_COLUMN_QUERY % (name, col_type))
+    if 'timestamp' in existing:
+        return
+
+    cursor.execute("SELECT file_id, gps_data, date_data FROM jpeg WHERE gps_data != '' OR date_data != ''")
+    updates = []
+    for file_id, gps_data, date_data in cursor.fetchall():
+        lat, lon = parse_lat_lon(gps_data)
+        updates.append((lat, lon, exif_date_to_timestamp(date_data), file_id))
+    cursor.executemany("UPDATE jpeg SET latitude=?, longitude=?, timestamp=? WHERE file_id=?", updates)
 
 
 def close_db(conn):
@@ -168,7 +378,8 @@ def insert_file_entry(cursor, filename, filesize, md5, sha512):
 
 def insert_jpeg_entry(cursor, fileid, well_formed, is_solid, contains_face, screenshot,
       screenshot_fname, is_cc, cc_fname, is_id, id_fname, contains_skin, skin_type, 
-      gps_data, date, model, text):
+      gps_data, date, model, text, latitude=None, longitude=None, timestamp=None,
+      screenshot_confidence=None):
       
     cursor.execute(INSERT_JPEG_QUERY, (fileid, well_formed, is_solid, contains_face, screenshot, 
         str(screenshot_fname).decode('utf-8'), is_cc, str(cc_fname).decode('utf-8'), is_id, 
@@ -176,11 +387,91 @@ def insert_jpeg_entry(cursor, fileid, well_formed, is_solid, contains_face, scre
         str(gps_data).decode('utf-8'), 
         str(date).decode('utf-8'), 
         buffer(str(model)), 
-        buffer(str(text))))
+        buffer(str(text)),
+        latitude, longitude, timestamp, screenshot_confidence))
+
+
+def insert_skipped_entry(cursor, fileid, reason, width, height):
+  cursor.execute(INSERT_SKIPPED_QUERY, (fileid, reason, width, height))
+
+
+def insert_failure_entry(cursor, fileid, filename, stage, error):
+  cursor.execute(INSERT_FAILURE_QUERY, (fileid, stage, error.decode('utf-8', 'replace'),
+                                        filename.decode('utf-8')))
+
+
+def insert_read_failure_entry(cursor, filename, error):
+  """Records a file that couldn't be read, replacing any earlier read failure
+  for the same path"""
+  cursor.execute(DELETE_READ_FAILURE_QUERY, (filename.decode('utf-8'),))
+  insert_failure_entry(cursor, None, filename, 'read', error)
+
+
+def clear_read_failure(cursor, filename):
+  cursor.execute(DELETE_READ_FAILURE_QUERY, (filename.decode('utf-8'),))
+
+
+def update_jpeg_optional(cursor, fileid, contains_skin, skin_type, text):
+  cursor.execute(UPDATE_JPEG_OPTIONAL_QUERY, (contains_skin, str(skin_type).decode('utf-8'),
+        buffer(str(text)), fileid))
+
+
+def insert_stage_timings(cursor, started, worker, stages):
+  """Records the stage statistics from a run (see metrics.Metrics.snapshot)"""
+  cursor.executemany(INSERT_STAGE_TIMING_QUERY,
+                     [(int(started), worker, name, stats['count'], stats['total_seconds'], stats['max_seconds'])
+                      for name, stats in sorted(stages.items())])
+
+
+def get_setting(cursor, name):
+  row = cursor.execute(SELECT_SETTING_QUERY, (name,)).fetchone()
+  return row[0] if row else None
+
+
+def record_setting(cursor, name, value):
+  """Records a setting for the run, warning if earlier runs into the same
+  database used a different value"""
+  previous = get_setting(cursor, name)
+  if previous is not None and previous != value:
+    print "Warning: this database was previously built with %s=%s, not %s" % (name, previous, value)
+  cursor.execute(INSERT_SETTING_QUERY, (name, value))
+
+
+def get_checked_dbs():
+  """Returns the databases that files are checked against for duplicates and
+  quarantined files: the one being written, and the main database if it was
+  attached by a local shard"""
+  return ['main', PRIOR_DB] if g_prior_attached else ['main']
 
 
 def find_sha512(cursor, sha512):
-  result = cursor.execute(SELECT_SHA512_QUERY, (sha512,))
+  for db in get_checked_dbs():
+    row = cursor.execute(SELECT_SHA512_QUERY % db, (sha512,)).fetchone()
+    if row is not None:
+      return row
+  return None
+
+
+def is_quarantined(cursor, sha512):
+  """Returns whether the file failed to be examined in an earlier run"""
+  return any(cursor.execute(SELECT_QUARANTINED_QUERY % {'db': db}, (sha512,)).fetchone() is not None
+             for db in get_checked_dbs())
+
+
+def forget_failures(cursor):
+  """Removes the files that failed to be examined, along with all of their
+  rows, so that they're examined again. Returns the amount of files."""
+  file_ids = [(row[0],) for row in cursor.execute(SELECT_FAILED_FILES_QUERY).fetchall()]
+  for table in merge_results.get_per_file_tables(cursor):
+    cursor.executemany("DELETE FROM %s WHERE file_id=?" % table, file_ids)
+  cursor.executemany("DELETE FROM files WHERE id=?", file_ids)
+  # Files that couldn't be read are tried again anyway, so only the record goes
+  cursor.execute(DELETE_READ_FAILURES_QUERY)
+  return len(file_ids)
+
+
+def find_jpeg_groups(cursor, fileid):
+  result = cursor.execute(SELECT_JPEG_GROUPS_QUERY, (fileid,))
   return result.fetchone()
 
   
@@ -188,29 +479,60 @@ def find_sha512(cursor, sha512):
 # Image processing
 ###############################################################################
 
+# Progress and timing for the current run
+g_metrics = metrics.Metrics()
+
+# Limits on the memory used for decoding images
+g_memory = memory.MemoryGovernor()
+
+# Results from earlier runs, or None if disabled
+g_cache = None
+
+# Runs the detectors on each file, isolated from the rest of the run
+g_sandbox = None
+
+# Where the sandbox worker writes the rows for a file before passing them back,
+# as (cursor, per-file tables)
+g_scratch = None
+
+# When the sandbox worker last committed the cache
+g_cache_committed = 0
+
+# Whether the main database is attached (as PRIOR_DB), so that a local shard
+# skips the files that it already has
+g_prior_attached = False
+
+# The file_id used in the scratch database
+SCRATCH_FILE_ID = 0
+
 ICON_DIR = "./common_desktop_icons"
 CC_DIR = "./cc_images"
 ID_DIR = "./id_images"
 
+# Where the packed template features are shared between the workers
+MODEL_DIR = refmodel.DEFAULT_MODEL_DIR
 
-def init_jpeg(enable_skin, enable_exif, enable_ocr):
+
+def init_jpeg(enable_skin, enable_exif, enable_ocr, backend=features.DEFAULT_BACKEND):
     """ Loads in global variables for efficiency purposes"""
     
     # Load in all of the classifiers
     global g_cascades
     g_cascades = load_cascades()
     
-    # Load in the icons
-    global g_icon
-    g_icon = load_imgdir_features(ICON_DIR)  
-       
-    # Next load in the CC's
-    global g_cc
-    g_cc = load_imgdir_features(CC_DIR) 
+    # The feature detector used for matching against the templates
+    global g_backend, g_detector
+    g_backend = features.get_backend(backend)
+    g_detector = g_backend.create_detector()
+    
+    # Map in the features of the icons, CC's, and ID's
+    global g_reference
+    g_reference = refmodel.ReferenceModel(MODEL_DIR, {'icon': ICON_DIR, 'cc': CC_DIR, 'id': ID_DIR},
+                                          g_backend)
     
-    # Next load in the ID's
-    global g_id
-    g_id = load_imgdir_features(ID_DIR)
+    # The icons are also searched for along the edges of possible screenshots
+    global g_screenshot_templates
+    g_screenshot_templates = screenshot.load_templates(ICON_DIR)
     
     # Set the options:
     global g_jpeg_options
@@ -220,46 +542,133 @@ def init_jpeg(enable_skin, enable_exif, enable_ocr):
     g_jpeg_options['enable_ocr']  = enable_ocr 
 
 
-def load_imgdir_features(dirname):
-  """Loads all of the features from all images in the dir"""
-  result = {}
-  for entry in os.listdir(dirname):
-    fname = os.path.join(dirname, entry)
-    if os.path.isfile(fname):
-        try:
-            img = load_image(fname)
-            detector = cv2.SURF(3200)
-            kp, desc = detector.detectAndCompute(img, None)
-             
-            result[fname] = [img, kp, desc]
-        except:
-          continue 
-  return result   
-
-
-def load_image(fname):
-  img = cv2.imread(fname)
-  return img
+def get_cache_version():
+    """Identifies everything that affects the results of process_jpeg, so that
+    cached results are only reused if they would come out the same"""
+    cascades = []
+    for fname in CASCADE_FILES:
+        if os.path.isfile(fname):
+            with open(fname, 'rb') as fh:
+                cascades.append(hashlib.md5(fh.read()).hexdigest())
+    return cache.make_version({'detector_version': DETECTOR_VERSION,
+                               'cascades': cascades,
+                               'faces': {'scale_factor': FACE_SCALE_FACTOR,
+                                         'min_neighbors': FACE_MIN_NEIGHBORS,
+                                         'min_size': FACE_MIN_SIZE},
+                               'reference': g_reference.signature,
+                               'match_ratio': features.MATCH_RATIO,
+                               'min_matches': refmodel.MIN_MATCHES,
+                               'screenshot': screenshot.config(),
+                               'max_pixels': g_memory.max_pixels,
+                               'jpeg_scales': memory.JPEG_SCALES,
+                               'options': g_jpeg_options})
+
+
+def open_cache(args):
+    """Opens the result cache for this process, unless it's disabled"""
+    global g_cache
+    if args.disable_cache:
+        g_cache = None
+        return
+    g_cache = cache.ResultCache(args.cache, get_cache_version(), args.cache_entries)
+
+
+def open_sandbox(args):
+    """Sets up the sandbox that the images are examined in (see sandbox.py).
+    The cache is opened by each sandbox worker, unless it's disabled."""
+    global g_sandbox
+    # The memory slots held by a worker that's killed are given back
+    held = multiprocessing.RawValue('i', 0)
+    g_sandbox = sandbox.Sandbox(init=lambda: init_sandbox_worker(args, held),
+                                finish=close_sandbox_worker,
+                                cleanup=lambda: g_memory.release_held(held),
+                                timeout=args.file_timeout or None,
+                                isolate=not args.disable_sandbox)
+    if not g_sandbox.isolate:
+        open_cache(args)
+        g_metrics.on_stage = g_sandbox.set_stage
+
+
+def init_sandbox_worker(args, held):
+    """Runs in each new sandbox worker"""
+    global g_metrics, g_cache_committed
+    g_metrics = metrics.StageRecorder(g_sandbox.set_stage)
+    g_memory.held = held
+    open_cache(args)
+    g_cache_committed = time.time()
+
+
+def close_sandbox_worker():
+    if g_cache is not None:
+        g_cache.close()
+
+
+def close_sandbox():
+    """Stops the sandbox, and closes the cache if it's in this process"""
+    g_sandbox.close()
+    if g_cache is not None:
+        g_cache.close()
+
+
+def examine(func, *args):
+    """Runs func(*args) in the sandbox, adding the stages that it timed to
+    g_metrics. Raises sandbox.WorkerFailure if it fails."""
+    if not g_sandbox.isolate:
+        return g_sandbox.call(func, *args)
+    result, (stages, counters) = g_sandbox.call(run_recorded, func, *args)
+    g_metrics.add_recorded(stages, counters)
+    return result
+
+
+def run_recorded(func, *args):
+    """Runs func in the sandbox worker, returning its result along with the
+    stages that it timed"""
+    global g_cache_committed
+    try:
+        result = func(*args)
+    finally:
+        # Taken even if the call failed, so that its stages aren't counted
+        # against the next file
+        recorded = g_metrics.take()
+        # Memory that a worker has grown into isn't given back to the system,
+        # even once it's freed, so a worker that's over the limit is replaced
+        if g_memory.over_rss():
+            g_sandbox.retire()
+    if g_cache is not None and time.time() - g_cache_committed > COMMIT_INTERVAL:
+        g_cache.commit()
+        g_cache_committed = time.time()
+    return result, recorded
+
+
+def get_scratch():
+    """Returns the (cursor, per-file tables) of the scratch database"""
+    global g_scratch
+    if g_scratch is None:
+        cursor = sqlite3.connect(':memory:').cursor()
+        create_db(cursor)
+        g_scratch = cursor, merge_results.get_per_file_tables(cursor)
+    return g_scratch
+
+
+def decode_image(data):
+  """Decodes an image from its in-memory contents, within the memory budget.
+  
+  Returns (img, skip_reason, dimensions). img is None if the image isn't
+  well-structured or was skipped, and skip_reason is set if it was skipped.
+  """
+  # Checking the header with PIL first is cheap, and not as noisy as OpenCV
+  dimensions = memory.get_dimensions(data)
+  if dimensions is None:
+    return None, None, None
+  # OpenCV returns None if it fails, instead of raising a useful exception.
+  img, skip_reason = g_memory.decode(data, dimensions)
+  return img, skip_reason, dimensions
 
 
 ###############################################################################
 # Image Feature Extraction
 ###############################################################################
 
-def is_well_structured(filename):
-  try:
-    # First try using PIL, since it's not as noisy:
-    img = PIL.Image.open(filename)
-    # Then, if that's successful, try it with OpenCV
-    img = cv2.imread(filename)
-    # It returns None if it fails, instead of raising a useful exception.
-    if img is None:
-      return False
-    else:
-      return True
-  except:
-    return False
-
 def is_solid_color(img):
   """A color is defined as 'mostly solid' if there are less than 3 buckets with
    values > 0 for each color: R,G, and B"""
@@ -296,34 +705,43 @@ def get_num_faces(img):
   # Returns the largest amount of faces matched by a single cascade
 
   for cascade in g_cascades:
-    rects = cascade.detectMultiScale(img, scaleFactor=1.3, minNeighbors=4, minSize=(30, 30), flags = cv.CV_HAAR_SCALE_IMAGE)
+    rects = cascade.detectMultiScale(img, scaleFactor=FACE_SCALE_FACTOR, minNeighbors=FACE_MIN_NEIGHBORS,
+                                     minSize=FACE_MIN_SIZE, flags = cv.CV_HAAR_SCALE_IMAGE)
     max_faces = max(max_faces, len(rects))    
   return max_faces
 
 
-def within_group(img, group, minmatches=0):
+def get_features(img):
+    """Returns a matcher holding the descriptors of an image, for matching
+    against the templates. It's built once per image, and shared by all of the
+    groups. Returns None if the image has too few features to match."""
+    kp, desc = g_detector.detectAndCompute(img, None)
+    return features.train_matcher(g_backend, desc)
+
+
+def within_group(matcher, group):
     """\
-    Checks if the supplied image is within a group of images.
-    The group is represented as a dictionary of filename:image
+    Checks if the image with the supplied matcher is within a group of
+    images. The group is the name of a group in the reference model.
+    
+    Note: This is prone to false positives!
     
-    Note: This is extremely slow and is prone to false positives!
+    Returns whether or not it matched and the filename ('' if it didn't).
+    Errors from the matcher are raised, so that they're recorded as failures.
+    """
+    return g_reference.within_group(matcher, group)
+
+def get_screenshot(img, matcher):
+    """Checks if the image is a screenshot, first from its dimensions and the
+    icons along its edges, and then by matching features against the icons if
+    that's inconclusive.
     
-    Returns whether or not it matched and the filename ('' if it didn't)
+    Returns whether or not it matched, the filename of the icon ('' if it
+    didn't), and the confidence from 0 to 1
     """
-    count = 0
-    for fname, details in group.iteritems():
-      try:
-        small_img, kp, desc = details
-        matches = find_obj.match_images(small_img, img, (kp, desc))
-        if len(matches) > 0:
-          count += 1
-        if count > minmatches:
-          return True, fname  
-      except:
-        return False, ''
-    return False, ''
-
-def get_skin_type(fname):
+    return screenshot.detect(img, g_screenshot_templates, lambda: within_group(matcher, 'icon'))
+
+def get_skin_type(img):
     """Gets whether or not there is skin in the image and guesses the type.
     Note: Extremely slow and inaccurate
     
@@ -331,7 +749,7 @@ def get_skin_type(fname):
     are most likely to be a person, and then only examine those portions of
     the image for skin color.
     """
-    image = Image.open(fname)
+    image = PIL.Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
     contains_skin, skin_type = detect_skin(image)
     return contains_skin, skin_type
 
@@ -339,12 +757,15 @@ def get_skin_type(fname):
 # EXIF-specific processing
 ###############################################################################
 
-def get_exif(fname):
+def get_exif(data):
+    """Returns the (gps, date, model) text, and the (latitude, longitude) as floats
+    (or None)"""
     gps_info = ''
     date_info = ''
     model_info = ''
+    lat_lon = (None, None)
     try:
-        img = PIL.Image.open(fname)
+        img = PIL.Image.open(StringIO.StringIO(data))
         info = img._getexif()
         for tag, value in info.items():
             tag = PIL.ExifTags.TAGS.get(tag)
@@ -354,14 +775,15 @@ def get_exif(fname):
                     sub_decoded = PIL.ExifTags.GPSTAGS.get(gps_tag, gps_tag)
                     gps_data[sub_decoded] = value[gps_tag]
                 # Now that we have the decoded data data:
-                gps_info = str(get_lat_lon(gps_data))                
+                lat_lon = get_lat_lon(gps_data)
+                gps_info = str(lat_lon)
             elif tag and 'DateTimeOriginal' in tag:
                 date_info = str(value)
             elif tag and 'Model' in tag:
                 model_info = str(value)
     except:
         pass
-    return gps_info, date_info, model_info
+    return gps_info, date_info, model_info, lat_lon
 
 def get_lat_lon(gps_info):
     """Returns the latitude and longitude, if available, from the provided GPSInfo exif data"""
@@ -393,46 +815,125 @@ def _convert_to_degress(value):
     min_num, min_denom = value[1]
     m = float(min_num) / float(min_denom)
 
-    sec_num, sec_denom = value[1]
+    sec_num, sec_denom = value[2]
     s = float(sec_num) / float(sec_denom)
 
     return d + (m / 60.0) + (s / 3600.0)
 
+def parse_lat_lon(gps_info):
+    """Parses the (lat, lon) text stored by earlier versions back into floats"""
+    try:
+        lat, lon = [part.strip() for part in gps_info.strip('()').split(',')]
+        lat = None if lat == 'None' else float(lat)
+        lon = None if lon == 'None' else float(lon)
+        return lat, lon
+    except ValueError:
+        return None, None
+
+def exif_date_to_timestamp(date_info):
+    """Converts an EXIF date ('YYYY:MM:DD HH:MM:SS') into seconds since the epoch.
+    The time zone isn't recorded in EXIF, so it's treated as UTC. Returns None
+    if the date can't be parsed."""
+    try:
+        date = datetime.datetime.strptime(date_info.strip().strip('\x00')[:19], '%Y:%m:%d %H:%M:%S')
+        return calendar.timegm(date.timetuple())
+    except (ValueError, AttributeError):
+        return None
+
 ###############################################################################
 # Tie everything up!
 ###############################################################################
 
-def process_jpeg(cursor, file_id, fname):
-  """Do all of the work required to process a single JPEG"""
+def get_optional_features(img, is_cc, is_id):
+  """Runs the slow optional stages on a decoded image. Returns (contains_skin,
+  skin_type, text)"""
+  contains_skin = ''
+  skin_type = ''
+  text = ''
+  if (is_cc or is_id) and g_jpeg_options['enable_ocr']:
+    with g_metrics.stage('ocr'):
+      text = ocr_image(img)
+  if g_jpeg_options['enable_skin']:
+    with g_metrics.stage('skin'):
+      contains_skin, skin_type = get_skin_type(img)
+  return contains_skin, skin_type, text
+
+
+def has_optional_stages(is_cc, is_id):
+  """Returns whether any of the optional stages would run for an image, in the
+  same way as get_optional_features"""
+  return g_jpeg_options['enable_skin'] or (g_jpeg_options['enable_ocr'] and (is_cc or is_id))
+
+
+def process_jpeg(cursor, file_id, data, run_optional=True, sha512=None):
+  """Do all of the work required to process a single JPEG
+  
+  If run_optional is False, the slow optional stages (OCR and skin) are
+  skipped. They can be filled in later with process_jpeg_optional.
+  If the sha512 is given, the results are reused from (and saved to) the cache.
+  
+  Returns whether the image is well-structured, and whether its optional
+  stages still need to be run.
+  """
+  if g_reference.refresh() and g_cache is not None:
+    # The templates changed, so the earlier results no longer apply
+    g_cache.version = get_cache_version()
+
+  if g_cache is not None and sha512 is not None:
+    with g_metrics.stage('cache'):
+      cached = g_cache.get(sha512)
+    if cached is not None:
+      print_debug("Reusing the cached results")
+      g_metrics.increment('cache_hits')
+      with g_metrics.stage('insert'):
+        insert_jpeg_entry(cursor, file_id, *cached)
+      return cached[0], False
+    g_metrics.increment('cache_misses')
 
   well_structured = False
   is_solid = False
   faces = 0
-  is_screenshot, screenshot_fname = False, ''
+  is_screenshot, screenshot_fname, screenshot_confidence = False, '', None
   is_cc, cc_fname = False, ''
   is_id, id_fname = False, ''
   exif_gps = ''
   exif_date = ''
   exif_model = ''
+  latitude, longitude, timestamp = None, None, None
   contains_skin = ''
   skin_type = ''
   text = ''
 
-  well_structured = is_well_structured(fname)
-  if well_structured:
-    img = load_image(fname)
-    is_solid = is_solid_color(img)
-    if not is_solid:
-      faces = get_num_faces(img)
-      is_screenshot, screenshot_fname = within_group(img, g_icon, 2)
-      is_cc, cc_fname = within_group(img, g_cc)
-      is_id, id_fname = within_group(img, g_id)
-      if (is_cc or is_id) and g_jpeg_options['enable_ocr']:
-        text = ocr_text(fname)
-      if g_jpeg_options['enable_exif']:
-        exif_gps, exif_date, exif_model = get_exif(fname)
-      if g_jpeg_options['enable_skin']:
-        contains_skin, skin_type = get_skin_type(fname)
+  # Only a limited amount of decoded images may be held at once
+  with g_memory.slot():
+    with g_metrics.stage('decode'):
+      img, skip_reason, dimensions = decode_image(data)
+    well_structured = img is not None
+    if skip_reason:
+      print_debug("Skipped for the memory budget (%s): %dx%d" % (skip_reason, dimensions[0], dimensions[1]))
+      insert_skipped_entry(cursor, file_id, skip_reason, dimensions[0], dimensions[1])
+    if well_structured:
+      with g_metrics.stage('solid'):
+        is_solid = is_solid_color(img)
+      if not is_solid:
+        with g_metrics.stage('faces'):
+          faces = get_num_faces(img)
+        with g_metrics.stage('features'):
+          matcher = get_features(img)
+        with g_metrics.stage('screenshot'):
+          is_screenshot, screenshot_fname, screenshot_confidence = get_screenshot(img, matcher)
+        with g_metrics.stage('cc'):
+          is_cc, cc_fname = within_group(matcher, 'cc')
+        with g_metrics.stage('id'):
+          is_id, id_fname = within_group(matcher, 'id')
+        if g_jpeg_options['enable_exif']:
+          with g_metrics.stage('exif'):
+            exif_gps, exif_date, exif_model, (latitude, longitude) = get_exif(data)
+            timestamp = exif_date_to_timestamp(exif_date)
+        if run_optional:
+          contains_skin, skin_type, text = get_optional_features(img, is_cc, is_id)
+    # Free the image before giving up the slot
+    del img
 
   # Mirror the same structure a second time for the debug output
   print_debug("Valid: %s" % str(well_structured))
@@ -440,7 +941,7 @@ def process_jpeg(cursor, file_id, fname):
     print_debug("Solid Color: %s" % str(is_solid))
     if not is_solid:
       print_debug("Amount of faces: %d" % faces)
-      print_debug("Screenshot? %s: %s" % (str(is_screenshot), screenshot_fname))
+      print_debug("Screenshot? %s (%0.2f): %s" % (str(is_screenshot), screenshot_confidence, screenshot_fname))
       print_debug("CC? %s: %s" % (str(is_cc), cc_fname))
       print_debug("ID? %s: %s" % (str(is_id), id_fname))
       if (is_cc or is_id) and g_jpeg_options['enable_ocr']:
@@ -453,32 +954,146 @@ def process_jpeg(cursor, file_id, fname):
       if g_jpeg_options['enable_skin']:
         print_debug("Contains skin? %s: Skin Type:%s" % (str(contains_skin), skin_type))
 
-  insert_jpeg_entry(cursor, file_id, well_structured, is_solid, faces, is_screenshot,
-                     screenshot_fname, is_cc, cc_fname, is_id, id_fname, contains_skin,
-                     skin_type, exif_gps, exif_date, exif_model, text)
-  return well_structured
+  result = [well_structured, is_solid, faces, is_screenshot, screenshot_fname, is_cc, cc_fname,
+            is_id, id_fname, contains_skin, skin_type, exif_gps, exif_date, exif_model, text,
+            latitude, longitude, timestamp, screenshot_confidence]
+  with g_metrics.stage('insert'):
+    insert_jpeg_entry(cursor, file_id, *result)
+
+  deferred = well_structured and not is_solid and not run_optional and has_optional_stages(is_cc, is_id)
+  # Images skipped for the budget might fit next time, and deferred stages
+  # aren't in the results yet
+  if g_cache is not None and sha512 is not None and not skip_reason and not deferred:
+    g_cache.put(sha512, result)
+  return well_structured, deferred
+
+
+def examine_jpeg(data, run_optional, sha512):
+  """Runs process_jpeg in the sandbox, against the scratch database
+  
+  Returns whether the image is well-structured, whether its optional stages
+  still need to be run, and its rows (see get_file_rows).
+  """
+  cursor, tables = get_scratch()
+  try:
+    well_structured, deferred = process_jpeg(cursor, SCRATCH_FILE_ID, data, run_optional, sha512)
+  finally:
+    # Nothing is left behind for the next file, even on errors
+    file_rows = get_file_rows(cursor, tables, SCRATCH_FILE_ID)
+  return well_structured, deferred, file_rows
+
+
+def examine_jpeg_optional(data, is_cc, is_id):
+  """Runs the optional stages in the sandbox. Returns (contains_skin,
+  skin_type, text), or None if the image can't be decoded."""
+  with g_memory.slot():
+    with g_metrics.stage('decode'):
+      img, skip_reason, dimensions = decode_image(data)
+    if img is None:
+      return None
+    optional = get_optional_features(img, is_cc, is_id)
+    del img
+  return optional
+
+
+def process_jpeg_optional(cursor, file_id, name, data):
+  """Fills in the optional stages for a JPEG that was processed without them"""
+  row = find_jpeg_groups(cursor, file_id)
+  if row is None:
+    return
+  is_cc, is_id = row
+  try:
+    optional = examine(examine_jpeg_optional, data, is_cc, is_id)
+  except sandbox.WorkerFailure, e:
+    print "Failed to examine %s in %s: %s" % (name, e.stage, e.error)
+    insert_failure_entry(cursor, file_id, name, e.stage, e.error)
+    return
+  if optional is not None:
+    update_jpeg_optional(cursor, file_id, *optional)
+
+
+def record_failure(cursor, name, size, md5, sha512, stage, error):
+  """Records a file that couldn't be examined. It's still added to the files
+  table, so that it's skipped (quarantined) when the run is resumed."""
+  print "Failed to examine %s in %s: %s" % (name, stage, error)
+  file_id = insert_file_entry(cursor, name, size, md5, sha512)
+  insert_failure_entry(cursor, file_id, name, stage, error)
+  return file_id
+
+
+def record_read_failure(cursor, name, error):
+  """Records a file that couldn't be read. Without its contents there's no
+  hash, so it's only recorded by filename, and is tried again on resume."""
+  print "Failed to read %s: %s" % (name, error)
+  insert_read_failure_entry(cursor, name, error)
 
-def process_file(cursor, fname):
-  """This is the function responsible for tying together all of the other parsing modules"""
+
+def process_file(cursor, entry, run_optional=True, prefetcher=None):
+  """This is the function responsible for tying together all of the other parsing modules
+  
+  If a prefetcher is given, the contents are taken from it, in case they were
+  read ahead.
+  """
   
   # First do the minimal amount we do for every file
-  md5, sha512 = get_hashes(fname)
+  try:
+    with g_metrics.stage('read'):
+      data = prefetcher.read(entry) if prefetcher else entry.read()
+  except Exception:
+    record_read_failure(cursor, entry.name, sandbox.format_error())
+    return "failed", None, False
+  with g_metrics.stage('hash'):
+    md5, sha512 = get_hashes(data)
+  return process_contents(cursor, entry.name, data, md5, sha512, run_optional)
+
+
+def process_contents(cursor, name, data, md5, sha512, run_optional=True):
+  """Processes a file whose contents were already read and hashed
+  
+  Returns the result (True or False for whether it's well-structured, or
+  "duplicate", "quarantined", or "failed"), its file_id, and whether its
+  optional stages were deferred.
+  """
   
   # If it's already in the DB, no processing is necessary
   if find_sha512(cursor, sha512):
+    if is_quarantined(cursor, sha512):
+      print_debug("It failed in an earlier run! Skipped!")
+      return "quarantined", None, False
     print_debug("It's a duplicate! Skipped!")
-    return "duplicate"
-  
-  size = os.path.getsize(fname)
-  file_id = insert_file_entry(cursor, fname, size, md5, sha512)
+    return "duplicate", None, False
 
-  # Then handle the remaining modules  
-  valid = process_jpeg(cursor, file_id, fname)
-  return valid
+  # Then handle the remaining modules, where a crash or hang only costs this file
+  try:
+    valid, deferred, file_rows = examine(examine_jpeg, data, run_optional, sha512)
+  except sandbox.WorkerFailure, e:
+    file_id = record_failure(cursor, name, len(data), md5, sha512, e.stage, e.error)
+    return "failed", file_id, False
+
+  file_id = insert_file_entry(cursor, name, len(data), md5, sha512)
+  with g_metrics.stage('insert'):
+    insert_file_rows(cursor, file_id, file_rows)
+    # It could be read this time
+    clear_read_failure(cursor, name)
+  return valid, file_id, deferred
+
+
+def parse_shard(value):
+  """Parses a shard given as INDEX/COUNT (e.g. 0/4) into an (index, count) tuple"""
+  try:
+    index, count = [int(part) for part in value.split('/')]
+  except ValueError:
+    raise argparse.ArgumentTypeError("Shards must be given as INDEX/COUNT, not '%s'" % value)
+  if count < 1 or not 0 <= index < count:
+    raise argparse.ArgumentTypeError("Shard index must be between 0 and %d" % (count - 1))
+  return index, count
 
 
 def build_argparser():
-  parser = argparse.ArgumentParser(description='Extracts features for prioritizing recovered data')
+  parser = argparse.ArgumentParser(description='Extracts features for prioritizing recovered data',
+                                   epilog='Use "%(prog)s merge --help" to combine shard databases, '
+                                          '"%(prog)s export --help" to export the results for analysis, and '
+                                          '"%(prog)s compare --help" to compare two runs')
   # g_debug mode
   parser.add_argument('--debug', dest='debug', action='store_true',
                       help='Add additional logging data')
@@ -490,7 +1105,8 @@ def build_argparser():
   # maxfiles     
   parser.add_argument('--maxfiles', dest='maxfiles', action='store', type=int,
                       default=None,
-                      help='Specify an upper limit to the amount of files that are examined')
+                      help='Specify an upper limit to the amount of files that are examined. With --shard or '
+                           '--local-shards, this limits all of the shards together, not each one')
   
   # Disable EXIF data extraction (slow):
   parser.add_argument('--disable_exif', dest='enable_exif', action='store_false',
@@ -504,40 +1120,161 @@ def build_argparser():
   parser.add_argument('--enable_ocr', dest='enable_ocr', action='store_true',
                       help="Enable text OCRing of ID's and CC's (slow and inaccurate)")
 
+  # Disable reading files out of containers:
+  parser.add_argument('--disable_containers', dest='expand_containers', action='store_false',
+                      help='Examine tar, zip, and raw carve files as-is, instead of examining each of their members')
+  parser.add_argument('--carve-extensions', dest='carve_extensions', action='store', nargs='+', default=[],
+                      metavar='EXT',
+                      help='Also split files with these extensions (such as .dd or .img) as raw concatenated '
+                           'carves, in addition to %s' % ', '.join(containers.CARVE_EXTENSIONS))
+
+  # Memory limits:
+  parser.add_argument('--max-pixels', dest='max_pixels', action='store', type=int,
+                      default=memory.DEFAULT_MAX_PIXELS,
+                      help='The most pixels an image may have once decoded. Larger JPEGs are decoded at a '
+                           'reduced resolution, and other images are skipped (default is %d)' % memory.DEFAULT_MAX_PIXELS)
+
+  parser.add_argument('--max-rss', dest='max_rss', action='store', type=int,
+                      default=None,
+                      help='Skip images while a process is using more than this many MB of memory. A sandbox '
+                           'worker that is still over it after a file is replaced by a new one')
+
+  parser.add_argument('--max-inflight-images', dest='max_inflight', action='store', type=int,
+                      default=None,
+                      help='The most decoded images held at once, across all of the local shards')
+
+  # Deadline for the run:
+  parser.add_argument('--time-budget', dest='time_budget', action='store', type=float,
+                      default=None,
+                      help='Stop after this many minutes. The most promising files are examined first, '
+                           'and the optional stages only run when there is time to spare')
+
+  # Sharding across several analysis nodes:
+  parser.add_argument('--shard', dest='shard', action='store', type=parse_shard,
+                      default=None,
+                      help='Only process the INDEX/COUNT partition of the files (e.g. 0/4), '
+                           'so that several nodes can split the work. Merge the results afterwards with "merge"')
+
+  # Sharding across local worker processes:
+  parser.add_argument('--local-shards', dest='local_shards', action='store', type=int,
+                      default=None,
+                      help='Split the files across this many local worker processes, '
+                           'each writing to its own shard database, and merge them when done')
+
+  # Progress reporting:
+  parser.add_argument('--status-interval', dest='status_interval', action='store', type=float,
+                      default=10,
+                      help='Print a progress line at most once every this many seconds (default is 10)')
+
+  parser.add_argument('--metrics-port', dest='metrics_port', action='store', type=int,
+                      default=None,
+                      help='Serve live metrics over HTTP on this port, as /metrics (Prometheus) and /status (JSON). '
+                           'Each local shard uses the next port up')
+
+  parser.add_argument('--metrics-host', dest='metrics_host', action='store',
+                      default='127.0.0.1',
+                      help='The address to serve the metrics on (default is 127.0.0.1)')
+
+  # Feature detector for the template matching:
+  parser.add_argument('--features', dest='features', action='store',
+                      choices=sorted(features.BACKENDS), default=features.DEFAULT_BACKEND,
+                      help='The feature detector used to match against the icons, CCs, and IDs. '
+                           'Use "python features.py" to compare them (default is %s)' % features.DEFAULT_BACKEND)
+
+  # Results from earlier runs:
+  parser.add_argument('--cache', dest='cache', action='store',
+                      default=cache.DEFAULT_CACHE_NAME,
+                      help='Reuse the results for files that were examined before, from this cache '
+                           '(default is %s)' % cache.DEFAULT_CACHE_NAME)
+
+  parser.add_argument('--cache-entries', dest='cache_entries', action='store', type=int,
+                      default=cache.DEFAULT_MAX_ENTRIES,
+                      help='The most results kept in the cache; the least recently used are '
+                           'removed first (default is %d)' % cache.DEFAULT_MAX_ENTRIES)
+
+  parser.add_argument('--disable-cache', dest='disable_cache', action='store_true',
+                      help="Don't read or write the result cache")
+
+  # Reading ahead from slow storage:
+  parser.add_argument('--prefetch', dest='prefetch', action='store', type=int,
+                      default=prefetch.DEFAULT_READERS,
+                      help='Read this many files ahead in the background, for evidence on high-latency '
+                           'storage such as network shares. 0 reads each file when it is needed '
+                           '(default is %d)' % prefetch.DEFAULT_READERS)
+
+  parser.add_argument('--prefetch-mb', dest='prefetch_mb', action='store', type=int,
+                      default=prefetch.DEFAULT_MAX_BYTES // (1024 * 1024),
+                      help='The most MB of files that are read ahead at once (default is %d)'
+                           % (prefetch.DEFAULT_MAX_BYTES // (1024 * 1024)))
+
+  # Isolating each file's processing:
+  parser.add_argument('--file-timeout', dest='file_timeout', action='store', type=float,
+                      default=sandbox.DEFAULT_TIMEOUT,
+                      help='Give up on a file that takes longer than this many seconds to examine, and '
+                           'record it in the failures table. 0 waits forever (default is %d)' % sandbox.DEFAULT_TIMEOUT)
+
+  parser.add_argument('--disable-sandbox', dest='disable_sandbox', action='store_true',
+                      help="Examine the files in this process instead of a separate worker, so that a crash "
+                           "stops the run and --file-timeout doesn't apply (for debugging)")
+
+  parser.add_argument('--retry-failures', dest='retry_failures', action='store_true',
+                      help='Examine the files that failed in earlier runs into the same database again, '
+                           'instead of skipping them')
+
+  # Watching a directory that's still being written to:
+  parser.add_argument('--watch', dest='watch', action='store_true',
+                      help='Keep running, and examine new files as they appear under the path, '
+                           'such as the output of a running carver. Stop with Ctrl-C')
+
+  parser.add_argument('--watch-workers', dest='watch_workers', action='store', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='The amount of worker processes examining new files (default is %d)'
+                           % multiprocessing.cpu_count())
+
+  parser.add_argument('--settle', dest='settle', action='store', type=float,
+                      default=watch.DEFAULT_SETTLE,
+                      help='Only examine a new file once it has gone unchanged for this many seconds '
+                           '(default is %g)' % watch.DEFAULT_SETTLE)
+
+  parser.add_argument('--poll-interval', dest='poll_interval', action='store', type=float,
+                      default=watch.DEFAULT_POLL_INTERVAL,
+                      help='How often the path is checked for new files, when inotify is unavailable '
+                           '(default is %g seconds)' % watch.DEFAULT_POLL_INTERVAL)
+
+  parser.add_argument('--report-interval', dest='report_interval', action='store', type=float,
+                      default=REPORT_INTERVAL,
+                      help='How often the report tables are brought up to date while watching '
+                           '(default is %d seconds)' % REPORT_INTERVAL)
 
   # Path to examine (required)
-  parser.add_argument(dest='path', help='The root directory of the files to examine')
+  parser.add_argument(dest='path', help='The root directory, or container, of the files to examine')
   return parser
 
 
-def main():
-    global g_debug
-    # First the initial argument parsing
-    parser = build_argparser()
-    args = parser.parse_args(sys.argv[1:])
-
-    g_debug     = args.debug
-    db_name     = args.db
-    maxfiles    = args.maxfiles
-    path        = args.path
- 
-    if maxfiles:
-        print_debug("Reading a max of %d files" % maxfiles)
-  
-    # Initialize stored data used for parsing JPEG files
-    init_jpeg(args.enable_skin, args.enable_exif, args.enable_ocr)
-  
+def process_files(db_name, args, shard, prior_db=None):
+    """Processes all of the files under args.path into the database at db_name
+    
+    If prior_db is given, the files that are already in it (or were
+    quarantined in it) are skipped too. It's only read from.
+    """
+    global g_prior_attached
     # Open a connection to the database and create it if necessary
     if g_debug:
         print "Connecting to DB: '%s'" % db_name
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
     create_db(cursor)
+    record_setting(cursor, 'feature_backend', g_backend.name)
+    if prior_db is not None:
+        cursor.execute("ATTACH DATABASE ? AS %s" % PRIOR_DB, (prior_db,))
+        g_prior_attached = True
+    elif args.retry_failures:
+        print "%d files that failed in earlier runs will be examined again" % forget_failures(cursor)
   
     start_time = time.time()
   
     # Get the list of JPEG files to process
-    files = get_file_list(path, maxfiles)
+    files = get_file_list(args.path, args.maxfiles, shard, args.expand_containers)
     print "A list of %d files were retrieved" % len(files)
   
     file_time = time.time() - start_time
@@ -546,44 +1283,423 @@ def main():
     statistics['valid'] = 0
     statistics['invalid'] = 0
     statistics['duplicates'] = 0
+    statistics['failed'] = 0
+    statistics['quarantined'] = 0
     statistics['total size'] = 0
     statistics['valid size'] = 0
     statistics['processing_time'] = 0
+    statistics['processed'] = 0
+
+    global g_metrics
+    g_metrics = metrics.Metrics(len(files))
+    worker = 'shard%d' % shard[0] if shard else 'main'
+    if args.metrics_port:
+        # Each local shard gets its own port
+        port = args.metrics_port + (shard[0] if shard and args.local_shards else 0)
+        metrics.start_server(g_metrics, port, args.metrics_host)
+        print "Serving metrics on http://%s:%d/metrics" % (args.metrics_host, port)
+    # Each process has its own sandbox worker
+    open_sandbox(args)
+
+    time_budget = args.time_budget * 60 if args.time_budget is not None else None
+    schedule = scheduler.Scheduler(files, time_budget, start_time)
+    prefetcher = None
+    if args.prefetch > 0:
+        prefetcher = prefetch.Prefetcher(args.prefetch, args.prefetch_mb * 1024 * 1024)
+    last_commit = time.time()
+    entry = None
     # Process each of them
     try:
-        for i, fname in enumerate(files):
-            print "Processing file %d/%d : %s" % (i+1, len(files), fname)
-            size = os.path.getsize(fname)
+        for i, entry in enumerate(schedule):
+            print_debug("Processing file %d/%d : %s" % (i+1, len(files), entry.name))
+            size = entry.size
             print_debug('Size: %d bytes' % size)
             statistics['total size'] += size
-            result = process_file(cursor, fname)
+            statistics['processed'] += 1
+            file_start = time.time()
+            run_optional = schedule.allow_optional()
+            if prefetcher:
+                prefetcher.prefetch(schedule.upcoming(args.prefetch))
+                g_metrics.set_gauge('prefetch', prefetcher.pending())
+            with g_metrics.working(worker):
+                result, file_id, deferred = process_file(cursor, entry, run_optional, prefetcher)
+            schedule.record(time.time() - file_start, run_optional)
+            if deferred:
+                print_debug("Deferring the optional stages")
+                schedule.defer(file_id, entry)
             if result == "duplicate":
                 statistics['duplicates'] += 1
+                g_metrics.count_file(size, 'duplicate')
+            elif result == "quarantined":
+                statistics['quarantined'] += 1
+                g_metrics.count_file(size, 'quarantined')
+            elif result == "failed":
+                statistics['failed'] += 1
+                g_metrics.count_file(size, 'failed')
             elif result is True:
                 statistics['valid'] += 1
                 statistics['valid size'] += size
-            elif result is False:
-                statistics['invalid'] += 1
+                g_metrics.count_file(size, 'valid')
             else:
-                raise Exception("Unexpected result for %s" % fname)
-            # Periodically commit the database results
-            if i % 100 == 0:
+                statistics['invalid'] += 1
+                g_metrics.count_file(size, 'invalid')
+            g_metrics.set_gauge('pending', schedule.unreached())
+            g_metrics.set_gauge('deferred', len(schedule.deferred))
+            g_metrics.maybe_print_status(args.status_interval)
+            # Periodically commit the database results, so that they can be
+            # examined while the run is still going
+            if i % 100 == 0 or time.time() - last_commit > COMMIT_INTERVAL:
+              conn.commit()
+              if g_cache is not None:
+                g_cache.commit()
+              last_commit = time.time()
+
+        # If there's time left, go back for the optional stages that were skipped
+        for file_id, entry in schedule.iter_deferred():
+            print_debug("Running the deferred optional stages for %s" % entry.name)
+            if prefetcher:
+                prefetcher.prefetch([upcoming for upcoming_id, upcoming in
+                                     schedule.upcoming_deferred(args.prefetch)])
+            with g_metrics.working(worker):
+                try:
+                    data = prefetcher.read(entry) if prefetcher else entry.read()
+                except Exception:
+                    print "Failed to read %s: %s" % (entry.name, sandbox.format_error())
+                    insert_failure_entry(cursor, file_id, entry.name, 'read', sandbox.format_error())
+                    continue
+                process_jpeg_optional(cursor, file_id, entry.name, data)
+            g_metrics.set_gauge('deferred', len(schedule.deferred))
+            g_metrics.maybe_print_status(args.status_interval)
+            if time.time() - last_commit > COMMIT_INTERVAL:
               conn.commit()
+              last_commit = time.time()
     except Exception, e:
-        print "Something bad happened while processing %s!" % fname
+        # Errors from examining a file are recorded as failures, so this is
+        # something like the database itself failing
+        print "Something bad happened while processing %s!" % entry.name
         close_db(conn)
         raise
+    finally:
+        if prefetcher:
+            prefetcher.close()
+        close_sandbox()
+    # Local shards are merged first, which rebuilds the report tables anyway
+    if not args.local_shards:
+        with g_metrics.stage('report'):
+            query.build_views(cursor)
+    # Kept for comparing runs (see compare_results.py)
+    insert_stage_timings(cursor, start_time, worker, g_metrics.snapshot()['stages'])
+    close_db(conn)
+    containers.close_containers()
+    print g_metrics.status_line()
     statistics['processing_time'] = time.time() - file_time - start_time  
+    processed = statistics['processed']
     print "*"*80
     print "Statistics"
-    if files:
-        print "Processed %d files in %0.3f seconds, for an average of %0.3f seconds/file" % (len(files),statistics['processing_time'], statistics['processing_time']/len(files))
+    if schedule.unreached():
+        print "The time budget ran out before %d/%d files were reached" % (schedule.unreached(), len(files))
+    if schedule.deferred:
+        print "The time budget ran out before the optional stages of %d files were run" % len(schedule.deferred)
+    if processed:
+        print "Processed %d files in %0.3f seconds, for an average of %0.3f seconds/file" % (processed,statistics['processing_time'], statistics['processing_time']/processed)
         print "A total of %d bytes were processed. %d bytes of valid data" % (statistics['total size'], statistics['valid size'])
-        print "%d/%d (%0.3f%%) files were duplicates" % (statistics['duplicates'], len(files), statistics['invalid']*100.0/len(files))
-        print "%d/%d (%0.3f%%) files were valid"   % (statistics['valid'], len(files), statistics['valid']*100.0/len(files))
-        print "%d/%d (%0.3f%%) files were invalid" % (statistics['invalid'], len(files), statistics['invalid']*100.0/len(files))
+        print "%d/%d (%0.3f%%) files were duplicates" % (statistics['duplicates'], processed, statistics['invalid']*100.0/processed)
+        print "%d/%d (%0.3f%%) files were valid"   % (statistics['valid'], processed, statistics['valid']*100.0/processed)
+        print "%d/%d (%0.3f%%) files were invalid" % (statistics['invalid'], processed, statistics['invalid']*100.0/processed)
     else:
         print "No files processed!"
+    if statistics['failed']:
+        print "%d files couldn't be examined; see the failures table" % statistics['failed']
+    if statistics['quarantined']:
+        print "%d files were skipped since they failed in an earlier run (use --retry-failures to try them again)" % statistics['quarantined']
+    if g_sandbox.restarts():
+        print "The sandbox worker was restarted %d times (%d timeouts, %d crashes, %d over --max-rss)" % (
+            g_sandbox.restarts(), g_sandbox.killed, g_sandbox.crashed, g_sandbox.retired)
+    cache_hits = g_metrics.snapshot()['counters'].get('cache_hits', 0)
+    if cache_hits:
+        print "%d files were examined in an earlier run, and their cached results were reused" % cache_hits
+
+
+def process_local_shards(db_name, args, count):
+    """Runs count worker processes, each handling one shard of the files, and
+    then merges their databases into db_name
+    
+    The shards check db_name for files from earlier runs, so that duplicates and
+    quarantined files are skipped the same way as in a single process. It isn't
+    written to until they're merged.
+    """
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    create_db(cursor)
+    if args.retry_failures:
+        print "%d files that failed in earlier runs will be examined again" % forget_failures(cursor)
+    close_db(conn)
+
+    shard_dbs = [SHARD_DB_FORMAT % (db_name, index) for index in range(count)]
+    workers = []
+    for index, shard_db in enumerate(shard_dbs):
+        worker = multiprocessing.Process(target=process_files,
+                                         args=(shard_db, args, (index, count), db_name))
+        worker.start()
+        workers.append(worker)
+
+    failed = False
+    for index, worker in enumerate(workers):
+        worker.join()
+        if worker.exitcode != 0:
+            print "Shard %d/%d failed with exit code %d" % (index, count, worker.exitcode)
+            failed = True
+    if failed:
+        print "Not merging; the shard databases were left in place"
+        sys.exit(1)
+
+    merge_results.merge_databases(db_name, shard_dbs)
+    for shard_db in shard_dbs:
+        os.remove(shard_db)
+
+
+def get_file_rows(cursor, tables, file_id):
+    """Returns the rows for a file from each of the per-file tables, as a list of
+    (table, columns, rows), and deletes them. The BLOB columns are returned as
+    str, since buffers can't be passed between processes."""
+    file_rows = []
+    for table in tables:
+        cursor.execute("SELECT * FROM %s WHERE file_id=?" % table, (file_id,))
+        columns = [description[0] for description in cursor.description]
+        rows = [[str(value) if isinstance(value, buffer) else value for value in row]
+                for row in cursor.fetchall()]
+        if rows:
+            file_rows.append((table, columns, rows))
+        cursor.execute("DELETE FROM %s WHERE file_id=?" % table, (file_id,))
+    cursor.execute("DELETE FROM files WHERE id=?", (file_id,))
+    return file_rows
+
+
+def insert_file_rows(cursor, file_id, file_rows):
+    """Inserts the rows from get_file_rows under a new file_id"""
+    for table, columns, rows in file_rows:
+        insert = "INSERT INTO %s (%s) VALUES (%s)" % (table, ', '.join(columns),
+                                                      ', '.join('?' * len(columns)))
+        cursor.executemany(insert, [[file_id if column == 'file_id' else
+                                     buffer(value) if isinstance(value, str) else value
+                                     for column, value in zip(columns, row)]
+                                    for row in rows])
+
+
+def watch_worker(db_name, args, tasks, results, worker):
+    """Examines the files from the tasks queue into a scratch database, and
+    passes the rows back through the results queue. The models were loaded
+    before the worker was started, so they're shared with the parent."""
+    # Ctrl-C is handled by the parent, which lets the workers finish up
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global g_metrics
+    g_metrics = metrics.Metrics()
+    open_sandbox(args)
+    # Files already in the database aren't examined again
+    main_cursor = sqlite3.connect(db_name).cursor()
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    create_db(cursor)
+    tables = merge_results.get_per_file_tables(cursor)
+
+    for fname in iter(tasks.get, None):
+        for entry in list_entries(fname, args.expand_containers):
+            with g_metrics.working(worker):
+                try:
+                    with g_metrics.stage('read'):
+                        data = entry.read()
+                except Exception:
+                    results.put(('read failed', entry.name, entry.size, sandbox.format_error()))
+                    continue
+                with g_metrics.stage('hash'):
+                    md5, sha512 = get_hashes(data)
+                if find_sha512(main_cursor, sha512):
+                    kind = 'quarantined' if is_quarantined(main_cursor, sha512) else 'duplicate'
+                    results.put((kind, entry.name, len(data)))
+                    continue
+                result, file_id, deferred = process_contents(cursor, entry.name, data, md5, sha512)
+                results.put(('file', entry.name, (len(data), md5, sha512), result,
+                             get_file_rows(cursor, tables, file_id)))
+        containers.close_containers()
+
+    close_sandbox()
+    results.put(('timings', worker, g_metrics.snapshot()['stages']))
+
+
+def handle_watch_result(cursor, message, timings):
+    """Records a message from a watch worker. Returns whether a file was added."""
+    kind, name = message[:2]
+    if kind == 'timings':
+        timings[name] = message[2]
+    elif kind == 'read failed':
+        record_read_failure(cursor, name, message[3])
+        g_metrics.count_file(message[2], 'failed')
+    elif kind in ('duplicate', 'quarantined'):
+        print_debug("%s is %s! Skipped!" % (name, 'a duplicate' if kind == 'duplicate' else 'quarantined'))
+        g_metrics.count_file(message[2], kind)
+    else:
+        (size, md5, sha512), result, file_rows = message[2:]
+        # Two workers may have been handed copies of the same file at once
+        if find_sha512(cursor, sha512):
+            g_metrics.count_file(size, 'duplicate')
+            return False
+        file_id = insert_file_entry(cursor, name, size, md5, sha512)
+        insert_file_rows(cursor, file_id, file_rows)
+        clear_read_failure(cursor, name)
+        print_debug("Examined %s" % name)
+        g_metrics.count_file(size, result if result == 'failed' else 'valid' if result is True else 'invalid')
+        return True
+    return False
+
+
+def watch_files(db_name, args):
+    """Examines the files under args.path as they appear, until interrupted.
+    The results are committed as they arrive, and the report tables are
+    updated every args.report_interval seconds."""
+    if g_debug:
+        print "Connecting to DB: '%s'" % db_name
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    create_db(cursor)
+    record_setting(cursor, 'feature_backend', g_backend.name)
+    if args.retry_failures and forget_failures(cursor):
+        # Their rows are gone, so appending to the report tables isn't enough
+        query.build_views(cursor)
+    # The workers check for duplicates against the committed files
+    conn.commit()
+
+    start_time = time.time()
+    global g_metrics
+    g_metrics = metrics.Metrics()
+    if args.metrics_port:
+        metrics.start_server(g_metrics, args.metrics_port, args.metrics_host)
+        print "Serving metrics on http://%s:%d/metrics" % (args.metrics_host, args.metrics_port)
+
+    # A small queue keeps the backlog in this process, where it can be reported
+    tasks = multiprocessing.Queue(args.watch_workers * 2)
+    results = multiprocessing.Queue()
+    workers = []
+    for index in range(args.watch_workers):
+        worker = multiprocessing.Process(target=watch_worker,
+                                         args=(db_name, args, tasks, results, 'watch%d' % index))
+        worker.start()
+        workers.append(worker)
+
+    watcher = watch.Watcher(args.path, args.settle, args.poll_interval)
+    print "Watching %s for new files (%s); press Ctrl-C to stop" % (
+        watcher.root, 'inotify' if watcher.using_inotify() else 'polling')
+    backlog = collections.deque()
+    timings = {}
+    added = 0
+    last_commit = last_report = time.time()
+    # Stopping only between files keeps a file's rows from being half written
+    stop = []
+    def request_stop(signum, frame):
+        stop.append(signum)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    while not stop:
+        backlog.extend(watcher.wait(0.5))
+        while backlog:
+            try:
+                tasks.put_nowait(backlog[0])
+            except Queue.Full:
+                break
+            backlog.popleft()
+        while True:
+            try:
+                message = results.get_nowait()
+            except Queue.Empty:
+                break
+            added += handle_watch_result(cursor, message, timings)
+        g_metrics.set_gauge('pending', len(backlog) + watcher.pending())
+        g_metrics.maybe_print_status(args.status_interval)
+        if time.time() - last_commit > COMMIT_INTERVAL:
+            conn.commit()
+            last_commit = time.time()
+        if added and time.time() - last_report > args.report_interval:
+            with g_metrics.stage('report'):
+                query.update_views(cursor)
+            conn.commit()
+            added = 0
+            last_report = time.time()
+    print "Stopping once the files that were handed out are examined"
+
+    # Files that hadn't been handed out are picked up by the next run
+    for worker in workers:
+        tasks.put(None)
+    # The results have to be drained for the workers to exit
+    while len(timings) < len(workers):
+        try:
+            message = results.get(timeout=1)
+        except Queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        handle_watch_result(cursor, message, timings)
+    for worker in workers:
+        worker.join()
+
+    with g_metrics.stage('report'):
+        query.update_views(cursor)
+    for worker, stages in sorted(timings.items()):
+        insert_stage_timings(cursor, start_time, worker, stages)
+    close_db(conn)
+    print g_metrics.status_line()
+    failed = g_metrics.snapshot()['counters'].get('failed', 0)
+    if failed:
+        print "%d files couldn't be examined; see the failures table" % failed
+
+
+def main():
+    global g_debug
+    # Combining shard databases is handled by its own tool
+    if sys.argv[1:2] == ['merge']:
+        return merge_results.main(sys.argv[2:])
+    # As is exporting the results for analysis
+    if sys.argv[1:2] == ['export']:
+        return export_results.main(sys.argv[2:])
+    # And comparing two runs
+    if sys.argv[1:2] == ['compare']:
+        return compare_results.main(sys.argv[2:])
+
+    # First the initial argument parsing
+    parser = build_argparser()
+    args = parser.parse_args(sys.argv[1:])
+
+    g_debug     = args.debug
+    db_name     = args.db
+    maxfiles    = args.maxfiles
+ 
+    if maxfiles:
+        print_debug("Reading a max of %d files" % maxfiles)
+
+    # Set before any workers are forked, so that they read carves the same way
+    containers.set_carve_extensions(args.carve_extensions)
+
+    if args.shard and args.local_shards:
+        parser.error("--shard and --local-shards can't be combined")
+    if args.watch and (args.shard or args.local_shards or args.time_budget):
+        parser.error("--watch can't be combined with --shard, --local-shards, or --time-budget")
+  
+    # Initialize stored data used for parsing JPEG files
+    try:
+        init_jpeg(args.enable_skin, args.enable_exif, args.enable_ocr, args.features)
+    except features.BackendUnavailable, e:
+        parser.error(str(e))
+
+    # The semaphore is created before any shards are started, so they share it
+    global g_memory
+    slots = multiprocessing.BoundedSemaphore(args.max_inflight) if args.max_inflight else None
+    max_rss = args.max_rss * 1024 * 1024 if args.max_rss else None
+    g_memory = memory.MemoryGovernor(args.max_pixels, max_rss, slots)
+
+    if args.watch:
+        watch_files(db_name, args)
+    elif args.local_shards:
+        process_local_shards(db_name, args, args.local_shards)
+    else:
+        process_files(db_name, args, args.shard)
 
 if __name__ == "__main__":
     main()
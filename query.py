@@ -0,0 +1,443 @@
+"""
+Query layer for the results database.
+
+The join of the files and jpeg tables is materialized into report tables
+after each ingest, with indexes on the columns that reports sort and filter
+by, a full-text (FTS5) index over the OCRed text and camera model, and an
+R*Tree index over the GPS locations. Reports are then built from composable,
+parameterized filters:
+
+  results = Query().min_faces(1).within_radius(40.7, -74.0, 5).limit(100).run(cursor)
+"""
+
+import math
+import calendar
+import datetime
+
+###############################################################################
+# Report tables
+###############################################################################
+
+# Tables whose names start with this are derived from the others, and can be
+# rebuilt at any time
+REPORT_PREFIX = 'report_'
+
+DROP_REPORT_QUERIES = [
+    '''DROP TABLE IF EXISTS report_location''',
+    '''DROP TABLE IF EXISTS report_text''',
+    '''DROP TABLE IF EXISTS report_files''',
+    '''DROP TABLE IF EXISTS report_info''',
+]
+
+CREATE_REPORT_FILES_QUERY = '''
+    CREATE TABLE report_files (
+        file_id           INTEGER PRIMARY KEY,
+        filename          TEXT,
+        sha512            TEXT,
+        is_solid          BOOLEAN,
+        faces             INTEGER,
+        screenshot        BOOLEAN,
+        screenshot_fname  TEXT,
+        cc                BOOLEAN,
+        cc_fname          TEXT,
+        id                BOOLEAN,
+        id_fname          TEXT,
+        contains_skin     BOOLEAN,
+        skin_type         TEXT,
+        gps_data          TEXT,
+        date_data         TEXT,
+        model_data        TEXT,
+        ocr_text          TEXT,
+        latitude          REAL,
+        longitude         REAL,
+        timestamp         INTEGER,
+        screenshot_confidence REAL
+    )'''
+
+# Bumped whenever the report tables change, so that older ones are rebuilt
+REPORT_VERSION = 3
+
+# Columns that are missing from the jpeg table of older databases
+TYPED_COLUMNS = ['latitude', 'longitude', 'timestamp', 'screenshot_confidence']
+
+# Only the well-formed images are ever reported on. The columns are named the
+# same as in report_files, so that it can also be queried directly.
+SELECT_REPORT_FILES_QUERY = '''
+    SELECT files.id AS file_id, files.filename AS filename, files.sha512 AS sha512, is_solid,
+        faces, screenshot, screenshot_fname, cc, cc_fname, jpeg.id AS id, id_fname, contains_skin,
+        skin_type, gps_data, date_data, CAST(model_data AS TEXT) AS model_data,
+        CAST(ocr_text AS TEXT) AS ocr_text, %(typed_columns)s
+    FROM jpeg JOIN files
+        ON files.id = jpeg.file_id
+    WHERE well_formed = 1'''
+
+FILL_REPORT_FILES_QUERY = '''
+    INSERT INTO report_files''' + SELECT_REPORT_FILES_QUERY
+
+REPORT_INDEXES = ['faces', 'screenshot', 'cc', 'id', 'date_data', 'timestamp']
+
+CREATE_REPORT_INDEX_QUERY = '''CREATE INDEX report_files_%(column)s ON report_files (%(column)s)'''
+
+CREATE_REPORT_TEXT_QUERY = '''CREATE VIRTUAL TABLE report_text USING fts5
+    (model_data, ocr_text, content='report_files', content_rowid='file_id')'''
+
+FILL_REPORT_TEXT_QUERY = '''INSERT INTO report_text (report_text) VALUES ('rebuild')'''
+
+# Indexes the text of rows that were added to report_files
+UPDATE_REPORT_TEXT_QUERY = '''INSERT INTO report_text (rowid, model_data, ocr_text)
+    SELECT file_id, model_data, ocr_text FROM report_files WHERE file_id > ?'''
+
+# Each photo is a point, so the boxes have no area
+CREATE_REPORT_LOCATION_QUERY = '''CREATE VIRTUAL TABLE report_location USING rtree
+    (file_id, min_lat, max_lat, min_lon, max_lon)'''
+
+FILL_REPORT_LOCATION_QUERY = '''INSERT INTO report_location
+    SELECT file_id, latitude, latitude, longitude, longitude FROM report_files
+    WHERE latitude IS NOT NULL AND longitude IS NOT NULL'''
+
+CREATE_REPORT_INFO_QUERY = '''CREATE TABLE report_info (key TEXT PRIMARY KEY, value)'''
+
+INSERT_REPORT_INFO_QUERY = '''INSERT OR REPLACE INTO report_info (key, value) VALUES (?, ?)'''
+
+SELECT_REPORT_INFO_QUERY = '''SELECT key, value FROM report_info'''
+
+# Identifies the state of the source tables that the report tables reflect
+SELECT_SOURCE_STATE_QUERY = '''SELECT COUNT(*), COALESCE(MAX(file_id), 0) FROM jpeg'''
+
+SELECT_LAST_REPORTED_QUERY = '''SELECT COALESCE(MAX(file_id), 0) FROM report_files'''
+
+
+def has_module(cursor, module, columns):
+    """Returns whether this SQLite was built with a virtual table module"""
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp.module_check USING %s (%s)" % (module, columns))
+        cursor.execute("DROP TABLE temp.module_check")
+        return True
+    except Exception:
+        return False
+
+
+def has_fts5(cursor):
+    return has_module(cursor, 'fts5', 'value')
+
+
+def has_rtree(cursor):
+    return has_module(cursor, 'rtree', 'id, min_x, max_x')
+
+
+def get_report_info(cursor):
+    """Returns the report_info as a dictionary, or None if there are no report tables"""
+    try:
+        cursor.execute(SELECT_REPORT_INFO_QUERY)
+    except Exception:
+        return None
+    return dict(cursor.fetchall())
+
+
+def get_source_state(cursor):
+    cursor.execute(SELECT_SOURCE_STATE_QUERY)
+    return '%d:%d' % cursor.fetchone()
+
+
+def get_typed_columns(cursor):
+    """Returns the typed columns to select from the jpeg table. Databases from
+    before they were added still have the text ones."""
+    cursor.execute("PRAGMA table_info(jpeg)")
+    existing = [row[1] for row in cursor.fetchall()]
+    return ', '.join(column if column in existing else 'NULL AS %s' % column for column in TYPED_COLUMNS)
+
+
+def build_views(cursor):
+    """(Re)builds all of the report tables from the files and jpeg tables"""
+    for query in DROP_REPORT_QUERIES:
+        cursor.execute(query)
+    cursor.execute(CREATE_REPORT_FILES_QUERY)
+    cursor.execute(FILL_REPORT_FILES_QUERY % {'typed_columns': get_typed_columns(cursor)})
+    # Creating the indexes after the rows are in is much faster
+    for column in REPORT_INDEXES:
+        cursor.execute(CREATE_REPORT_INDEX_QUERY % {'column': column})
+
+    fts = has_fts5(cursor)
+    if fts:
+        cursor.execute(CREATE_REPORT_TEXT_QUERY)
+        cursor.execute(FILL_REPORT_TEXT_QUERY)
+
+    rtree = has_rtree(cursor)
+    if rtree:
+        cursor.execute(CREATE_REPORT_LOCATION_QUERY)
+        cursor.execute(FILL_REPORT_LOCATION_QUERY)
+
+    cursor.execute(CREATE_REPORT_INFO_QUERY)
+    cursor.execute(INSERT_REPORT_INFO_QUERY, ('version', REPORT_VERSION))
+    cursor.execute(INSERT_REPORT_INFO_QUERY, ('source_state', get_source_state(cursor)))
+    cursor.execute(INSERT_REPORT_INFO_QUERY, ('fts', int(fts)))
+    cursor.execute(INSERT_REPORT_INFO_QUERY, ('rtree', int(rtree)))
+
+
+def update_views(cursor):
+    """Adds the images that were examined since the report tables were last
+    updated, instead of rebuilding them. Only new files are picked up, so
+    this rebuilds them if they're missing or from an older version."""
+    info = get_report_info(cursor)
+    if info is None or info.get('version') != REPORT_VERSION:
+        build_views(cursor)
+        return
+    cursor.execute(SELECT_LAST_REPORTED_QUERY)
+    last = cursor.fetchone()[0]
+    cursor.execute(FILL_REPORT_FILES_QUERY % {'typed_columns': get_typed_columns(cursor)} +
+                   ' AND files.id > ?', (last,))
+    if info.get('fts'):
+        cursor.execute(UPDATE_REPORT_TEXT_QUERY, (last,))
+    if info.get('rtree'):
+        cursor.execute(FILL_REPORT_LOCATION_QUERY + ' AND file_id > ?', (last,))
+    cursor.execute(INSERT_REPORT_INFO_QUERY, ('source_state', get_source_state(cursor)))
+
+
+def views_are_current(cursor, info=None):
+    """Returns whether the report tables reflect the source tables. They're
+    out of date while an ingest is running, until it updates them at the end."""
+    if info is None:
+        info = get_report_info(cursor)
+    return (info is not None and info.get('version') == REPORT_VERSION and
+            info.get('source_state') == get_source_state(cursor))
+
+
+def ensure_views(cursor):
+    """Builds the report tables, unless they're already up to date"""
+    if not views_are_current(cursor):
+        build_views(cursor)
+        return True
+    return False
+
+###############################################################################
+# Queries
+###############################################################################
+
+RESULT_FIELDS = ['filename', 'faces', 'screenshot', 'screenshot_fname', 'cc', 'cc_fname',
+                 'jpeg.id', 'id_fname', 'contains_skin', 'skin_type', 'gps_data', 'date_data',
+                 'model_data', 'ocr_text', 'file_id', 'latitude', 'longitude', 'timestamp',
+                 'screenshot_confidence']
+
+SELECT_RESULTS_QUERY = '''SELECT filename, faces, screenshot, screenshot_fname, cc, cc_fname,
+    id, id_fname, contains_skin, skin_type, gps_data, date_data, model_data, ocr_text,
+    file_id, latitude, longitude, timestamp, screenshot_confidence
+    FROM %s'''
+
+ORDER_COLUMNS = {
+    'faces': 'faces',
+    'cc': 'cc',
+    'id': 'id',
+    'screenshot': 'screenshot',
+    'date': 'timestamp',
+}
+
+# The columns that can be searched for text
+TEXT_COLUMNS = ('ocr_text', 'model_data')
+
+
+# Mean radius of the Earth
+EARTH_RADIUS_KM = 6371.0
+
+# Length of a degree of latitude
+KM_PER_DEGREE = 111.32
+
+
+def to_timestamp(value, end_of_day=False):
+    """Converts a YYYY-MM-DD[ HH:MM[:SS]] date into seconds since the epoch (UTC,
+    like the stored EXIF dates). A bare date is the start of the day, or the
+    end of the day if end_of_day is set."""
+    value = value.strip().replace('T', ' ')
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            date = datetime.datetime.strptime(value, date_format)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError("Can't parse the date '%s', use YYYY-MM-DD [HH:MM:SS]" % value)
+    timestamp = calendar.timegm(date.timetuple())
+    if end_of_day and date_format == '%Y-%m-%d':
+        timestamp += 24 * 60 * 60 - 1
+    return timestamp
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Returns the great-circle (haversine) distance between two points"""
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    lat1, lon1, lat2, lon2 = [math.radians(value) for value in (lat1, lon1, lat2, lon2)]
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lon, radius_km):
+    """Returns the (min_lat, min_lon, max_lat, max_lon) around a circle"""
+    lat_delta = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat < 1e-6 or abs(lat) + lat_delta >= 90:
+        # Near a pole, every longitude is close by
+        lon_delta = 180.0
+    else:
+        lon_delta = radius_km / (KM_PER_DEGREE * cos_lat)
+    if lon - lon_delta < -180 or lon + lon_delta > 180:
+        # The box would wrap around the antimeridian
+        return lat - lat_delta, -180.0, lat + lat_delta, 180.0
+    return lat - lat_delta, lon - lon_delta, lat + lat_delta, lon + lon_delta
+
+
+class Query(object):
+    """A composable query over the report tables. Each filter returns the
+    query, so that they can be chained."""
+
+    def __init__(self):
+        self.conditions = []
+        self.params = []
+        self.order_column = None
+        self.max_results = None
+        self.use_fts = True
+        self.use_rtree = True
+        # The table (or subquery) that the results are selected from
+        self.source = 'report_files'
+
+    def where(self, condition, *params):
+        """Adds an arbitrary condition, with ? placeholders for the params"""
+        self.conditions.append(condition)
+        self.params.extend(params)
+        return self
+
+    def min_faces(self, count):
+        return self.where('faces >= ?', count)
+
+    def not_solid(self):
+        return self.where('is_solid = 0')
+
+    def has_gps(self):
+        return self.where('latitude IS NOT NULL AND longitude IS NOT NULL')
+
+    def date_range(self, start=None, end=None):
+        """Filters on the EXIF date, given as YYYY-MM-DD[ HH:MM:SS]. Either end
+        may be None for an open range. A bare end date includes the whole day."""
+        return self.time_window(to_timestamp(start) if start else None,
+                                to_timestamp(end, end_of_day=True) if end else None)
+
+    def time_window(self, start=None, end=None):
+        """Filters on the EXIF date, given as seconds since the epoch"""
+        if start is not None:
+            self.where('timestamp >= ?', start)
+        if end is not None:
+            self.where('timestamp <= ?', end)
+        return self
+
+    def within_box(self, min_lat, min_lon, max_lat, max_lon):
+        """Filters on the GPS location falling within a bounding box"""
+        if self.use_rtree:
+            return self.where('''file_id IN (SELECT file_id FROM report_location
+                WHERE min_lat >= ? AND max_lat <= ? AND min_lon >= ? AND max_lon <= ?)''',
+                min_lat, max_lat, min_lon, max_lon)
+        return self.where('latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?',
+                          min_lat, max_lat, min_lon, max_lon)
+
+    def within_radius(self, lat, lon, radius_km):
+        """Filters on the GPS location being within radius_km of a point"""
+        # The box narrows it down using the index, then the exact distance is checked
+        self.within_box(*bounding_box(lat, lon, radius_km))
+        return self.where('distance_km(latitude, longitude, ?, ?) <= ?', lat, lon, radius_km)
+
+    def camera_model(self, term):
+        return self.text_contains(term, 'model_data')
+
+    def ocr_contains(self, term):
+        return self.text_contains(term, 'ocr_text')
+
+    def text_contains(self, term, column):
+        if column not in TEXT_COLUMNS:
+            raise ValueError("Can't search the text of %s" % column)
+        if self.use_fts:
+            phrase = '"%s"' % term.replace('"', '""')
+            return self.where('file_id IN (SELECT rowid FROM report_text WHERE report_text MATCH ?)',
+                              '%s : %s' % (column, phrase))
+        return self.where('%s LIKE ?' % column, '%' + term + '%')
+
+    def order_by(self, name):
+        self.order_column = ORDER_COLUMNS[name]
+        return self
+
+    def limit(self, count):
+        self.max_results = count
+        return self
+
+    def build(self):
+        """Returns the (sql, params) for the query"""
+        sql = SELECT_RESULTS_QUERY % self.source
+        params = list(self.params)
+        if self.conditions:
+            sql += '\n    WHERE ' + ' AND '.join('(%s)' % cond for cond in self.conditions)
+        if self.order_column:
+            sql += '\n    ORDER BY %s DESC' % self.order_column
+        if self.max_results:
+            sql += '\n    LIMIT ?'
+            params.append(self.max_results)
+        return sql, params
+
+    def run(self, cursor):
+        """Runs the query, returning a list of dictionaries"""
+        sql, params = self.build()
+        cursor.connection.create_function('distance_km', 4, distance_km)
+        cursor.execute(sql, params)
+        return [dict(zip(RESULT_FIELDS, row)) for row in cursor.fetchall()]
+
+
+def new_query(cursor):
+    """Returns a Query that matches how the report tables were built. If
+    they're out of date, it reads from the source tables instead, without the
+    text and location indexes, so that nothing is written to the database."""
+    query = Query()
+    info = get_report_info(cursor)
+    if not views_are_current(cursor, info):
+        query.source = '(%s)' % (SELECT_REPORT_FILES_QUERY % {'typed_columns': get_typed_columns(cursor)})
+        query.use_fts = query.use_rtree = False
+        return query
+    query.use_fts = bool(info.get('fts'))
+    query.use_rtree = bool(info.get('rtree'))
+    return query
+
+###############################################################################
+# Clustering
+###############################################################################
+
+def cluster_results(results, radius_km=1.0, window_seconds=3 * 60 * 60):
+    """Groups results that were taken close together, in both location and time.
+
+    The results are walked in time order, and each joins the current cluster
+    if it was taken within window_seconds of the cluster's last photo and
+    within radius_km of the cluster's center. Results without a location or
+    a date aren't clustered. Returns a list of dictionaries, from the largest
+    cluster to the smallest.
+    """
+    located = [result for result in results
+               if result['latitude'] is not None and result['longitude'] is not None
+               and result['timestamp'] is not None]
+    located.sort(key=lambda result: result['timestamp'])
+
+    clusters = []
+    current = None
+    for result in located:
+        if current is not None:
+            distance = distance_km(current['latitude'], current['longitude'],
+                                   result['latitude'], result['longitude'])
+            if (result['timestamp'] - current['end'] > window_seconds or distance > radius_km):
+                current = None
+        if current is None:
+            current = {'latitude': result['latitude'], 'longitude': result['longitude'],
+                       'start': result['timestamp'], 'end': result['timestamp'], 'results': []}
+            clusters.append(current)
+        current['results'].append(result)
+        current['end'] = result['timestamp']
+        # Keep the center at the mean of the members
+        count = len(current['results'])
+        current['latitude'] += (result['latitude'] - current['latitude']) / count
+        current['longitude'] += (result['longitude'] - current['longitude']) / count
+
+    clusters.sort(key=lambda cluster: -len(cluster['results']))
+    return clusters
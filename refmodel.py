@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+'''
+Reference model of the template images (desktop icons, credit cards, IDs) that
+files are matched against.
+
+Instead of every worker process holding its own copy of the template images
+and their keypoints, the descriptors and keypoints of every template are
+packed into contiguous float32 arrays and saved as .npy files. Workers
+memory-map them read-only, so every process shares the same pages.
+
+Each feature backend (see features.py) has its own model, in a subdirectory
+named after it. A model is rebuilt whenever the templates or the detector
+change. Each build is written into its own directory and then published by replacing the
+CURRENT file, so running workers pick up new templates on their next refresh
+without being restarted.
+
+USAGE
+  refmodel.py [<model dir>] [<backend>]   (Rebuilds the model from the template dirs)
+'''
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+import numpy
+import cv2
+
+# local
+import features
+
+
+DEFAULT_MODEL_DIR = './reference_model'
+
+# The template directory for each group
+DEFAULT_GROUPS = {
+    'icon': './common_desktop_icons',
+    'cc': './cc_images',
+    'id': './id_images',
+}
+
+# How many templates of a group must match, beyond the first, for an image to
+# be in the group. Desktop icons turn up in all sorts of images, so it takes
+# three of them.
+MIN_MATCHES = {'icon': 2}
+
+# The file naming the build that's currently in use
+CURRENT_FILE = 'CURRENT'
+
+# Held while a build is published, so that builders don't remove each other's
+LOCK_FILE = 'publish.lock'
+
+MANIFEST_FILE = 'manifest.json'
+DESCRIPTORS_FILE = 'descriptors.npy'
+KEYPOINTS_FILE = 'keypoints.npy'
+
+# How often workers check for a new build, in seconds
+REFRESH_INTERVAL = 30
+
+
+###############################################################################
+# Building
+###############################################################################
+
+def list_templates(groups):
+    """Returns a sorted list of (group, filename) for every template"""
+    templates = []
+    for group, dirname in sorted(groups.items()):
+        for entry in sorted(os.listdir(dirname)):
+            fname = os.path.join(dirname, entry)
+            if os.path.isfile(fname):
+                templates.append((group, fname))
+    return templates
+
+
+def source_signature(groups, backend):
+    """Returns a hash of the templates' names, sizes, and modification times,
+    along with the detector configuration"""
+    digest = hashlib.sha1(json.dumps(backend.config(), sort_keys=True))
+    for group, fname in list_templates(groups):
+        stat = os.stat(fname)
+        digest.update('%s\0%s\0%d\0%d\n' % (group, fname, stat.st_size, int(stat.st_mtime)))
+    return digest.hexdigest()
+
+
+def build_model(model_dir, groups, backend):
+    """Computes the features of every template and publishes them as a new build"""
+    detector = backend.create_detector()
+    templates = []
+    all_desc = []
+    all_kp = []
+    start = 0
+    for group, fname in list_templates(groups):
+        img = cv2.imread(fname)
+        if img is None:
+            continue
+        kp, desc = detector.detectAndCompute(img, None)
+        count = len(kp) if desc is not None else 0
+        if count:
+            all_desc.append(numpy.asarray(desc, backend.dtype))
+            all_kp.append(numpy.float32([(k.pt[0], k.pt[1], k.size, k.angle) for k in kp]))
+        templates.append({'group': group, 'name': fname, 'start': start, 'count': count})
+        start += count
+
+    desc_size = detector.descriptorSize()
+    descriptors = numpy.vstack(all_desc) if all_desc else numpy.zeros((0, desc_size), backend.dtype)
+    keypoints = numpy.vstack(all_kp) if all_kp else numpy.zeros((0, 4), numpy.float32)
+
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    build_dir = tempfile.mkdtemp(prefix='build-', dir=model_dir)
+    numpy.save(os.path.join(build_dir, DESCRIPTORS_FILE), descriptors)
+    numpy.save(os.path.join(build_dir, KEYPOINTS_FILE), keypoints)
+    manifest = {'signature': source_signature(groups, backend),
+                'config': backend.config(),
+                'templates': templates}
+    with open(os.path.join(build_dir, MANIFEST_FILE), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    publish_build(model_dir, os.path.basename(build_dir))
+    return build_dir
+
+
+def publish_build(model_dir, build_name):
+    """Atomically points CURRENT at a build, and removes the builds that are
+    older than the one it replaced. Newer builds may still be being written by
+    another process, so they're left alone. Workers that still have an older
+    build mapped keep their mapping."""
+    with open(os.path.join(model_dir, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            replaced = current_build(model_dir)
+            tmp_fname = os.path.join(model_dir, CURRENT_FILE + '.tmp')
+            with open(tmp_fname, 'w') as fh:
+                fh.write(build_name)
+            os.rename(tmp_fname, os.path.join(model_dir, CURRENT_FILE))
+            remove_builds_before(model_dir, replaced, keep=build_name)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def remove_builds_before(model_dir, build_name, keep):
+    """Removes the builds (other than keep) created before build_name"""
+    if build_name is None or build_name == keep:
+        return
+    try:
+        cutoff = os.path.getmtime(os.path.join(model_dir, build_name))
+    except OSError:
+        return
+    for entry in os.listdir(model_dir):
+        if not entry.startswith('build-') or entry in (build_name, keep):
+            continue
+        path = os.path.join(model_dir, entry)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def current_build(model_dir):
+    """Returns the name of the current build, or None if there isn't one"""
+    try:
+        with open(os.path.join(model_dir, CURRENT_FILE)) as fh:
+            return fh.read().strip()
+    except IOError:
+        return None
+
+###############################################################################
+# Loading
+###############################################################################
+
+class ReferenceModel(object):
+    """Read-only, memory-mapped template features, grouped by template group"""
+
+    def __init__(self, model_dir=DEFAULT_MODEL_DIR, groups=None, backend=None):
+        self.backend = backend if backend is not None else features.get_backend()
+        self.model_dir = os.path.join(model_dir, self.backend.name)
+        self.groups = groups if groups is not None else DEFAULT_GROUPS
+        self.build = None
+        self.last_check = 0
+        self.load()
+
+    def load(self):
+        """Maps the current build, building it first if it's missing or stale"""
+        build = current_build(self.model_dir)
+        manifest = self._read_manifest(build)
+        if manifest is None or manifest['signature'] != source_signature(self.groups, self.backend):
+            build = os.path.basename(build_model(self.model_dir, self.groups, self.backend))
+            manifest = self._read_manifest(build)
+        self._attach(build, manifest)
+
+    def _read_manifest(self, build):
+        if build is None:
+            return None
+        try:
+            with open(os.path.join(self.model_dir, build, MANIFEST_FILE)) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def _attach(self, build, manifest):
+        build_dir = os.path.join(self.model_dir, build)
+        self.descriptors = numpy.load(os.path.join(build_dir, DESCRIPTORS_FILE), mmap_mode='r')
+        self.keypoints = numpy.load(os.path.join(build_dir, KEYPOINTS_FILE), mmap_mode='r')
+        self.templates = manifest['templates']
+        self.signature = manifest['signature']
+        # The templates are sorted by group, so each group is a single range
+        self.group_ranges = {}
+        for template in self.templates:
+            start, end = template['start'], template['start'] + template['count']
+            first, last = self.group_ranges.get(template['group'], (start, end))
+            self.group_ranges[template['group']] = (min(first, start), max(last, end))
+        self.build = build
+        self.last_check = time.time()
+
+    def refresh(self):
+        """Switches to a newer build, if one was published. Checks at most
+        once every REFRESH_INTERVAL seconds."""
+        if time.time() - self.last_check < REFRESH_INTERVAL:
+            return False
+        self.last_check = time.time()
+        build = current_build(self.model_dir)
+        if build is None or build == self.build:
+            return False
+        manifest = self._read_manifest(build)
+        if manifest is None:
+            return False
+        self._attach(build, manifest)
+        return True
+
+    def count_matches(self, matcher, group):
+        """Yields (name, good matches) for each template in a group, against an
+        image's matcher (see features.train_matcher). The whole group is
+        matched at once, rather than a template at a time."""
+        if group not in self.group_ranges:
+            return
+        group_start, group_end = self.group_ranges[group]
+        good = features.good_matches(matcher, numpy.asarray(self.descriptors[group_start:group_end]))
+        for template in self.templates:
+            if template['group'] != group:
+                continue
+            start = template['start'] - group_start
+            yield template['name'], int(good[start:start + template['count']].sum())
+
+    def within_group(self, matcher, group):
+        """Returns whether an image is in a group, and the name of the template
+        that decided it ('' if it isn't). It takes more than MIN_MATCHES of the
+        group's templates to match."""
+        if matcher is None:
+            return False, ''
+        minmatches = MIN_MATCHES.get(group, 0)
+        count = 0
+        for name, matches in self.count_matches(matcher, group):
+            if matches > 0:
+                count += 1
+            if count > minmatches:
+                return True, name
+        return False, ''
+
+###############################################################################
+# Test Main
+###############################################################################
+
+if __name__ == '__main__':
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_MODEL_DIR
+    backend = features.get_backend(sys.argv[2] if len(sys.argv) > 2 else features.DEFAULT_BACKEND)
+    build_dir = build_model(os.path.join(model_dir, backend.name), DEFAULT_GROUPS, backend)
+    model = ReferenceModel(model_dir, DEFAULT_GROUPS, backend)
+    print "Built %s: %d templates, %d descriptors" % (build_dir, len(model.templates), len(model.descriptors))
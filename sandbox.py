@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+'''
+Runs the work on each file in a separate worker process, so that a file which
+crashes or hangs the native code (OpenCV, SURF, Tesseract) on malformed data
+only costs that one file, and not the whole run.
+
+The worker is forked from the parent, so it starts out with everything that
+was already loaded (such as the cascades and the reference model). The parent
+acts as a watchdog: a call that takes longer than the timeout has its worker
+killed, and a worker that dies is replaced before the next call. Either way,
+the call raises WorkerFailure with the stage that the worker was in. A worker
+can also retire itself, such as when it's holding on to too much memory, and
+is replaced once the call returns.
+
+USAGE
+  sandbox.py   (Runs calls that succeed, fail, hang, crash, and retire)
+'''
+
+import os
+import sys
+import time
+import signal
+import traceback
+import multiprocessing
+
+# The longest a single call may take, in seconds
+DEFAULT_TIMEOUT = 120
+
+# Longest stage name that's reported
+MAX_STAGE_LEN = 64
+
+# How long a worker gets to exit cleanly before it's killed
+EXIT_TIMEOUT = 5
+
+
+class WorkerFailure(Exception):
+    """A call that raised an exception, timed out, or crashed its worker"""
+
+    def __init__(self, stage, error):
+        Exception.__init__(self, '%s: %s' % (stage or 'unknown', error))
+        self.stage = stage or 'unknown'
+        self.error = error
+
+
+def describe_exit(exitcode):
+    """Describes how a worker process exited"""
+    if exitcode is None:
+        return 'stopped responding'
+    if exitcode < 0:
+        names = dict((getattr(signal, name), name) for name in dir(signal)
+                     if name.startswith('SIG') and not name.startswith('SIG_'))
+        return 'crashed (%s)' % names.get(-exitcode, 'signal %d' % -exitcode)
+    return 'exited with code %d' % exitcode
+
+
+class Sandbox(object):
+    """Runs functions in a worker process that's restarted when it dies or
+    takes too long
+
+    init    - called in each new worker before any calls, such as to open
+              connections that can't be shared with the parent
+    finish  - called in a worker when it's closed cleanly
+    cleanup - called in the parent after a worker was killed or died, to undo
+              anything that the worker couldn't (such as held semaphores)
+    timeout - the most seconds a call may take, or None for no limit
+    isolate - if False, calls run in this process instead, with exceptions
+              still raised as WorkerFailure but no timeout
+    """
+
+    def __init__(self, init=None, finish=None, cleanup=None, timeout=DEFAULT_TIMEOUT, isolate=True):
+        self.init = init
+        self.finish = finish
+        self.cleanup = cleanup
+        self.timeout = timeout
+        self.isolate = isolate
+        # Written by the worker, so that the parent knows where it failed
+        self.stage = multiprocessing.Array('c', MAX_STAGE_LEN, lock=False)
+        self.process = None
+        self.conn = None
+        self.started = 0
+        self.killed = 0
+        self.crashed = 0
+        self.retired = 0
+        # Set within the worker by retire()
+        self.retiring = False
+
+    def set_stage(self, name):
+        """Records the stage that's running, from within the worker"""
+        self.stage.value = name[:MAX_STAGE_LEN - 1]
+
+    def retire(self):
+        """From within the worker, has it exit once the current call returns, so
+        that the next call starts in a new worker"""
+        self.retiring = True
+
+    def start(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self._serve, args=(child_conn, parent_conn))
+        self.process.daemon = True
+        self.process.start()
+        # The worker holds the only other end, so its exit is seen as EOF
+        child_conn.close()
+        self.conn = parent_conn
+        self.started += 1
+
+    def _serve(self, conn, parent_conn):
+        """The worker's loop"""
+        parent_conn.close()
+        # Ctrl-C is handled by the parent, which stops the worker itself
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.init is not None:
+            self.init()
+        for func, args in iter(conn.recv, None):
+            self.set_stage('')
+            try:
+                reply = (True, func(*args), self.retiring)
+            except Exception:
+                reply = (False, format_error(), self.retiring)
+            conn.send(reply)
+            if self.retiring:
+                break
+        if self.finish is not None:
+            self.finish()
+
+    def call(self, func, *args):
+        """Returns func(*args), as run by the worker. Raises WorkerFailure if it
+        raised an exception, timed out, or crashed the worker."""
+        if not self.isolate:
+            self.set_stage('')
+            # There's no worker to replace
+            self.retiring = False
+            try:
+                return func(*args)
+            except Exception:
+                raise WorkerFailure(self.stage.value, format_error())
+
+        if self.process is None or not self.process.is_alive():
+            self.start()
+        try:
+            self.conn.send((func, args))
+            # A crash also makes the pipe readable, as EOF
+            if not self.conn.poll(self.timeout):
+                stage = self.stage.value
+                self.kill()
+                self.killed += 1
+                raise WorkerFailure(stage, 'timed out after %g seconds' % self.timeout)
+            success, result, retiring = self.conn.recv()
+        except (EOFError, IOError):
+            stage = self.stage.value
+            self.process.join()
+            error = describe_exit(self.process.exitcode)
+            self.discard()
+            self.crashed += 1
+            raise WorkerFailure(stage, error)
+        if retiring:
+            self.close()
+            self.retired += 1
+        if not success:
+            raise WorkerFailure(self.stage.value, result)
+        return result
+
+    def kill(self):
+        """Stops the worker immediately"""
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+        self.process.join()
+        self.discard()
+
+    def discard(self):
+        """Forgets the worker once it has exited"""
+        self.conn.close()
+        self.process = None
+        self.conn = None
+        if self.cleanup is not None:
+            self.cleanup()
+
+    def restarts(self):
+        return max(0, self.started - 1)
+
+    def close(self):
+        """Lets the worker exit cleanly, killing it if it doesn't"""
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.process.join(EXIT_TIMEOUT)
+        self.kill()
+
+
+def format_error():
+    """Returns the current exception as a single line"""
+    exc_type, exc_value = sys.exc_info()[:2]
+    return ''.join(traceback.format_exception_only(exc_type, exc_value)).strip()
+
+###############################################################################
+# Test Main
+###############################################################################
+
+def sleep_for(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def crash():
+    os.kill(os.getpid(), signal.SIGSEGV)
+
+
+def retire():
+    g_test_sandbox.retire()
+    return os.getpid()
+
+
+if __name__ == '__main__':
+    sandbox = g_test_sandbox = Sandbox(timeout=1)
+    start = time.time()
+    for func, args in [(sleep_for, (0.1,)), (fail, ('bad data',)), (sleep_for, (5,)),
+                       (crash, ()), (sleep_for, (0.1,)), (retire, ()), (retire, ())]:
+        try:
+            print "%s%r: %r" % (func.__name__, args, sandbox.call(func, *args))
+        except WorkerFailure, e:
+            print "%s%r: failed in %s: %s" % (func.__name__, args, e.stage, e.error)
+    sandbox.close()
+    print "%0.2f seconds, with %d restarts" % (time.time() - start, sandbox.restarts())
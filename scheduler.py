@@ -0,0 +1,227 @@
+"""
+Orders the files to examine by how likely they are to be interesting, so that
+a run with a deadline reaches the most valuable files first.
+
+Files are ranked using signals that are cheap to collect: the size, the
+extension, and hints in the path. The image dimensions and EXIF presence from
+the first few KB of the file refine the ranking, but reading them takes time,
+so they're read for the most promising files first, and only for a small
+share of the budget. When a time budget is given, the expensive
+optional stages (skin and OCR) are only run while there's slack left in the
+budget; the rest are deferred, and run at the end if there's time left over.
+"""
+
+import time
+import os.path
+import itertools
+import StringIO
+import collections
+
+# PIL
+import PIL.Image
+
+# The amount of data read for the header signals. Enough for most EXIF blocks.
+HEADER_SIZE = 64 * 1024
+
+EXTENSION_SCORES = {
+    '.jpg': 3.0,
+    '.jpeg': 3.0,
+    '.jpe': 3.0,
+    '.png': 2.0,
+    '.bmp': 1.0,
+    '.tif': 1.0,
+    '.tiff': 1.0,
+    '.gif': 0.5,
+}
+
+# Substrings of the path that hint at whether the file is a personal photo
+PATH_HINTS = {
+    'dcim': 2.0,
+    'camera': 1.5,
+    'photo': 1.5,
+    'picture': 1.0,
+    'screenshot': 1.5,
+    'scan': 1.0,
+    'img_': 1.0,
+    'dsc': 1.0,
+    'cache': -1.5,
+    'thumb': -1.5,
+    'icon': -2.0,
+    'temp': -0.5,
+    'sample': -1.0,
+}
+
+# Images smaller than this are mostly icons and UI elements
+MIN_DIMENSION = 100
+
+# The share of the time budget that may be spent reading headers for the ranking
+HEADER_BUDGET_FRACTION = 0.05
+
+
+###############################################################################
+# Ranking
+###############################################################################
+
+def get_header_info(header):
+    """Returns (width, height, has_exif) from the start of an image file.
+    The width and height are None if the header couldn't be parsed."""
+    try:
+        img = PIL.Image.open(StringIO.StringIO(header))
+        width, height = img.size
+        return width, height, 'exif' in img.info
+    except Exception:
+        return None, None, False
+
+
+def score_entry(entry):
+    """Returns a score for an entry from its name and size, without reading it.
+    Higher scores are examined first."""
+    score = 0.0
+
+    name = entry.name.lower()
+    score += EXTENSION_SCORES.get(os.path.splitext(name)[1], 0.0)
+    for hint, value in PATH_HINTS.iteritems():
+        if hint in name:
+            score += value
+
+    # Photos are usually somewhere between tens of KB and tens of MB
+    if entry.size < 8 * 1024:
+        score -= 2.0
+    elif entry.size < 64 * 1024:
+        score -= 0.5
+    elif entry.size <= 32 * 1024 * 1024:
+        score += 1.0
+
+    return score
+
+
+def score_header(header):
+    """Returns the amount to add to an entry's score, from its first bytes"""
+    score = 0.0
+    width, height, has_exif = get_header_info(header)
+    if width is None:
+        # Not an image we can parse, so it will very likely be invalid
+        score -= 3.0
+    elif min(width, height) < MIN_DIMENSION:
+        score -= 2.0
+    else:
+        score += 1.0
+    if has_exif:
+        score += 2.0
+
+    return score
+
+
+def rank_entries(entries, deadline=None):
+    """Returns the entries, sorted from the most to the least promising
+
+    The headers are read in the order of the cheap scores, and only until the
+    deadline (a time.time() value), if one is given. The rest are ranked by
+    their cheap scores alone.
+    """
+    scored = [[score_entry(entry), i, entry] for i, entry in enumerate(entries)]
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    for item in scored:
+        if deadline is not None and time.time() >= deadline:
+            break
+        try:
+            header = item[2].read(HEADER_SIZE)
+        except Exception:
+            header = ''
+        item[0] += score_header(header)
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [entry for score, i, entry in scored]
+
+
+###############################################################################
+# Scheduling
+###############################################################################
+
+class Scheduler(object):
+    """Hands out the entries in priority order, until the time budget runs out.
+
+    time_budget is in seconds, or None for no limit. It's counted from
+    start_time, which defaults to now.
+    """
+
+    def __init__(self, entries, time_budget=None, start_time=None):
+        self.start_time = start_time if start_time is not None else time.time()
+        self.time_budget = time_budget
+        if time_budget is not None:
+            entries = rank_entries(entries, self.start_time + time_budget * HEADER_BUDGET_FRACTION)
+        self.pending = entries
+        self.position = 0
+        self.deferred = collections.deque()
+        # (count, total seconds) of files with and without the optional stages
+        self.core_stats = [0, 0.0]
+        self.full_stats = [0, 0.0]
+
+    def __iter__(self):
+        while self.position < len(self.pending) and not self.exhausted():
+            entry = self.pending[self.position]
+            self.position += 1
+            yield entry
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def remaining_time(self):
+        if self.time_budget is None:
+            return None
+        return self.time_budget - self.elapsed()
+
+    def exhausted(self):
+        return self.time_budget is not None and self.remaining_time() <= 0
+
+    def upcoming(self, count):
+        """Returns the next count entries that will be handed out, without
+        handing them out"""
+        if self.exhausted():
+            return []
+        return self.pending[self.position:self.position + count]
+
+    def upcoming_deferred(self, count):
+        """Returns the next count deferred (file_id, entry)s"""
+        if self.exhausted():
+            return []
+        return list(itertools.islice(self.deferred, count))
+
+    def unreached(self):
+        """Returns the amount of entries that were never handed out"""
+        return len(self.pending) - self.position
+
+    def record(self, seconds, ran_optional):
+        """Records how long a file took, to refine the estimates"""
+        stats = self.full_stats if ran_optional else self.core_stats
+        stats[0] += 1
+        stats[1] += seconds
+
+    def _average(self, stats):
+        count, total = stats
+        return total / count if count else None
+
+    def allow_optional(self):
+        """Returns whether the next file can run the optional stages, without
+        keeping any of the remaining files from their core stages"""
+        if self.time_budget is None:
+            return True
+        core = self._average(self.core_stats)
+        full = self._average(self.full_stats)
+        if full is None:
+            # Not enough information yet, so be optimistic
+            return True
+        if core is None:
+            # Assume the worst until a file without the optional stages is seen
+            core = full
+        remaining = len(self.pending) - self.position
+        slack = self.remaining_time() - remaining * core
+        return slack > full - core
+
+    def defer(self, file_id, entry):
+        """Remembers a file whose optional stages were skipped"""
+        self.deferred.append((file_id, entry))
+
+    def iter_deferred(self):
+        """Hands out the deferred files, for as long as the budget allows"""
+        while self.deferred and not self.exhausted():
+            yield self.deferred.popleft()
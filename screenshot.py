@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+'''
+Cheap detection of desktop screenshots, using where things are on a screen.
+
+Start buttons and taskbar icons are in predictable places, along the edges of
+the screen, and screenshots have the dimensions of a screen. So instead of
+matching features across the whole image, the image is first checked for:
+ * dimensions that are a common screen resolution (or at least the same
+   aspect ratio as one)
+ * the icon templates, along the downscaled edge strips where taskbars are,
+   using plain template matching at a few taskbar sizes
+
+These give a confidence score. Feature matching against the icons is only
+needed when the score is inconclusive.
+
+USAGE
+  screenshot.py <image> [<image> ...]   (Prints the confidence for each image)
+'''
+
+import os
+import sys
+
+import cv2
+
+# Bumped whenever the scoring changes, so that cached results are redone
+VERSION = 1
+
+COMMON_RESOLUTIONS = set([
+    (640, 480), (800, 600), (1024, 600), (1024, 768), (1152, 864), (1280, 720),
+    (1280, 768), (1280, 800), (1280, 960), (1280, 1024), (1360, 768), (1366, 768),
+    (1400, 1050), (1440, 900), (1600, 900), (1600, 1200), (1680, 1050), (1920, 1080),
+    (1920, 1200), (2048, 1152), (2560, 1080), (2560, 1440), (2560, 1600), (2880, 1800),
+    (3440, 1440), (3840, 2160),
+])
+
+SCREEN_ASPECTS = sorted(set(round(float(w) / h, 3) for w, h in COMMON_RESOLUTIONS))
+
+# How closely an aspect ratio must match a screen's
+ASPECT_TOLERANCE = 0.01
+
+# The image is downscaled to this width before the strips are examined
+WORK_WIDTH = 640
+
+# The taskbar heights that are tried, as a fraction of the screen's height
+TASKBAR_FRACTIONS = (0.028, 0.038, 0.05)
+
+# The icons take up most of the taskbar's height
+ICON_FILL = 0.85
+
+# How far in from each edge is examined, as a multiple of the largest taskbar
+STRIP_MARGIN = 1.5
+
+# Template matching scores (normalized correlation) that are treated as no
+# match and as a certain match
+MIN_CORRELATION = 0.4
+MAX_CORRELATION = 0.9
+
+# How much each signal counts towards the confidence. A matching aspect ratio
+# alone counts for little, since cameras share them with screens.
+RESOLUTION_WEIGHT = 0.4
+STRIP_WEIGHT = 0.6
+EXACT_RESOLUTION_SCORE = 1.0
+ASPECT_ONLY_SCORE = 0.3
+
+# Confidences at or above this are screenshots, and below LOW_CONFIDENCE they
+# aren't. Anything in between falls back to feature matching.
+HIGH_CONFIDENCE = 0.75
+LOW_CONFIDENCE = 0.25
+
+# (filename, height) -> the template resized to that height. Only a few
+# heights come up, since most images are downscaled to the same width.
+g_icons = {}
+
+
+def config():
+    """Describes the detector, so that a change to it invalidates the results"""
+    return {'version': VERSION, 'high': HIGH_CONFIDENCE, 'low': LOW_CONFIDENCE,
+            'resolution_weight': RESOLUTION_WEIGHT, 'strip_weight': STRIP_WEIGHT,
+            'exact_resolution_score': EXACT_RESOLUTION_SCORE, 'aspect_only_score': ASPECT_ONLY_SCORE,
+            'resolutions': sorted(COMMON_RESOLUTIONS), 'aspect_tolerance': ASPECT_TOLERANCE,
+            'work_width': WORK_WIDTH, 'taskbar_fractions': TASKBAR_FRACTIONS, 'icon_fill': ICON_FILL,
+            'strip_margin': STRIP_MARGIN, 'correlation': (MIN_CORRELATION, MAX_CORRELATION)}
+
+
+def load_templates(dirname):
+    """Returns a list of (filename, grayscale template) for the icons in dirname"""
+    templates = []
+    for entry in sorted(os.listdir(dirname)):
+        fname = os.path.join(dirname, entry)
+        img = cv2.imread(fname, cv2.CV_LOAD_IMAGE_GRAYSCALE) if os.path.isfile(fname) else None
+        if img is not None:
+            templates.append((fname, img))
+    return templates
+
+
+def resolution_score(width, height):
+    """Scores how much the dimensions look like a screen's"""
+    if (width, height) in COMMON_RESOLUTIONS:
+        return EXACT_RESOLUTION_SCORE
+    if not height:
+        return 0.0
+    aspect = float(width) / height
+    for screen_aspect in SCREEN_ASPECTS:
+        if abs(aspect - screen_aspect) <= screen_aspect * ASPECT_TOLERANCE:
+            return ASPECT_ONLY_SCORE
+    return 0.0
+
+
+def get_strips(gray, thickness):
+    """Returns the bottom, top, left, and right edge strips of an image"""
+    height, width = gray.shape[:2]
+    return [gray[height - thickness:, :], gray[:thickness, :],
+            gray[:, :thickness], gray[:, width - thickness:]]
+
+
+def get_icon(fname, template, height):
+    """Returns the template resized to the given height"""
+    key = (fname, height)
+    if key not in g_icons:
+        t_height, t_width = template.shape[:2]
+        width = max(1, int(t_width * float(height) / t_height))
+        g_icons[key] = cv2.resize(template, (width, height), interpolation=cv2.INTER_AREA)
+    return g_icons[key]
+
+
+def strip_score(img, templates):
+    """Returns (score, filename) for the best match of a template along the
+    edges of the image. The score is from 0 to 1."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+    height, width = gray.shape[:2]
+    if width > WORK_WIDTH:
+        scale = float(WORK_WIDTH) / width
+        gray = cv2.resize(gray, (WORK_WIDTH, max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        height, width = gray.shape[:2]
+
+    thickness = max(1, int(height * max(TASKBAR_FRACTIONS) * STRIP_MARGIN))
+    strips = get_strips(gray, thickness)
+    best, best_fname = 0.0, ''
+    for fraction in TASKBAR_FRACTIONS:
+        icon_height = int(height * fraction * ICON_FILL)
+        if icon_height < 4:
+            continue
+        for fname, template in templates:
+            icon = get_icon(fname, template, icon_height)
+            icon_width = icon.shape[1]
+            for strip in strips:
+                if strip.shape[0] < icon_height or strip.shape[1] < icon_width:
+                    continue
+                result = cv2.matchTemplate(strip, icon, cv2.TM_CCOEFF_NORMED)
+                correlation = float(result.max())
+                if correlation > best:
+                    best, best_fname = correlation, fname
+    score = (best - MIN_CORRELATION) / (MAX_CORRELATION - MIN_CORRELATION)
+    return min(1.0, max(0.0, score)), best_fname
+
+
+def get_confidence(img, templates):
+    """Returns (confidence, filename) that the image is a screenshot, where
+    the filename is the best matching icon"""
+    height, width = img.shape[:2]
+    score, fname = strip_score(img, templates)
+    confidence = RESOLUTION_WEIGHT * resolution_score(width, height) + STRIP_WEIGHT * score
+    return confidence, fname if score > 0 else ''
+
+
+def is_conclusive(confidence):
+    return confidence >= HIGH_CONFIDENCE or confidence < LOW_CONFIDENCE
+
+
+def combine_confidence(confidence, matched):
+    """Adjusts an inconclusive confidence with the result of feature matching"""
+    if matched:
+        return max(confidence, HIGH_CONFIDENCE)
+    return min(confidence, LOW_CONFIDENCE)
+
+
+def detect(img, templates, match_icons):
+    """Returns whether the image is a screenshot, the filename of the icon ('' if
+    it isn't), and the confidence from 0 to 1. match_icons is only called when
+    the confidence is inconclusive, and returns whether feature matching found
+    the icons and the filename of the one that matched."""
+    confidence, fname = get_confidence(img, templates)
+    if is_conclusive(confidence):
+        is_screenshot = confidence >= HIGH_CONFIDENCE
+    else:
+        is_screenshot, fname = match_icons()
+        confidence = combine_confidence(confidence, is_screenshot)
+    return is_screenshot, fname if is_screenshot else '', confidence
+
+###############################################################################
+# Test Main
+###############################################################################
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "USAGE: screenshot.py <image> [<image> ...]"
+        sys.exit(1)
+    templates = load_templates('./common_desktop_icons')
+    for fname in sys.argv[1:]:
+        img = cv2.imread(fname)
+        if img is None:
+            print "%s: couldn't be loaded" % fname
+            continue
+        confidence, icon = get_confidence(img, templates)
+        verdict = 'yes' if confidence >= HIGH_CONFIDENCE else 'no' if confidence < LOW_CONFIDENCE else 'maybe'
+        print "%s: %0.2f (%s) %s" % (fname, confidence, verdict, icon)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+'''
+Watches a directory for new files, such as the output of a running carver.
+
+New and changed files are found with inotify (through pyinotify) when it's
+installed, and by periodically walking the directory otherwise. A file is
+only handed out once its size and modification time have stopped changing for
+a while, so that files which are still being written aren't examined early.
+
+USAGE
+  watch.py <dir>   (Prints each file once it's ready)
+'''
+
+import os
+import sys
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# How long a file must go unchanged before it's ready, in seconds
+DEFAULT_SETTLE = 5.0
+
+# How often the directory is walked, when inotify isn't available
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+def get_signature(fname):
+    """Returns the (size, modification time) of a file, or None if it's gone"""
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+if pyinotify is not None:
+    class _EventHandler(pyinotify.ProcessEvent):
+        """Passes the files that inotify reports on to the watcher"""
+
+        def my_init(self, watcher=None):
+            self.watcher = watcher
+
+        def process_IN_Q_OVERFLOW(self, event):
+            # Events were dropped, so fall back to walking everything
+            self.watcher.scan()
+
+        def process_default(self, event):
+            if not event.dir:
+                self.watcher.touch(event.pathname)
+
+
+class Watcher(object):
+    """Finds the files under root that are ready to be examined
+
+    settle        - how long a file must go unchanged, in seconds
+    poll_interval - how often the directory is walked without inotify
+    use_inotify   - whether to use inotify, if it's available
+    """
+
+    def __init__(self, root, settle=DEFAULT_SETTLE, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        self.root = os.path.abspath(root)
+        self.settle = settle
+        self.poll_interval = poll_interval
+        # fname -> signature, for the files that were handed out
+        self.known = {}
+        # fname -> (signature, time it last changed), for the files that
+        # haven't settled yet
+        self.candidates = {}
+        self.last_scan = 0
+        self.notifier = None
+        if use_inotify and pyinotify is not None:
+            manager = pyinotify.WatchManager()
+            mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                    pyinotify.IN_CREATE | pyinotify.IN_MODIFY)
+            self.notifier = pyinotify.Notifier(manager, _EventHandler(watcher=self))
+            manager.add_watch(self.root, mask, rec=True, auto_add=True)
+        # Everything that's already there is new to us
+        self.scan()
+
+    def using_inotify(self):
+        return self.notifier is not None
+
+    def touch(self, fname):
+        """Notes that a file was created or changed"""
+        signature = get_signature(fname)
+        if signature is None:
+            self.candidates.pop(fname, None)
+        elif self.known.get(fname) != signature:
+            previous = self.candidates.get(fname)
+            if previous is None or previous[0] != signature:
+                self.candidates[fname] = (signature, time.time())
+
+    def scan(self):
+        """Walks the whole directory for new and changed files"""
+        self.last_scan = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                self.touch(os.path.join(dirpath, fname))
+
+    def wait(self, timeout=1.0):
+        """Waits up to timeout seconds for changes, and then returns the files
+        that have settled"""
+        if self.notifier is not None:
+            if self.notifier.check_events(int(timeout * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        else:
+            time.sleep(max(0, min(timeout, self.last_scan + self.poll_interval - time.time())))
+            if time.time() - self.last_scan >= self.poll_interval:
+                self.scan()
+        return self.ready()
+
+    def ready(self):
+        """Returns the candidates that haven't changed for long enough"""
+        now = time.time()
+        ready = []
+        for fname, (signature, changed) in sorted(self.candidates.items()):
+            current = get_signature(fname)
+            if current is None:
+                del self.candidates[fname]
+            elif current != signature:
+                # inotify doesn't report every write, so check again
+                self.candidates[fname] = (current, now)
+            elif now - changed >= self.settle:
+                del self.candidates[fname]
+                self.known[fname] = signature
+                ready.append(fname)
+        return ready
+
+    def pending(self):
+        """Returns the amount of files that are waiting to settle"""
+        return len(self.candidates)
+
+###############################################################################
+# Test Main
+###############################################################################
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "USAGE: watch.py <dir>"
+        sys.exit(1)
+    watcher = Watcher(sys.argv[1])
+    print "Watching %s (%s)" % (watcher.root, 'inotify' if watcher.using_inotify() else 'polling')
+    try:
+        while True:
+            for fname in watcher.wait():
+                print fname
+    except KeyboardInterrupt:
+        pass